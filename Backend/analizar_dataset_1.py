@@ -5,8 +5,9 @@ Script avanzado para extraer y procesar datos del dataset 1 (Incidències viàri
 import requests
 from lxml import etree
 import json
-from datetime import datetime
 from typing import List, Dict
+from datasets import Incidencia, iterar_incidencias
+import metrics
 
 # Dataset 1: SCT – Incidències viàries Catalunya
 DATASET_URL = "https://www.gencat.cat/transit/opendata/incidenciesGML.xml"
@@ -23,78 +24,62 @@ def descargar_xml(url: str) -> str:
         print(f"✗ Error descargando XML: {str(e)}")
         raise
 
+# Campos básicos de la afectación y el tipo al que se convierten
+CAMPOS = {
+    'identificador': 'int',
+    'tipus': 'int',
+    'subtipus': 'int',
+    'carretera': 'str',
+    'pk_inici': 'float',
+    'pk_fi': 'float',
+    'causa': 'str',
+    'data': 'str',
+    'nivell': 'int',
+    'sentit': 'str',
+    'descripcio': 'str',
+    'descripcio_tipus': 'str',
+    'font': 'str',
+    'cap_a': 'str'
+}
+
+def incidencia_a_registro(inc: Incidencia) -> Dict:
+    """Convierte una Incidencia del parser a un diccionario con los campos tipados"""
+    incidencia = {}
+    for campo, tipo in CAMPOS.items():
+        texto = getattr(inc, campo)
+        if texto:
+            valor = texto.strip()
+            # Convertir tipo si es necesario
+            if tipo == 'int':
+                try:
+                    incidencia[campo] = int(valor)
+                except ValueError:
+                    incidencia[campo] = valor
+            elif tipo == 'float':
+                try:
+                    incidencia[campo] = float(valor)
+                except ValueError:
+                    incidencia[campo] = valor
+            else:
+                incidencia[campo] = valor
+
+    if inc.lat is not None:
+        incidencia['longitud'] = inc.lon
+        incidencia['latitud'] = inc.lat
+    return incidencia
+
+@metrics.medir("extraer_incidencias")
 def extraer_incidencias(xml_content: str) -> List[Dict]:
     """
     Extrae información estructurada de las incidencias del XML
     """
     try:
         print("\nExtrayendo incidencias...")
-        root = etree.fromstring(xml_content.encode('utf-8'))
-        
-        # Definir namespaces
-        namespaces = {
-            'wfs': 'http://www.opengis.net/wfs',
-            'gml': 'http://www.opengis.net/gml',
-            'cite': 'http://www.opengeospatial.net/cite'
-        }
-        
-        incidencias = []
-        
-        # Buscar todos los elementos featureMember
-        for feature_member in root.findall('.//gml:featureMember', namespaces):
-            feature = feature_member.find('.//cite:mct2_v_afectacions_data', namespaces)
-            
-            if feature is not None:
-                incidencia = {}
-                
-                # Extraer campos básicos
-                campos = {
-                    'identificador': 'int',
-                    'tipus': 'int',
-                    'subtipus': 'int',
-                    'carretera': 'str',
-                    'pk_inici': 'float',
-                    'pk_fi': 'float',
-                    'causa': 'str',
-                    'data': 'str',
-                    'nivell': 'int',
-                    'sentit': 'str',
-                    'descripcio': 'str',
-                    'descripcio_tipus': 'str',
-                    'font': 'str',
-                    'cap_a': 'str'
-                }
-                
-                for campo, tipo in campos.items():
-                    elem = feature.find(f'cite:{campo}', namespaces)
-                    if elem is not None and elem.text:
-                        valor = elem.text.strip()
-                        # Convertir tipo si es necesario
-                        if tipo == 'int':
-                            try:
-                                incidencia[campo] = int(valor)
-                            except ValueError:
-                                incidencia[campo] = valor
-                        elif tipo == 'float':
-                            try:
-                                incidencia[campo] = float(valor)
-                            except ValueError:
-                                incidencia[campo] = valor
-                        else:
-                            incidencia[campo] = valor
-                
-                # Extraer coordenadas
-                coords = feature.find('.//gml:coordinates', namespaces)
-                if coords is not None and coords.text:
-                    try:
-                        lon, lat = coords.text.strip().split(',')
-                        incidencia['longitud'] = float(lon)
-                        incidencia['latitud'] = float(lat)
-                    except:
-                        pass
-                
-                incidencias.append(incidencia)
-        
+        incidencias = [
+            incidencia_a_registro(inc)
+            for inc in iterar_incidencias(xml_content.encode('utf-8'))
+            if inc.tiene_afectacion
+        ]
         print(f"✓ {len(incidencias)} incidencias extraídas")
         return incidencias
     
@@ -0,0 +1,150 @@
+"""
+Caché de autenticación: tokens ya verificados y sesiones revocadas.
+
+  - CacheTokens: LRU acotado token -> valor (el usuario y su sesión). Un
+    token que ya se verificó (firma JWT + usuario en la base de datos) no
+    se vuelve a decodificar ni a buscar mientras no caduque: cada entrada
+    guarda la expiración del JWT y deja de servirse en ese instante.
+  - Revocaciones: identificadores de sesión (sid) cerrados con /logout.
+    La fuente de verdad es la base de datos; cada proceso guarda el
+    conjunto en memoria y lo pone al día como mucho cada `intervalo`
+    segundos leyendo sólo las revocaciones nuevas (con un solape hacia
+    atrás para las que se confirman tarde), así que con varios workers un
+    logout tarda como máximo ese intervalo en verse en todos.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+
+class CacheTokens:
+    def __init__(self, maximo: int = 10000):
+        """
+        Args:
+            maximo: número máximo de tokens en la caché (se expulsan los menos usados)
+        """
+        self.maximo = maximo
+        self._entradas: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "size": 0}
+
+    def obtener(self, token: str) -> Optional[Any]:
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(token)
+            if entrada is None:
+                self.stats["misses"] += 1
+                return None
+            expira, valor = entrada
+            if expira <= ahora:
+                del self._entradas[token]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                self.stats["size"] = len(self._entradas)
+                return None
+            self._entradas.move_to_end(token)
+            self.stats["hits"] += 1
+            return valor
+
+    def guardar(self, token: str, valor: Any, expira: float) -> None:
+        """Guarda el valor hasta `expira` (epoch, el 'exp' del JWT)."""
+        if self.maximo <= 0 or expira <= time.time():
+            return
+        with self._lock:
+            self._entradas[token] = (expira, valor)
+            self._entradas.move_to_end(token)
+            if len(self._entradas) > self.maximo:
+                self._purgar_caducados()
+            while len(self._entradas) > self.maximo:
+                self._entradas.popitem(last=False)
+                self.stats["evictions"] += 1
+            self.stats["size"] = len(self._entradas)
+
+    def _purgar_caducados(self) -> None:
+        ahora = time.time()
+        for token in [t for t, (expira, _) in self._entradas.items() if expira <= ahora]:
+            del self._entradas[token]
+            self.stats["expired"] += 1
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+
+class Revocaciones:
+    def __init__(self, intervalo: float = 5.0, solape: float = 30.0):
+        """
+        Args:
+            intervalo: segundos entre sincronizaciones con la base de datos
+            solape: segundos antes de la última revocación vista desde los que se vuelve a leer.
+                revoked_at se fija antes del commit: una revocación de otro proceso puede
+                confirmarse después de una sincronización que ya vio otras más recientes,
+                y sin solape no se leería nunca (su token seguiría valiendo hasta caducar)
+        """
+        self.intervalo = intervalo
+        self.solape = timedelta(seconds=solape)
+        # sid -> expiración (epoch) de la sesión: pasada ésta ya no hace falta recordarla
+        self._revocadas: Dict[str, float] = {}
+        self._marca: Optional[datetime] = None
+        self._ultima = float("-inf")
+        # _lock protege _revocadas (logout en un hilo, sincronización en otro);
+        # _sincronizando deja que sólo un hilo consulte la base de datos
+        self._lock = threading.Lock()
+        self._sincronizando = threading.Lock()
+        self.stats = {"revoked": 0, "syncs": 0, "sync_errors": 0}
+
+    def revocada(self, sid: str) -> bool:
+        return sid in self._revocadas
+
+    def revocar(self, sid: str, expira: float) -> None:
+        with self._lock:
+            self._revocadas[sid] = expira
+            self.stats["revoked"] = len(self._revocadas)
+
+    def sincronizar_si_toca(self, cargar: Callable[[Optional[datetime]], Iterable[Tuple[str, datetime, datetime]]]) -> None:
+        """
+        Lee las revocaciones nuevas si ha pasado el intervalo. Sólo sincroniza
+        un hilo; los demás siguen con el conjunto que ya hay en memoria.
+
+        Args:
+            cargar: función (revocadas desde, None = todas) -> filas (sid, expires_at, revoked_at)
+        """
+        if time.monotonic() - self._ultima < self.intervalo or not self._sincronizando.acquire(blocking=False):
+            return
+        try:
+            self._ultima = time.monotonic()
+            marca = self._marca
+            # La consulta se hace sin _lock: los logouts no esperan a la base de datos
+            nuevas = {}
+            for sid, expira, revocada in cargar(None if marca is None else marca - self.solape):
+                nuevas[sid] = _epoch(expira)
+                revocada = _utc(revocada)
+                if marca is None or revocada > marca:
+                    marca = revocada
+            with self._lock:
+                self._revocadas.update(nuevas)
+                self._purgar()
+            self._marca = marca
+            self.stats["syncs"] += 1
+        except Exception as exc:
+            self.stats["sync_errors"] += 1
+            print(f"Error sincronizando revocaciones: {exc}")
+        finally:
+            self._sincronizando.release()
+
+    def _purgar(self) -> None:
+        """Olvida las sesiones ya caducadas. Debe llamarse con _lock adquirido."""
+        ahora = time.time()
+        for sid in [s for s, expira in self._revocadas.items() if expira <= ahora]:
+            del self._revocadas[sid]
+        self.stats["revoked"] = len(self._revocadas)
+
+
+def _utc(instante: datetime) -> datetime:
+    # SQLite devuelve los datetime sin zona horaria (se guardan en UTC)
+    return instante.replace(tzinfo=timezone.utc) if instante.tzinfo is None else instante
+
+
+def _epoch(instante: datetime) -> float:
+    return _utc(instante).timestamp()
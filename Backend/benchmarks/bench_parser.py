@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Compara el parser en streaming (datasets.iterar_incidencias) con el parser
+anterior basado en árbol completo (etree.fromstring + xpath) sobre feeds
+sintéticos grandes.
+
+Cada caso se ejecuta en un proceso nuevo para medir el pico de memoria
+(ru_maxrss) sin interferencias entre casos.
+
+Uso (desde Backend/):
+    python benchmarks/bench_parser.py 1000 10000 100000
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lxml import etree  # noqa: E402
+
+from benchmarks.generar_gml import generar_gml  # noqa: E402
+from datasets import iterar_incidencias, parsear_incidencias_detalladas  # noqa: E402
+
+
+def _arbol_detalles(path: str) -> int:
+    """Parser anterior de extraer_coordenadas_con_detalles (árbol completo + búsquedas .//)."""
+    with open(path, "rb") as f:
+        root = etree.fromstring(f.read())
+    namespaces = {
+        'gml': 'http://www.opengis.net/gml',
+        'cite': 'http://www.opengeospatial.net/cite',
+        'wfs': 'http://www.opengis.net/wfs'
+    }
+    incidencias = []
+    for feature in root.xpath('.//gml:featureMember', namespaces=namespaces):
+        coords_elem = feature.find('.//gml:coordinates', namespaces)
+        if coords_elem is None or not coords_elem.text:
+            continue
+        parts = coords_elem.text.strip().split(',')
+        if len(parts) < 2:
+            continue
+        try:
+            lon, lat = float(parts[0]), float(parts[1])
+        except ValueError:
+            continue
+        incidencia = {'lat': lat, 'lon': lon}
+        afectacion = feature.find('.//cite:mct2_v_afectacions_data', namespaces)
+        if afectacion is not None:
+            for elem in afectacion:
+                incidencia[elem.tag.split('}')[-1]] = elem.text
+        incidencias.append(incidencia)
+    return len(incidencias)
+
+
+def _streaming_detalles(path: str) -> int:
+    with open(path, "rb") as f:
+        return len(parsear_incidencias_detalladas(f))
+
+
+def _streaming_contar(path: str) -> int:
+    """Sólo recorre el stream sin acumular: muestra la memoria plana del parser."""
+    with open(path, "rb") as f:
+        return sum(1 for _ in iterar_incidencias(f))
+
+
+def _primer_registro(path: str) -> float:
+    inicio = time.perf_counter()
+    with open(path, "rb") as f:
+        next(iterar_incidencias(f))
+    return time.perf_counter() - inicio
+
+
+IMPLEMENTACIONES = {
+    "arbol (anterior)": _arbol_detalles,
+    "streaming (lista)": _streaming_detalles,
+    "streaming (sin acumular)": _streaming_contar,
+}
+
+
+def _medir(nombre: str, path: str) -> dict:
+    rss_inicial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    inicio = time.perf_counter()
+    n = IMPLEMENTACIONES[nombre](path)
+    segundos = time.perf_counter() - inicio
+    rss_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"n": n, "segundos": segundos, "pico_mb": (rss_final - rss_inicial) / 1024}
+
+
+def _en_proceso_nuevo(fn, *args):
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def main(tamanios):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'features':>10} {'implementación':<26} {'tiempo (s)':>10} {'feat/s':>10} {'pico (MB)':>10}")
+        for n in tamanios:
+            path = generar_gml(n, os.path.join(tmp, f"incidencies_{n}.xml"))
+            for nombre in IMPLEMENTACIONES:
+                r = _en_proceso_nuevo(_medir, nombre, path)
+                print(f"{n:>10} {nombre:<26} {r['segundos']:>10.3f} {r['n'] / r['segundos']:>10.0f} {r['pico_mb']:>10.1f}")
+            primero = _en_proceso_nuevo(_primer_registro, path)
+            print(f"{n:>10} {'primer registro':<26} {primero:>10.4f}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Logins por segundo según el coste del hash de contraseñas.
+
+Para cada número de rondas (PASSWORD_ROUNDS) mide primero lo que tarda un
+hash en un núcleo y después arranca el backend con uvicorn con ese coste
+(base de datos nueva: el usuario admin se crea con él) y lanza una ráfaga
+de POST /login concurrentes durante unos segundos, midiendo a la vez la
+latencia de /datasets para ver si el resto de endpoints se resiente.
+
+Sirve para elegir PASSWORD_ROUNDS / PASSWORD_HASH_PROCESSES en cada máquina:
+el coste más alto que mantiene los logins/s necesarios.
+
+Uso (desde Backend/):
+    python benchmarks/bench_password.py
+    python benchmarks/bench_password.py --rondas 29000 100000 600000 --concurrencia 64 --duracion 5
+    python benchmarks/bench_password.py --esquema bcrypt --rondas 10 12 --procesos 2
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+from password_hashing import crear_contexto  # noqa: E402
+
+PUERTO_BACKEND = 18002
+RONDAS = [29000, 100000, 300000, 600000]
+
+
+def percentil(valores, p):
+    if not valores:
+        return float("nan")
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def coste_hash_ms(esquema: str, rondas: int, repeticiones: int = 5) -> float:
+    contexto = crear_contexto(esquema, rondas)
+    hashed = contexto.hash("admin")
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        contexto.verify("admin", hashed)
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+
+async def rafaga(client: httpx.AsyncClient, concurrencia: int, duracion: float) -> dict:
+    latencias, datasets = [], []
+    codigos = {}
+    fin = time.perf_counter() + duracion
+
+    async def login():
+        while time.perf_counter() < fin:
+            inicio = time.perf_counter()
+            r = await client.post("/login", json={"username": "admin", "password": "admin"})
+            codigos[r.status_code] = codigos.get(r.status_code, 0) + 1
+            if r.status_code == 200:
+                latencias.append((time.perf_counter() - inicio) * 1000)
+            elif r.status_code == 429:
+                await asyncio.sleep(0.05)
+
+    async def sondeo():
+        while time.perf_counter() < fin:
+            inicio = time.perf_counter()
+            r = await client.get("/datasets")
+            r.raise_for_status()
+            datasets.append((time.perf_counter() - inicio) * 1000)
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(sondeo(), *(login() for _ in range(concurrencia)))
+    return {"latencias": latencias, "datasets": datasets, "codigos": codigos}
+
+
+async def medir(esquema: str, rondas: int, args) -> dict:
+    tmp = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+        DATASET_STORE_DIR=os.path.join(tmp, "store"),
+        PASSWORD_SCHEME=esquema,
+        PASSWORD_ROUNDS=str(rondas),
+        # Sin feeds reales: el poller falla en segundo plano sin afectar a /login
+        SCT_FEED_URL="http://127.0.0.1:9/incidenciesGML.xml",
+        FUENTES_ACTIVAS="",
+        SCT_HISTORIAL_ENABLED="0",
+    )
+    if args.procesos:
+        env["PASSWORD_HASH_PROCESSES"] = str(args.procesos)
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PUERTO_BACKEND), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrencia + 10)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PUERTO_BACKEND}", limits=limits, timeout=60) as client:
+            for _ in range(200):
+                try:
+                    await client.get("/datasets")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            # Calentamiento: arranca los procesos del pool
+            await client.post("/login", json={"username": "admin", "password": "admin"})
+            resultado = await rafaga(client, args.concurrencia, args.duracion)
+    finally:
+        backend.terminate()
+        backend.wait()
+    resultado["logins_s"] = len(resultado["latencias"]) / args.duracion
+    return resultado
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--esquema", default="pbkdf2_sha256")
+    parser.add_argument("--rondas", type=int, nargs="+", default=RONDAS)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--duracion", type=float, default=5.0)
+    parser.add_argument("--procesos", type=int, default=None, help="PASSWORD_HASH_PROCESSES del backend")
+    args = parser.parse_args()
+
+    print(f"{args.esquema}, {args.concurrencia} logins concurrentes durante {args.duracion:.0f}s, {os.cpu_count()} CPU")
+    print(f"{'rondas':>8} {'hash (ms)':>10} {'logins/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} "
+          f"{'429':>6} {'/datasets p99':>14}")
+    for rondas in args.rondas:
+        coste = coste_hash_ms(args.esquema, rondas)
+        r = await medir(args.esquema, rondas, args)
+        print(f"{rondas:>8} {coste:>10.1f} {r['logins_s']:>9.1f} {percentil(r['latencias'], 50):>9.1f} "
+              f"{percentil(r['latencias'], 99):>9.1f} {r['codigos'].get(429, 0):>6} "
+              f"{percentil(r['datasets'], 99):>14.1f}")
+        otros = {c: n for c, n in r["codigos"].items() if c not in (200, 429)}
+        if otros:
+            print(f"         respuestas inesperadas: {otros}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Mide filtros y group-by de la tabla columnar (incident_table) frente a las
+mismas operaciones sobre la lista de diccionarios.
+
+Uso (desde Backend/):
+    python benchmarks/bench_tabla.py 500000
+"""
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.generar_gml import generar_gml_bytes  # noqa: E402
+from datasets import parsear_incidencias_detalladas  # noqa: E402
+from incident_index import parse_nivel  # noqa: E402
+from incident_table import TablaIncidencias  # noqa: E402
+
+
+def _medir(fn, repeticiones: int = 20) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        fn()
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+
+def main(n: int) -> None:
+    base = parsear_incidencias_detalladas(generar_gml_bytes(min(n, 10000)))
+    incidencias = (base * (n // len(base) + 1))[:n]
+
+    inicio = time.perf_counter()
+    tabla = TablaIncidencias(incidencias)
+    print(f"{n} incidencias, tabla construida en {time.perf_counter() - inicio:.2f}s")
+
+    casos = {
+        "graves por causa": (
+            lambda: Counter(inc.get('causa') for inc in incidencias if parse_nivel(inc.get('nivel')) >= 3),
+            lambda: tabla.contar_por('causa', tabla.mascara_graves()),
+        ),
+        "por carretera": (
+            lambda: Counter(inc.get('carretera') for inc in incidencias),
+            lambda: tabla.contar_por('carretera'),
+        ),
+        "cortadas (filtro)": (
+            lambda: [inc for inc in incidencias
+                     if 'tallat' in (inc.get('descripcion') or '').lower()
+                     or 'tall' in (inc.get('tipo') or '').lower()
+                     or parse_nivel(inc.get('nivel')) >= 4],
+            lambda: tabla.filas(tabla.mascara_cortadas()),
+        ),
+        "por nivel": (
+            lambda: Counter(parse_nivel(inc.get('nivel')) for inc in incidencias),
+            lambda: tabla.contar_por_nivel(),
+        ),
+    }
+    print(f"{'operación':<20} {'dicts (ms)':>12} {'tabla (ms)':>12}")
+    for nombre, (con_dicts, con_tabla) in casos.items():
+        print(f"{nombre:<20} {_medir(con_dicts, 3):>12.2f} {_medir(con_tabla):>12.3f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Genera ficheros incidenciesGML.xml sintéticos con el esquema del feed SCT
+(wfs:FeatureCollection > gml:featureMember > cite:mct2_v_afectacions_data).
+
+Uso:
+    python benchmarks/generar_gml.py 10000 incidencies_10k.xml
+"""
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+CABECERA = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+    'xmlns:gml="http://www.opengis.net/gml" '
+    'xmlns:cite="http://www.opengeospatial.net/cite">\n'
+)
+PIE = '</wfs:FeatureCollection>\n'
+
+CARRETERES = ["AP-7", "C-58", "C-31", "C-32", "C-16", "C-17", "B-23", "B-20", "BV-1462", "A-2", "N-II", "C-25"]
+CAUSES = ["Accident", "Obres", "Neu", "Gel", "Avaria", "Manifestació", "Cotxe aturat", "Trànsit intens"]
+TIPUS = ["Retenció", "Tall total", "Tall parcial", "Obres", "Cons", "Circulació lenta"]
+DESCRIPCIONS = ["Carril tallat", "Retenció", "Calçada tallada", "Circulació irregular", "Cons a la via"]
+SENTITS = ["Nord", "Sud", "Est", "Oest", "Ambdós sentits"]
+DESTINS = ["Barcelona", "Girona", "Lleida", "Tarragona", "França", "Manresa"]
+
+
+def feature(r: random.Random, i: int, base: datetime) -> str:
+    lon = r.uniform(0.2, 3.3)
+    lat = r.uniform(40.6, 42.8)
+    pk = r.uniform(0, 200)
+    data = (base - timedelta(minutes=r.randint(0, 60 * 24 * 30))).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    return (
+        '<gml:featureMember>'
+        f'<cite:mct2_v_afectacions_data fid="mct2_v_afectacions_data.{i}">'
+        f'<cite:identificador>{100000 + i}</cite:identificador>'
+        f'<cite:tipus>{r.randint(1, 6)}</cite:tipus>'
+        f'<cite:subtipus>{r.randint(1, 20)}</cite:subtipus>'
+        f'<cite:carretera>{r.choice(CARRETERES)}</cite:carretera>'
+        f'<cite:pk_inici>{pk:.1f}</cite:pk_inici>'
+        f'<cite:pk_fi>{pk + r.uniform(0, 8):.1f}</cite:pk_fi>'
+        f'<cite:causa>{r.choice(CAUSES)}</cite:causa>'
+        f'<cite:data>{data}</cite:data>'
+        f'<cite:nivell>{r.randint(1, 5)}</cite:nivell>'
+        f'<cite:sentit>{r.choice(SENTITS)}</cite:sentit>'
+        f'<cite:descripcio>{r.choice(DESCRIPCIONS)}</cite:descripcio>'
+        f'<cite:descripcio_tipus>{r.choice(TIPUS)}</cite:descripcio_tipus>'
+        '<cite:font>SCT</cite:font>'
+        f'<cite:cap_a>{r.choice(DESTINS)}</cite:cap_a>'
+        '<cite:geom><gml:Point srsName="EPSG:4326">'
+        f'<gml:coordinates decimal="." cs="," ts=" ">{lon:.8f},{lat:.8f}</gml:coordinates>'
+        '</gml:Point></cite:geom>'
+        '</cite:mct2_v_afectacions_data>'
+        '</gml:featureMember>\n'
+    )
+
+
+def generar_gml(n: int, path: str, seed: int = 0) -> str:
+    """Escribe un feed sintético de n incidencias en path (en streaming) y devuelve path."""
+    r = random.Random(seed)
+    base = datetime(2026, 1, 14, 12, 0, tzinfo=timezone.utc)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(CABECERA)
+        for i in range(n):
+            f.write(feature(r, i, base))
+        f.write(PIE)
+    return path
+
+
+def generar_gml_bytes(n: int, seed: int = 0) -> bytes:
+    r = random.Random(seed)
+    base = datetime(2026, 1, 14, 12, 0, tzinfo=timezone.utc)
+    return (CABECERA + "".join(feature(r, i, base) for i in range(n)) + PIE).encode("utf-8")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    generar_gml(int(sys.argv[1]), sys.argv[2])
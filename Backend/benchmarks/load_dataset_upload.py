@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga: subidas concurrentes de datasets según el tamaño del catálogo.
+
+Para cada tamaño crea una base de datos con ese número de datasets, arranca
+el backend con uvicorn (varios workers, como en producción) y lanza
+POST /datasets/upload concurrentes, cada uno con un fichero distinto.
+Comprueba que no se pierde ninguna subida ni se repite ningún id (todas
+201, ids distintos, el catálogo crece exactamente en el número de subidas
+y cada dataset tiene su fichero con el link a su propio id) y mide la
+latencia, que no debe depender del tamaño del catálogo.
+
+Uso (desde Backend/):
+    python benchmarks/load_dataset_upload.py
+    python benchmarks/load_dataset_upload.py --datasets 0 100000 --subidas 500 --concurrencia 64 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+from sqlalchemy import create_engine, func, insert, select
+from sqlmodel import SQLModel
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PUERTO_BACKEND = 18004
+DATASETS = [0, 10_000, 100_000]
+LOTE_INSERCION = 50_000
+CATEGORIA = "Prova de càrrega"
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def poblar(url: str, datasets: int):
+    """Crea el esquema del backend e inserta `datasets` filas de catálogo simuladas."""
+    os.environ.setdefault("DATABASE_URL", url)
+    sys.path.insert(0, BACKEND_DIR)
+    import main  # noqa: E402  (registra los modelos en SQLModel.metadata)
+
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conexion:
+        for desde in range(1, datasets + 1, LOTE_INSERCION):
+            conexion.execute(insert(main.Dataset), [
+                {
+                    "id": i, "title": f"Dataset {i}", "description": "simulat", "format": "CSV",
+                    "lastUpdate": "2024-01-01", "category": "Trànsit", "coverage": "Catalunya",
+                    "link": f"/datasets/{i}/file",
+                }
+                for i in range(desde, min(datasets + 1, desde + LOTE_INSERCION))
+            ])
+    return main, engine
+
+
+async def subir(client: httpx.AsyncClient, subidas: int, concurrencia: int) -> dict:
+    r = await client.post("/login", json={"username": "admin", "password": "admin"})
+    r.raise_for_status()
+    cabeceras = {"Authorization": f"Bearer {r.json()['access_token']}"}
+    pendientes = iter(range(subidas))
+    latencias, ids, codigos = [], [], Counter()
+
+    async def trabajador():
+        for i in pendientes:
+            contenido = f"id,valor\n{i},{time.time_ns()}\n".encode()
+            inicio = time.perf_counter()
+            r = await client.post(
+                "/datasets/upload",
+                headers=cabeceras,
+                files={"file": (f"subida_{i}.csv", contenido, "text/csv")},
+                data={"format": "CSV", "title": f"Subida {i}", "description": "prova", "category": CATEGORIA,
+                      "coverage": "Catalunya", "lastUpdate": "2024-01-01"},
+            )
+            codigos[r.status_code] += 1
+            if r.status_code == 201:
+                latencias.append((time.perf_counter() - inicio) * 1000)
+                ids.append(r.json()["id"])
+
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    return {"latencias": latencias, "ids": ids, "codigos": codigos}
+
+
+async def con_backend(url: str, tmp: str, args) -> dict:
+    env = dict(
+        os.environ,
+        DATABASE_URL=url,
+        DATASET_STORE_DIR=os.path.join(tmp, "store"),
+        SCT_FEED_URL="http://127.0.0.1:9/incidenciesGML.xml",
+        FUENTES_ACTIVAS="",
+        SCT_HISTORIAL_ENABLED="0",
+    )
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PUERTO_BACKEND),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrencia + 10)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PUERTO_BACKEND}", limits=limits, timeout=60) as client:
+            for _ in range(600):
+                try:
+                    await client.get("/datasets/1")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            return await subir(client, args.subidas, args.concurrencia)
+    finally:
+        backend.terminate()
+        backend.wait()
+
+
+def medir_tamano(datasets: int, args) -> dict:
+    tmp = tempfile.mkdtemp()
+    url = f"sqlite:///{tmp}/datasets.db"
+    main, engine = poblar(url, datasets)
+    resultado = asyncio.run(con_backend(url, tmp, args))
+
+    with engine.connect() as conexion:
+        # Las filas subidas (el backend puede haber sembrado el catálogo por defecto al arrancar)
+        subidos = conexion.execute(
+            select(func.count()).select_from(main.Dataset).where(main.Dataset.category == CATEGORIA)
+        ).scalar()
+        enlaces = dict(conexion.execute(
+            select(main.Dataset.id, main.Dataset.link).where(main.Dataset.id.in_(resultado["ids"]))
+        ).all()) if resultado["ids"] else {}
+        con_fichero = conexion.execute(
+            select(func.count()).select_from(main.DatasetArchivo)
+            .where(main.DatasetArchivo.dataset_id.in_(resultado["ids"]))
+        ).scalar() if resultado["ids"] else 0
+    ids = resultado["ids"]
+    errores = []
+    if resultado["codigos"] != Counter({201: args.subidas}):
+        errores.append(f"respuestas {dict(resultado['codigos'])}")
+    if len(set(ids)) != len(ids):
+        errores.append(f"{len(ids) - len(set(ids))} ids repetidos")
+    if subidos != len(ids):
+        errores.append(f"{subidos} datasets nuevos en el catálogo con {len(ids)} subidas")
+    if con_fichero != len(set(ids)):
+        errores.append(f"{len(set(ids)) - con_fichero} datasets sin fichero")
+    if any(enlace != f"/datasets/{i}/file" for i, enlace in enlaces.items()):
+        errores.append("links que no corresponden a su id")
+    resultado["errores"] = errores
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", type=int, nargs="+", default=DATASETS, help="tamaños del catálogo inicial")
+    parser.add_argument("--subidas", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2, help="workers de uvicorn")
+    args = parser.parse_args()
+
+    print(f"{args.subidas} subidas, {args.concurrencia} concurrentes, {args.workers} workers")
+    print(f"{'datasets':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}  resultado")
+    fallos = 0
+    for datasets in args.datasets:
+        r = medir_tamano(datasets, args)
+        fallos += bool(r["errores"])
+        print(f"{datasets:>10} {percentil(r['latencias'], 50) if r['latencias'] else float('nan'):>9.1f} "
+              f"{percentil(r['latencias'], 99) if r['latencias'] else float('nan'):>9.1f}  "
+              f"{'; '.join(r['errores']) or 'ok'}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga: latencia de /refresh según el tamaño de la tabla RefreshToken.
+
+Para cada tamaño crea una base de datos con ese número de sesiones
+simuladas (la mayoría rotadas o caducadas, como tras meses de uso),
+arranca el backend con uvicorn sin la compactación periódica y mide una
+cadena de /refresh (cada uno rota el token del anterior). Después ejecuta
+la compactación (compactacion.Compactador, la misma que usa el backend) y
+vuelve a medir. Con el índice único en jti la latencia no debe depender
+del número de filas; la compactación devuelve la tabla a su tamaño útil.
+
+Uso (desde Backend/):
+    python benchmarks/load_refresh_tokens.py
+    python benchmarks/load_refresh_tokens.py --filas 100000 1000000 3000000 --peticiones 500
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import create_engine, insert
+from sqlmodel import SQLModel
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PUERTO_BACKEND = 18003
+FILAS = [10_000, 100_000, 1_000_000]
+# Proporción de filas simuladas que siguen siendo válidas (el resto, rotadas o caducadas)
+VIGENTES = 0.02
+LOTE_INSERCION = 50_000
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def poblar(url: str, filas: int):
+    """Crea el esquema del backend e inserta `filas` refresh tokens simulados."""
+    os.environ["DATABASE_URL"] = url
+    sys.path.insert(0, BACKEND_DIR)
+    import main  # noqa: E402  (registra los modelos en SQLModel.metadata)
+
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    ahora = datetime.now(timezone.utc)
+    vigentes = int(filas * VIGENTES)
+    inicio = time.perf_counter()
+    with engine.begin() as conexion:
+        for desde in range(0, filas, LOTE_INSERCION):
+            lote = []
+            for i in range(desde, min(filas, desde + LOTE_INSERCION)):
+                vigente = i < vigentes
+                lote.append({
+                    "jti": uuid.uuid4().hex,
+                    "user_id": 1 + i % 1000,
+                    "expires_at": ahora + timedelta(days=7) if vigente else ahora - timedelta(days=1 + i % 90),
+                    "revoked": not vigente and i % 3 != 0,
+                })
+            conexion.execute(insert(main.RefreshToken), lote)
+    print(f"  {filas} filas insertadas en {time.perf_counter() - inicio:.1f}s")
+    return main, engine
+
+
+async def medir_refresh(client: httpx.AsyncClient, peticiones: int):
+    r = await client.post("/login", json={"username": "admin", "password": "admin"})
+    r.raise_for_status()
+    token = r.json()["refresh_token"]
+    latencias = []
+    for _ in range(peticiones):
+        inicio = time.perf_counter()
+        r = await client.post("/refresh", json={"refresh_token": token})
+        r.raise_for_status()
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        token = r.json()["refresh_token"]
+    return latencias
+
+
+async def con_backend(url: str, tmp: str, peticiones: int):
+    env = dict(
+        os.environ,
+        DATABASE_URL=url,
+        DATASET_STORE_DIR=os.path.join(tmp, "store"),
+        TOKEN_COMPACTION_SECONDS="0",
+        SCT_FEED_URL="http://127.0.0.1:9/incidenciesGML.xml",
+        FUENTES_ACTIVAS="",
+        SCT_HISTORIAL_ENABLED="0",
+    )
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PUERTO_BACKEND), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PUERTO_BACKEND}", timeout=60) as client:
+            for _ in range(600):
+                try:
+                    await client.get("/datasets")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            return await medir_refresh(client, peticiones)
+    finally:
+        backend.terminate()
+        backend.wait()
+
+
+def medir_tamano(filas: int, peticiones: int) -> dict:
+    tmp = tempfile.mkdtemp()
+    url = f"sqlite:///{tmp}/tokens.db"
+    main, engine = poblar(url, filas)
+    antes = asyncio.run(con_backend(url, tmp, peticiones))
+
+    compactador = main.compactacion.Compactador(engine, [
+        ("refresh_tokens", main.RefreshToken, main.RefreshToken.id,
+         lambda ahora: main.or_(main.RefreshToken.revoked == True, main.RefreshToken.expires_at < ahora)),  # noqa: E712
+    ], intervalo=0)
+    inicio = time.perf_counter()
+    borradas = compactador.compactar()["refresh_tokens"]
+    duracion = time.perf_counter() - inicio
+    despues = asyncio.run(con_backend(url, tmp, peticiones))
+    return {
+        "antes": antes, "despues": despues, "borradas": borradas, "duracion": duracion,
+        "quedan": compactador.stats["refresh_tokens_rows"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, nargs="+", default=FILAS)
+    parser.add_argument("--peticiones", type=int, default=200)
+    args = parser.parse_args()
+
+    resultados = []
+    for filas in args.filas:
+        print(f"{filas} sesiones simuladas")
+        resultados.append((filas, medir_tamano(filas, args.peticiones)))
+
+    print(f"{'filas':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'compactación':>13} {'borradas':>10} "
+          f"{'quedan':>8} {'p50 después':>12} {'p99 después':>12}")
+    for filas, r in resultados:
+        print(f"{filas:>10} {percentil(r['antes'], 50):>9.2f} {percentil(r['antes'], 99):>9.2f} "
+              f"{r['duracion']:>12.1f}s {r['borradas']:>10} {r['quedan']:>8} "
+              f"{percentil(r['despues'], 50):>12.2f} {percentil(r['despues'], 99):>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
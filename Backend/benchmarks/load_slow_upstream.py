@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga: latencia de /datasets mientras los servicios externos no responden.
+
+Levanta un servidor local que tarda UPSTREAM_DELAY segundos en contestar
+cualquier petición (hace de gencat.cat y del endpoint de inferencia), arranca
+el backend con uvicorn apuntando a él y mide la latencia de /datasets:
+  1. sin carga,
+  2. con decenas de peticiones colgadas en /chatbot/ask y en los endpoints
+     que dependen del feed.
+
+Uso (desde Backend/):
+    python benchmarks/load_slow_upstream.py
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+UPSTREAM_DELAY = float(os.getenv("UPSTREAM_DELAY", "20"))
+PUERTO_UPSTREAM = 18765
+PUERTO_BACKEND = 18000
+
+
+class UpstreamLento(BaseHTTPRequestHandler):
+    def _colgar(self):
+        time.sleep(UPSTREAM_DELAY)
+        try:
+            self.send_response(504)
+            self.end_headers()
+        except OSError:
+            pass
+
+    do_GET = _colgar
+    do_POST = _colgar
+
+    def log_message(self, *args):
+        pass
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+async def medir_datasets(client: httpx.AsyncClient, n: int = 200, concurrencia: int = 10):
+    latencias = []
+
+    async def trabajador():
+        for _ in range(n // concurrencia):
+            inicio = time.perf_counter()
+            r = await client.get("/datasets")
+            r.raise_for_status()
+            latencias.append((time.perf_counter() - inicio) * 1000)
+
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    return latencias
+
+
+async def carga_colgada(client: httpx.AsyncClient, n: int):
+    """Peticiones que dependen del upstream lento (no se esperan a que terminen)."""
+    tareas = []
+    for i in range(n):
+        if i % 2:
+            tareas.append(client.post("/chatbot/ask", json={"context": "x", "question": "y"}, timeout=120))
+        else:
+            tareas.append(client.get("/grafana/incidents/total", timeout=120))
+    return [asyncio.ensure_future(t) for t in tareas]
+
+
+async def main():
+    servidor = ThreadingHTTPServer(("127.0.0.1", PUERTO_UPSTREAM), UpstreamLento)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    tmp = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+        SCT_FEED_URL=f"http://127.0.0.1:{PUERTO_UPSTREAM}/incidenciesGML.xml",
+        HF_ENDPOINT=f"http://127.0.0.1:{PUERTO_UPSTREAM}/models/gpt2",
+        UPSTREAM_TIMEOUT_SECONDS="60",
+    )
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PUERTO_BACKEND), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    try:
+        limits = httpx.Limits(max_connections=500)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PUERTO_BACKEND}", limits=limits, timeout=30) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/datasets")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+            base = await medir_datasets(client)
+            colgadas = await carga_colgada(client, 100)
+            await asyncio.sleep(1)
+            con_carga = await medir_datasets(client)
+
+            print(f"upstream colgado {UPSTREAM_DELAY:.0f}s, {len(colgadas)} peticiones esperándolo")
+            print(f"{'escenario':<22} {'p50 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+            for nombre, lat in (("/datasets sin carga", base), ("/datasets con carga", con_carga)):
+                print(f"{nombre:<22} {percentil(lat, 50):>10.1f} {percentil(lat, 99):>10.1f} {max(lat):>10.1f}")
+            for t in colgadas:
+                t.cancel()
+    finally:
+        backend.terminate()
+        backend.wait()
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
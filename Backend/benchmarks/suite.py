@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Suite de benchmarks reproducible: parseo del feed y latencia de los endpoints.
+
+1. Genera feeds incidenciesGML.xml sintéticos (generar_gml, mismo esquema
+   cite:mct2_v_afectacions_data) de 100, 10.000 y 1.000.000 de features
+   y los sirve desde un servidor HTTP local que hace de gencat.cat.
+2. Parseo: mide el rendimiento de extraer_coordenadas_con_detalles (descarga
+   del servidor local + parseo), extraer_incidencias y xml_to_txt para cada
+   tamaño. Cada medida se hace en un proceso nuevo para que el pico de
+   memoria (ru_maxrss) sea el de esa función.
+3. HTTP: arranca el backend con uvicorn apuntando al feed local y lanza
+   carga concurrente contra cada ruta GET /grafana/* y /api/* (más el POST
+   /grafana/query con un dashboard típico): p50, p99, RPS y errores.
+4. Guarda todo en un JSON (con el commit y la máquina). Con --comparar se
+   compara con un resultado anterior y se marcan las regresiones.
+
+Uso (desde Backend/):
+    python benchmarks/suite.py
+    python benchmarks/suite.py --tamanos 100 10000 --duracion 3 --salida /tmp/antes.json
+    python benchmarks/suite.py --comparar /tmp/antes.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.generar_gml import generar_gml  # noqa: E402
+
+TAMANOS = [100, 10_000, 1_000_000]
+PUERTO_FEED = 18766
+PUERTO_BACKEND = 18001
+FUNCIONES_PARSEO = ("extraer_coordenadas_con_detalles", "extraer_incidencias", "xml_to_txt")
+
+# Rutas que no se cargan: flujo SSE (no termina) y las que dependen de otra petición
+RUTAS_EXCLUIDAS = {"/api/incidencies/stream"}
+# Parámetros representativos para las rutas que los admiten
+PARAMETROS = {
+    "/api/incidents-map/query": {"bbox": "1.9,41.2,2.4,41.6", "zoom": 11},
+    "/api/incidencies/raw": {"limit": 100},
+    "/api/historial/incidencies": {"limit": 100},
+}
+# Consulta agrupada equivalente al dashboard AMB – General
+CONSULTA_GRAFANA = {
+    "targets": [
+        {"refId": "total", "metric": "count"},
+        {"refId": "pct_greus", "metric": "percent", "filter": {"severe": True}},
+        {"refId": "carreteres", "metric": "distinct", "field": "carretera"},
+        {"refId": "per_dia", "dimension": "weekday"},
+        {"refId": "per_area", "dimension": "region"},
+        {"refId": "top_carreteres", "dimension": "carretera", "top": 5},
+        {"refId": "per_tipus", "dimension": "tipo"},
+    ],
+}
+
+
+# --- Servidor local del feed ---
+
+class _FeedLocal(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def servir_directorio(directorio: str, puerto: int) -> ThreadingHTTPServer:
+    """Sirve los ficheros de `directorio` por HTTP (con Last-Modified / 304) en segundo plano."""
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), partial(_FeedLocal, directory=directorio))
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def fixture(directorio: str, n: int) -> str:
+    """Ruta del feed sintético de n features (se genera la primera vez; siempre con la misma semilla)."""
+    path = os.path.join(directorio, f"incidencies_{n}.xml")
+    if not os.path.exists(path):
+        generar_gml(n, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return path
+
+
+# --- Parseo ---
+
+def _medir_parseo(funcion: str, path: str, url: str) -> dict:
+    """Se ejecuta en un proceso nuevo: importa la función, la ejecuta una vez y mide tiempo y memoria."""
+    os.chdir(BACKEND_DIR)
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    if funcion == "extraer_coordenadas_con_detalles":
+        from datasets import extraer_coordenadas_con_detalles as fn
+        argumento = url
+    else:
+        if funcion == "extraer_incidencias":
+            from analizar_dataset_1 import extraer_incidencias as fn
+        else:
+            from main import xml_to_txt as fn
+        with open(path, encoding="utf-8") as f:
+            argumento = f.read()
+
+    rss_inicial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    inicio = time.perf_counter()
+    resultado = fn(argumento)
+    segundos = time.perf_counter() - inicio
+    rss_final = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "segundos": round(segundos, 4),
+        "pico_mb": round(max(rss_final - rss_inicial, 0) / 1024, 1),
+        "salida": len(resultado) if not isinstance(resultado, dict) else len(resultado.get("incidencies", [])),
+    }
+
+
+def _en_proceso_nuevo(fn, *args):
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def bench_parseo(directorio: str, tamanos, funciones) -> list:
+    resultados = []
+    print(f"{'función':<34} {'features':>10} {'tiempo (s)':>10} {'feat/s':>10} {'MB/s':>8} {'pico (MB)':>10}")
+    for n in tamanos:
+        path = fixture(directorio, n)
+        tamano = os.path.getsize(path)
+        url = f"http://127.0.0.1:{PUERTO_FEED}/{os.path.basename(path)}"
+        for funcion in funciones:
+            try:
+                r = _en_proceso_nuevo(_medir_parseo, funcion, path, url)
+            except Exception as exc:
+                print(f"{funcion:<34} {n:>10} error: {exc}")
+                resultados.append({"funcion": funcion, "features": n, "bytes": tamano, "error": str(exc)})
+                continue
+            r.update({
+                "funcion": funcion,
+                "features": n,
+                "bytes": tamano,
+                "features_por_s": round(n / r["segundos"]) if r["segundos"] else None,
+                "mb_por_s": round(tamano / 1e6 / r["segundos"], 2) if r["segundos"] else None,
+            })
+            resultados.append(r)
+            print(f"{funcion:<34} {n:>10} {r['segundos']:>10.3f} {r['features_por_s']:>10} "
+                  f"{r['mb_por_s']:>8} {r['pico_mb']:>10}")
+    return resultados
+
+
+# --- HTTP ---
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+async def _cargar_ruta(client: httpx.AsyncClient, metodo: str, ruta: str, concurrencia: int, duracion: float) -> dict:
+    latencias, errores = [], 0
+    fin = time.perf_counter() + duracion
+
+    async def trabajador():
+        nonlocal errores
+        while time.perf_counter() < fin:
+            inicio = time.perf_counter()
+            try:
+                if metodo == "POST":
+                    r = await client.post(ruta, json=CONSULTA_GRAFANA)
+                else:
+                    r = await client.get(ruta, params=PARAMETROS.get(ruta))
+                if r.status_code >= 400:
+                    errores += 1
+            except httpx.HTTPError:
+                errores += 1
+            latencias.append((time.perf_counter() - inicio) * 1000)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    total = time.perf_counter() - inicio
+    return {
+        "metodo": metodo,
+        "ruta": ruta,
+        "peticiones": len(latencias),
+        "errores": errores,
+        "rps": round(len(latencias) / total, 1),
+        "p50_ms": round(percentil(latencias, 50), 2) if latencias else None,
+        "p99_ms": round(percentil(latencias, 99), 2) if latencias else None,
+    }
+
+
+def _rutas(openapi: dict, filtro=None) -> list:
+    rutas = []
+    for ruta, metodos in sorted(openapi["paths"].items()):
+        if not (ruta.startswith("/grafana/") or ruta.startswith("/api/")) or ruta in RUTAS_EXCLUIDAS or "{" in ruta:
+            continue
+        if filtro and filtro not in ruta:
+            continue
+        if "get" in metodos:
+            rutas.append(("GET", ruta))
+        elif ruta == "/grafana/query":
+            rutas.append(("POST", ruta))
+    return rutas
+
+
+async def _bench_http(url_backend: str, concurrencia: int, duracion: float, filtro) -> list:
+    limits = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url_backend, limits=limits, timeout=60) as client:
+        # Espera a que el backend arranque y el poller haya publicado el primer snapshot
+        for _ in range(600):
+            try:
+                estado = (await client.get("/api/incidencies/feed-status")).json()
+                if estado["poller"]["updates"] >= 1:
+                    break
+            except (httpx.HTTPError, KeyError, ValueError):
+                pass
+            await asyncio.sleep(0.2)
+        else:
+            raise RuntimeError("El backend no ha cargado el feed")
+
+        rutas = _rutas((await client.get("/openapi.json")).json(), filtro)
+        resultados = []
+        print(f"{'ruta':<48} {'RPS':>8} {'p50 (ms)':>10} {'p99 (ms)':>10} {'errores':>8}")
+        for metodo, ruta in rutas:
+            await _cargar_ruta(client, metodo, ruta, concurrencia, min(0.5, duracion))  # calentamiento
+            r = await _cargar_ruta(client, metodo, ruta, concurrencia, duracion)
+            resultados.append(r)
+            print(f"{metodo + ' ' + ruta:<48} {r['rps']:>8} {r['p50_ms']:>10} {r['p99_ms']:>10} {r['errores']:>8}")
+        return resultados
+
+
+def bench_http(directorio: str, tamano_feed: int, concurrencia: int, duracion: float, filtro=None) -> list:
+    path = fixture(directorio, tamano_feed)
+    tmp = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+        SCT_FEED_URL=f"http://127.0.0.1:{PUERTO_FEED}/{os.path.basename(path)}",
+        SCT_FEED_POLL_SECONDS="3600",
+        SCT_FEED_TTL_SECONDS="3600",
+    )
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PUERTO_BACKEND), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    try:
+        return asyncio.run(_bench_http(f"http://127.0.0.1:{PUERTO_BACKEND}", concurrencia, duracion, filtro))
+    finally:
+        backend.terminate()
+        backend.wait()
+
+
+# --- Resultados ---
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def comparar(anterior: dict, actual: dict, umbral: float) -> list:
+    """Regresiones de `actual` respecto a `anterior` (más lento que umbral, p. ej. 0.2 = 20 %)."""
+    regresiones = []
+    previos = {(r["funcion"], r["features"]): r for r in anterior.get("parseo", []) if "segundos" in r}
+    for r in actual.get("parseo", []):
+        previo = previos.get((r.get("funcion"), r.get("features")))
+        if previo and "segundos" in r and r["segundos"] > previo["segundos"] * (1 + umbral):
+            regresiones.append(f"{r['funcion']} ({r['features']}): {previo['segundos']}s -> {r['segundos']}s")
+    previos = {(r["metodo"], r["ruta"]): r for r in anterior.get("http", [])}
+    for r in actual.get("http", []):
+        previo = previos.get((r["metodo"], r["ruta"]))
+        if not previo or previo["p99_ms"] is None or r["p99_ms"] is None:
+            continue
+        if r["p99_ms"] > previo["p99_ms"] * (1 + umbral):
+            regresiones.append(f"{r['metodo']} {r['ruta']} p99: {previo['p99_ms']}ms -> {r['p99_ms']}ms")
+        if r["rps"] < previo["rps"] * (1 - umbral):
+            regresiones.append(f"{r['metodo']} {r['ruta']} RPS: {previo['rps']} -> {r['rps']}")
+    return regresiones
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks de parseo y de endpoints del backend")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=TAMANOS, help="features de los feeds sintéticos")
+    parser.add_argument("--funciones", nargs="+", default=list(FUNCIONES_PARSEO), choices=FUNCIONES_PARSEO)
+    parser.add_argument("--feed-http", type=int, default=10_000, help="features del feed que carga el backend")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--duracion", type=float, default=5.0, help="segundos de carga por ruta")
+    parser.add_argument("--rutas", default=None, help="sólo las rutas que contengan este texto")
+    parser.add_argument("--sin-parseo", action="store_true")
+    parser.add_argument("--sin-http", action="store_true")
+    parser.add_argument("--fixtures", default=None, help="directorio donde guardar/reutilizar los feeds generados")
+    parser.add_argument("--salida", default=None, help="fichero JSON de resultados")
+    parser.add_argument("--comparar", default=None, help="JSON de una ejecución anterior")
+    parser.add_argument("--umbral", type=float, default=0.2, help="empeoramiento relativo que cuenta como regresión")
+    args = parser.parse_args()
+
+    directorio = args.fixtures or tempfile.mkdtemp(prefix="pae-bench-")
+    os.makedirs(directorio, exist_ok=True)
+    servidor = servir_directorio(directorio, PUERTO_FEED)
+    resultado = {
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "maquina": {"sistema": platform.platform(), "cpus": os.cpu_count()},
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("salida", "comparar")},
+    }
+    try:
+        if not args.sin_parseo:
+            resultado["parseo"] = bench_parseo(directorio, args.tamanos, args.funciones)
+        if not args.sin_http:
+            resultado["http"] = bench_http(directorio, args.feed_http, args.concurrencia, args.duracion, args.rutas)
+    finally:
+        servidor.shutdown()
+
+    salida = args.salida or os.path.join(
+        BACKEND_DIR, "benchmarks", "resultados",
+        f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{resultado['commit']}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            regresiones = comparar(json.load(f), resultado, args.umbral)
+        if regresiones:
+            print(f"\n{len(regresiones)} regresiones (> {args.umbral:.0%}):")
+            for r in regresiones:
+                print(f"  {r}")
+            return 1
+        print(f"\nSin regresiones respecto a {args.comparar}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Bloqueos exclusivos entre procesos sobre un fichero (workers de uvicorn).
+
+flock en Linux/macOS y msvcrt.locking en Windows (entornos de desarrollo);
+fcntl sólo existe en POSIX, así que se importa al usarlo. El fichero de
+bloqueo no se borra nunca: borrarlo mientras otro proceso espera en él
+dejaría a ese proceso bloqueando un fichero que ya nadie ve.
+"""
+import contextlib
+import os
+import time
+from typing import Iterator
+
+
+def bloquear(fichero, esperar: bool = True) -> bool:
+    """Bloquea `fichero` (abierto). False si está bloqueado por otro y no se espera."""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        while True:
+            fichero.seek(0)
+            try:
+                msvcrt.locking(fichero.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not esperar:
+                    return False
+                time.sleep(0.1)
+    try:
+        fcntl.flock(fichero, fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def desbloquear(fichero) -> None:
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        fichero.seek(0)
+        msvcrt.locking(fichero.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(fichero, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def bloqueo(ruta: str) -> Iterator[None]:
+    """Bloqueo exclusivo sobre el fichero `ruta` (se crea si no existe); espera a que se libere."""
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+    with open(ruta, "a+") as fichero:
+        bloquear(fichero)
+        try:
+            yield
+        finally:
+            desbloquear(fichero)
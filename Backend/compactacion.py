@@ -0,0 +1,107 @@
+"""
+Compactación periódica de tablas que sólo crecen (refresh tokens, sesiones revocadas).
+
+Cada /login y /refresh inserta un RefreshToken y los rotados o caducados
+sólo se marcan; sin borrarlos, la tabla (y sus índices) crece sin límite.
+El Compactador es una tarea asyncio que cada `intervalo` segundos borra,
+en el threadpool, las filas que ya no sirven para nada. Borra por lotes
+(DELETE ... WHERE id IN (SELECT id ... LIMIT lote)) con un commit por
+lote, así que no bloquea la tabla mucho rato aunque haya millones de filas
+pendientes, y al final cuenta las filas que quedan para /metrics.
+
+Con varios workers sólo compacta el que `debe_compactar()` indica (el
+líder): N procesos lanzando los mismos DELETE a la vez sólo se
+disputarían el bloqueo de escritura.
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+# (nombre, modelo, columna de la clave, función ahora -> condición de las filas a borrar)
+Regla = Tuple[str, type, object, Callable[[datetime], object]]
+
+
+class Compactador:
+    def __init__(
+        self,
+        engine,
+        reglas: List[Regla],
+        intervalo: float = 3600.0,
+        lote: int = 5000,
+        debe_compactar: Optional[Callable[[], bool]] = None,
+    ):
+        """
+        Args:
+            engine: engine de SQLAlchemy
+            reglas: tablas a compactar y condición de borrado de cada una
+            intervalo: segundos entre compactaciones (0 = sin tarea periódica)
+            lote: filas borradas por sentencia (y por commit)
+            debe_compactar: si este proceso compacta en cada vuelta de la tarea
+                periódica (bloqueante, se llama en el threadpool); None = siempre
+        """
+        self.engine = engine
+        self.reglas = reglas
+        self.intervalo = intervalo
+        self.lote = lote
+        self.debe_compactar = debe_compactar
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, float] = {"runs": 0, "skipped": 0, "errors": 0, "last_run_seconds": 0.0}
+        for nombre, *_ in reglas:
+            self.stats[f"{nombre}_rows"] = 0
+            self.stats[f"{nombre}_deleted"] = 0
+
+    def compactar(self) -> Dict[str, int]:
+        """Borra lo que sobra de cada tabla (bloqueante). Devuelve las filas borradas por tabla."""
+        inicio = time.perf_counter()
+        borradas = {}
+        ahora = datetime.now(timezone.utc)
+        for nombre, modelo, clave, condicion in self.reglas:
+            total = 0
+            while True:
+                with Session(self.engine) as session:
+                    ids = select(clave).where(condicion(ahora)).limit(self.lote)
+                    resultado = session.execute(delete(modelo).where(clave.in_(ids)))
+                    session.commit()
+                total += resultado.rowcount
+                if resultado.rowcount < self.lote:
+                    break
+            borradas[nombre] = total
+            self.stats[f"{nombre}_deleted"] += total
+            with Session(self.engine) as session:
+                self.stats[f"{nombre}_rows"] = session.exec(select(func.count()).select_from(modelo)).one()
+        self.stats["runs"] += 1
+        self.stats["last_run_seconds"] = round(time.perf_counter() - inicio, 4)
+        return borradas
+
+    def start(self) -> None:
+        """Arranca la tarea periódica (la primera compactación es inmediata). Desde el event loop."""
+        if self.intervalo > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _bucle(self) -> None:
+        while True:
+            try:
+                if self.debe_compactar is None or await run_in_threadpool(self.debe_compactar):
+                    await run_in_threadpool(self.compactar)
+                else:
+                    self.stats["skipped"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.stats["errors"] += 1
+                print(f"Error compactando tablas: {exc}")
+            await asyncio.sleep(self.intervalo)
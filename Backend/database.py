@@ -0,0 +1,251 @@
+"""
+Engine de base de datos y coordinación entre workers de uvicorn.
+
+  - crear_engine: SQLite (un nodo) en modo WAL con busy_timeout, para que
+    varios procesos lean mientras otro escribe y las escrituras concurrentes
+    esperen en lugar de fallar con "database is locked"; PostgreSQL (u otro
+    servidor) con pool configurable (tamaño, overflow, pre-ping, reciclado).
+  - ejecutar_una_vez: con --workers N cada proceso ejecuta los eventos de
+    startup. La migración y la siembra se hacen bajo un bloqueo entre
+    procesos (pg_advisory_lock en PostgreSQL, flock/msvcrt sobre un fichero
+    junto a la base de datos en SQLite) y se apunta su huella en la tabla
+    'inicializacion': el primer worker la ejecuta y los demás, al conseguir
+    el bloqueo, ven que ya está hecha y siguen.
+  - Liderazgo: un único worker se encarga de las tareas que no deben
+    repetirse por proceso (p. ej. ingestar el histórico). Es un bloqueo no
+    bloqueante que se mantiene mientras vive el proceso (en PostgreSQL se
+    comprueba en cada consulta que la conexión lo sigue teniendo); si el
+    líder muere o pierde el bloqueo, otro worker lo toma en su siguiente
+    intento.
+"""
+import contextlib
+import hashlib
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, create_engine, event, select, text
+from sqlalchemy.engine import Connection, Engine, make_url
+
+import bloqueo_ficheros
+
+_estado = Table(
+    "inicializacion", MetaData(),
+    Column("nombre", String, primary_key=True),
+    Column("huella", String, nullable=False),
+    Column("ejecutado_at", DateTime(timezone=True), nullable=False),
+)
+
+
+def crear_engine(
+    url: str,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30.0,
+    pool_recycle: int = 1800,
+    pre_ping: bool = True,
+    sqlite_busy_timeout: float = 5.0,
+    sqlite_wal: bool = True,
+) -> Engine:
+    """
+    Args:
+        pool_size, max_overflow, pool_timeout: conexiones fijas, extra y espera máxima por una conexión
+        pool_recycle: segundos tras los que se renueva una conexión (antes de que la cierre el servidor)
+        pre_ping: comprobar la conexión al sacarla del pool (reconecta tras reinicios de la base de datos)
+        sqlite_busy_timeout: segundos que SQLite espera a que se libere el bloqueo de escritura
+        sqlite_wal: journal WAL en SQLite (lectores y un escritor a la vez, entre procesos)
+    """
+    url_parseada = make_url(url)
+    if url_parseada.get_backend_name() != "sqlite":
+        return create_engine(
+            url, echo=False, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle, pool_pre_ping=pre_ping,
+        )
+
+    en_memoria = url_parseada.database in (None, "", ":memory:")
+    opciones = {} if en_memoria else {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout}
+    engine = create_engine(
+        url, echo=False, connect_args={"check_same_thread": False, "timeout": sqlite_busy_timeout}, **opciones
+    )
+
+    @event.listens_for(engine, "connect")
+    def _pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(sqlite_busy_timeout * 1000)}")
+        if sqlite_wal and not en_memoria:
+            cursor.execute("PRAGMA journal_mode = WAL")
+            # En WAL, NORMAL sólo arriesga la última transacción ante un corte de luz (no corrompe)
+            cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+    return engine
+
+
+def estado_pool(engine: Engine) -> dict:
+    """Conexiones del pool (para /metrics)."""
+    pool = engine.pool
+    estado = {}
+    for nombre in ("size", "checkedin", "checkedout", "overflow"):
+        medir = getattr(pool, nombre, None)
+        if callable(medir):
+            estado[nombre] = medir()
+    return estado
+
+
+def sincronizar_secuencia(conexion, tabla: str, columna: str = "id") -> None:
+    """
+    PostgreSQL: tras insertar ids explícitos (siembra, POST con id), la secuencia
+    del autoincremento sigue donde estaba y el siguiente INSERT sin id chocaría.
+    La avanza hasta el máximo de la columna. En SQLite no hace falta (usa max(rowid)+1).
+    """
+    if conexion.get_bind().dialect.name != "postgresql":
+        return
+    conexion.execute(text(
+        f"SELECT setval(pg_get_serial_sequence(:tabla, :columna), "
+        f"COALESCE(MAX({columna}), 1), MAX({columna}) IS NOT NULL) FROM {tabla}"
+    ), {"tabla": tabla, "columna": columna})
+
+
+def _ruta_bloqueo(engine: Engine, nombre: str) -> Optional[str]:
+    base = engine.url.database
+    if not base or base == ":memory:":
+        return None
+    return f"{os.path.abspath(base)}.{nombre}.lock"
+
+
+def _clave_pg(nombre: str) -> int:
+    return zlib.crc32(f"pae:{nombre}".encode("utf-8"))
+
+
+@contextlib.contextmanager
+def bloqueo(engine: Engine, nombre: str) -> Iterator[None]:
+    """Bloqueo exclusivo entre procesos (espera a que se libere)."""
+    dialecto = engine.dialect.name
+    if dialecto == "postgresql":
+        with engine.connect() as conexion:
+            conexion.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _clave_pg(nombre)})
+            try:
+                yield
+            finally:
+                conexion.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _clave_pg(nombre)})
+                conexion.commit()
+        return
+    ruta = _ruta_bloqueo(engine, nombre) if dialecto == "sqlite" else None
+    if ruta is None:
+        # Base de datos en memoria (un solo proceso) u otro motor sin bloqueo conocido
+        yield
+        return
+    with bloqueo_ficheros.bloqueo(ruta):
+        yield
+
+
+def huella(*partes) -> str:
+    return hashlib.sha256("\n".join(map(str, partes)).encode("utf-8")).hexdigest()
+
+
+def huella_esquema(metadata: MetaData, *extra) -> str:
+    """Huella de las tablas, columnas e índices (cambia si el modelo cambia) y de los datos de siembra."""
+    partes = []
+    for tabla in metadata.sorted_tables:
+        partes.append(tabla.name)
+        partes.extend(f"{c.name}:{c.type}:{c.nullable}:{c.primary_key}" for c in tabla.columns)
+        partes.extend(sorted(f"{i.name}:{i.unique}" for i in tabla.indexes))
+    return huella(*partes, *extra)
+
+
+def ejecutar_una_vez(engine: Engine, nombre: str, huella_actual: str, funcion: Callable[[], None]) -> bool:
+    """
+    Ejecuta `funcion` si no se ha ejecutado ya con esta huella (en cualquier proceso).
+
+    Returns:
+        True si se ha ejecutado en este proceso
+    """
+    with bloqueo(engine, nombre):
+        _estado.create(bind=engine, checkfirst=True)
+        with engine.connect() as conexion:
+            guardada = conexion.execute(select(_estado.c.huella).where(_estado.c.nombre == nombre)).scalar()
+        if guardada == huella_actual:
+            return False
+        funcion()
+        with engine.begin() as conexion:
+            conexion.execute(_estado.delete().where(_estado.c.nombre == nombre))
+            conexion.execute(_estado.insert().values(
+                nombre=nombre, huella=huella_actual, ejecutado_at=datetime.now(timezone.utc)
+            ))
+        return True
+
+
+class Liderazgo:
+    def __init__(self, engine: Engine, nombre: str):
+        self.engine = engine
+        self.nombre = nombre
+        self._recurso = None
+        self._lock = threading.Lock()
+
+    def es_lider(self) -> bool:
+        """True si este proceso es (o acaba de pasar a ser) el líder. Bloqueante: fuera del event loop."""
+        with self._lock:
+            if self._recurso is not None and not self._vigente(self._recurso):
+                # Bloqueo perdido (reinicio del servidor, conexión caída): se suelta y se vuelve a competir
+                self._soltar(self._recurso)
+                self._recurso = None
+            if self._recurso is None:
+                self._recurso = self._intentar()
+            return self._recurso is not None
+
+    def _vigente(self, recurso) -> bool:
+        if not isinstance(recurso, Connection):
+            # flock: lo mantiene el sistema operativo mientras el fichero siga abierto
+            return True
+        try:
+            fila = recurso.execute(text(
+                "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND granted "
+                "AND pid = pg_backend_pid() AND classid = 0 AND objid::bigint = :k AND objsubid = 1"
+            ), {"k": _clave_pg(self.nombre)}).first()
+            recurso.commit()
+            return fila is not None
+        except Exception:
+            return False
+
+    @staticmethod
+    def _soltar(recurso) -> None:
+        if isinstance(recurso, Connection):
+            try:
+                # La conexión puede estar rota: no se devuelve al pool
+                recurso.invalidate()
+            except Exception:
+                pass
+        if recurso is not True:
+            try:
+                recurso.close()
+            except Exception:
+                pass
+
+    def _intentar(self):
+        dialecto = self.engine.dialect.name
+        if dialecto == "postgresql":
+            # Bloqueo de sesión: dura lo que la conexión, que se reserva para ello y
+            # se comprueba en cada es_lider()
+            conexion = self.engine.connect()
+            if conexion.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": _clave_pg(self.nombre)}).scalar():
+                conexion.commit()
+                return conexion
+            conexion.close()
+            return None
+        ruta = _ruta_bloqueo(self.engine, self.nombre) if dialecto == "sqlite" else None
+        if ruta is None:
+            return True
+        fichero = open(ruta, "a+")
+        if not bloqueo_ficheros.bloquear(fichero, esperar=False):
+            fichero.close()
+            return None
+        return fichero
+
+    def liberar(self) -> None:
+        with self._lock:
+            recurso, self._recurso = self._recurso, None
+        if recurso is not None:
+            # Cerrar el fichero suelta el flock; cerrar la conexión, el advisory lock
+            self._soltar(recurso)
@@ -0,0 +1,246 @@
+"""
+Almacén en disco de los ficheros de datasets subidos, direccionado por contenido.
+
+Cada fichero se guarda una sola vez en <directorio>/<sha[:2]>/<sha256>:
+la subida se copia por trozos a un temporal del mismo directorio mientras
+se calcula el hash y se valida el formato de forma incremental (guardar)
+y después se renombra (atómico) a su ruta definitiva (confirmar). Si ya
+existía un fichero con el mismo hash se descarta el temporal (deduplicación).
+
+Un mismo contenido puede estar referenciado por varios datasets, así que
+confirmar una subida (hasta el commit de su referencia en la base de
+datos) y borrar un contenido que ya nadie usa se hacen bajo un bloqueo
+entre procesos por hash: un borrado concurrente no puede llevarse el
+fichero que una subida acaba de deduplicar, y si el fichero ya no está
+al confirmar se vuelve a crear desde el temporal.
+
+Validadores incrementales (memoria acotada sea cual sea el tamaño):
+  - JSON: parser en streaming (ijson, backend C yajl2 si está disponible)
+  - CSV: UTF-8 válido en todo el fichero y dialecto detectado con
+    csv.Sniffer sobre los primeros KB
+  - XML: XMLPullParser de lxml, liberando los elementos ya cerrados
+"""
+import codecs
+import contextlib
+import csv
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, Callable, Iterator, NamedTuple, Optional
+
+import ijson
+from lxml import etree
+
+import bloqueo_ficheros
+
+TAMANO_TROZO = 1024 * 1024
+# Bytes del principio del CSV sobre los que se detecta el dialecto
+CSV_MUESTRA_BYTES = 64 * 1024
+
+
+class ContenidoInvalido(ValueError):
+    """El fichero no es del formato declarado."""
+
+
+class ArchivoDemasiadoGrande(ValueError):
+    """El fichero supera el tamaño máximo admitido."""
+
+
+class ValidadorJSON:
+    def __init__(self):
+        self._eventos = ijson.utils.sendable_list()
+        self._parser = ijson.basic_parse_coro(self._eventos)
+
+    def alimentar(self, datos: bytes) -> None:
+        try:
+            self._parser.send(datos)
+        except ijson.JSONError as e:
+            raise ContenidoInvalido(str(e))
+        # Los eventos no se usan: se descartan para no acumularlos
+        del self._eventos[:]
+
+    def cerrar(self) -> None:
+        try:
+            self._parser.close()
+        except ijson.JSONError as e:
+            raise ContenidoInvalido(str(e))
+
+
+class ValidadorCSV:
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._muestra = []
+        self._tamano_muestra = 0
+        self.dialecto: Optional[str] = None
+
+    def alimentar(self, datos: bytes) -> None:
+        try:
+            texto = self._decoder.decode(datos)
+        except UnicodeDecodeError as e:
+            raise ContenidoInvalido(f"El CSV no es UTF-8: {e}")
+        if self._tamano_muestra < CSV_MUESTRA_BYTES:
+            self._muestra.append(texto)
+            self._tamano_muestra += len(datos)
+            if self._tamano_muestra >= CSV_MUESTRA_BYTES:
+                self._detectar()
+
+    def _detectar(self) -> None:
+        muestra = "".join(self._muestra)[:CSV_MUESTRA_BYTES]
+        self._muestra = []
+        # Sólo líneas completas (la última puede estar cortada por la muestra)
+        if len(muestra) >= CSV_MUESTRA_BYTES and "\n" in muestra:
+            muestra = muestra[:muestra.rindex("\n") + 1]
+        if not muestra.strip():
+            raise ContenidoInvalido("El CSV está vacío")
+        try:
+            self.dialecto = csv.Sniffer().sniff(muestra).delimiter
+        except csv.Error:
+            # Una sola columna: no hay delimitador que detectar (se toma el de por defecto)
+            if "\x00" in muestra:
+                raise ContenidoInvalido("El CSV contiene bytes nulos")
+            self.dialecto = ","
+
+    def cerrar(self) -> None:
+        try:
+            self._decoder.decode(b"", final=True)
+        except UnicodeDecodeError as e:
+            raise ContenidoInvalido(f"El CSV no es UTF-8: {e}")
+        if self.dialecto is None:
+            self._detectar()
+
+
+class ValidadorXML:
+    def __init__(self):
+        self._parser = etree.XMLPullParser(events=("end",), resolve_entities=False, no_network=True)
+
+    def _liberar(self) -> None:
+        for _, elemento in self._parser.read_events():
+            elemento.clear()
+            padre = elemento.getparent()
+            if padre is not None:
+                while len(padre) and padre[0] is not elemento:
+                    del padre[0]
+
+    def alimentar(self, datos: bytes) -> None:
+        try:
+            self._parser.feed(datos)
+        except etree.XMLSyntaxError as e:
+            raise ContenidoInvalido(str(e))
+        self._liberar()
+
+    def cerrar(self) -> None:
+        try:
+            self._parser.close()
+        except etree.XMLSyntaxError as e:
+            raise ContenidoInvalido(str(e))
+        self._liberar()
+
+
+VALIDADORES = {"JSON": ValidadorJSON, "CSV": ValidadorCSV, "XML": ValidadorXML}
+
+
+class Subida(NamedTuple):
+    """Fichero ya validado en un temporal del almacén, pendiente de confirmar."""
+    sha256: str
+    tamano: int
+    temporal: str
+
+
+class AlmacenDatasets:
+    def __init__(self, directorio: str, tamano_maximo: Optional[int] = None):
+        """
+        Args:
+            directorio: raíz del almacén (se crea si no existe)
+            tamano_maximo: bytes máximos por fichero (None = sin límite)
+        """
+        self.directorio = directorio
+        self.tamano_maximo = tamano_maximo
+        os.makedirs(directorio, exist_ok=True)
+
+    def ruta(self, sha256: str) -> str:
+        return os.path.join(self.directorio, sha256[:2], sha256)
+
+    def existe(self, sha256: str) -> bool:
+        return os.path.exists(self.ruta(sha256))
+
+    def _bloqueo(self, sha256: str):
+        # Un fichero de bloqueo por prefijo (256 como mucho), no uno por contenido
+        return bloqueo_ficheros.bloqueo(os.path.join(self.directorio, ".bloqueos", sha256[:2]))
+
+    def guardar(self, origen: BinaryIO, formato: str) -> Subida:
+        """
+        Copia `origen` a un temporal del almacén validándolo como `formato` (JSON, CSV o XML).
+        Hay que confirmar() o descartar() la subida.
+
+        Raises:
+            ContenidoInvalido, ArchivoDemasiadoGrande: no se guarda nada
+        """
+        validador = VALIDADORES[formato]()
+        hasher = hashlib.sha256()
+        tamano = 0
+        descriptor, temporal = tempfile.mkstemp(prefix=".subida-", dir=self.directorio)
+        try:
+            with os.fdopen(descriptor, "wb") as destino:
+                while True:
+                    datos = origen.read(TAMANO_TROZO)
+                    if not datos:
+                        break
+                    tamano += len(datos)
+                    if self.tamano_maximo is not None and tamano > self.tamano_maximo:
+                        raise ArchivoDemasiadoGrande(f"El fichero supera {self.tamano_maximo} bytes")
+                    hasher.update(datos)
+                    validador.alimentar(datos)
+                    destino.write(datos)
+                validador.cerrar()
+            if tamano == 0:
+                raise ContenidoInvalido("El fichero está vacío")
+
+            return Subida(hasher.hexdigest(), tamano, temporal)
+        except BaseException:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+
+    @contextlib.contextmanager
+    def confirmar(self, subida: Subida) -> Iterator[bool]:
+        """
+        Lleva la subida a su ruta definitiva (si el contenido no estaba) y mantiene el
+        bloqueo de su hash durante el with: la referencia al contenido (commit en la base
+        de datos) se guarda dentro. Devuelve si el contenido es nuevo.
+        """
+        try:
+            with self._bloqueo(subida.sha256):
+                ruta = self.ruta(subida.sha256)
+                nuevo = not os.path.exists(ruta)
+                if nuevo:
+                    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                    os.replace(subida.temporal, ruta)
+                yield nuevo
+        finally:
+            self.descartar(subida)
+
+    def descartar(self, subida: Subida) -> None:
+        """Borra el temporal de una subida no confirmada (o ya deduplicada)."""
+        try:
+            os.remove(subida.temporal)
+        except FileNotFoundError:
+            pass
+
+    def eliminar(self, sha256: str) -> None:
+        """Borra el contenido. Llamar con el bloqueo de su hash (eliminar_si_sin_uso)."""
+        try:
+            os.remove(self.ruta(sha256))
+        except FileNotFoundError:
+            pass
+
+    def eliminar_si_sin_uso(self, sha256: str, en_uso: Callable[[], bool]) -> bool:
+        """
+        Borra el contenido si `en_uso()` (consulta a la base de datos, ya confirmada)
+        dice que nadie lo referencia. Bajo el bloqueo del hash: ninguna subida puede
+        estar confirmando una referencia nueva entretanto.
+        """
+        with self._bloqueo(sha256):
+            if en_uso():
+                return False
+            self.eliminar(sha256)
+            return True
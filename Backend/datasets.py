@@ -1,65 +1,185 @@
+import time
+from urllib.parse import urlsplit
+
 import requests
 from lxml import etree
-from typing import List, Dict
+from io import BytesIO
+from dataclasses import dataclass
+from typing import List, Dict, Iterator, Optional, Union, BinaryIO
+
+import metrics
+
+
+SCT_INCIDENCIES_URL = "https://www.gencat.cat/transit/opendata/incidenciesGML.xml"
+
+NAMESPACES = {
+    'gml': 'http://www.opengis.net/gml',
+    'cite': 'http://www.opengeospatial.net/cite',
+    'wfs': 'http://www.opengis.net/wfs'
+}
+
+_FEATURE_TAG = f"{{{NAMESPACES['gml']}}}featureMember"
+_AFECTACION_TAG = f"{{{NAMESPACES['cite']}}}mct2_v_afectacions_data"
+_COORDS_TAG = f"{{{NAMESPACES['gml']}}}coordinates"
+
+# Campos de cite:mct2_v_afectacions_data que se guardan en cada incidencia
+CAMPOS_AFECTACION = (
+    'identificador', 'tipus', 'subtipus', 'carretera', 'pk_inici', 'pk_fi', 'causa',
+    'data', 'nivell', 'sentit', 'descripcio', 'descripcio_tipus', 'font', 'cap_a',
+)
+_CAMPO_POR_TAG = {f"{{{NAMESPACES['cite']}}}{campo}": campo for campo in CAMPOS_AFECTACION}
+
+
+@dataclass(slots=True)
+class Incidencia:
+    """
+    Una incidencia del feed tal como viene en el XML.
+
+    Los campos de la afectación se guardan como texto sin tocar (None si no
+    existen); lat/lon son None si la feature no trae coordenadas válidas.
+    """
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    tiene_afectacion: bool = False
+    identificador: Optional[str] = None
+    tipus: Optional[str] = None
+    subtipus: Optional[str] = None
+    carretera: Optional[str] = None
+    pk_inici: Optional[str] = None
+    pk_fi: Optional[str] = None
+    causa: Optional[str] = None
+    data: Optional[str] = None
+    nivell: Optional[str] = None
+    sentit: Optional[str] = None
+    descripcio: Optional[str] = None
+    descripcio_tipus: Optional[str] = None
+    font: Optional[str] = None
+    cap_a: Optional[str] = None
 
 
-def extraer_coordenadas_xml(url: str = "https://www.gencat.cat/transit/opendata/incidenciesGML.xml") -> List[Dict]:
+def iterar_incidencias(source: Union[bytes, BinaryIO]) -> Iterator[Incidencia]:
+    """
+    Parser en streaming de incidenciesGML.xml.
+
+    Recorre el documento con iterparse y emite una Incidencia por cada
+    gml:featureMember en cuanto se cierra, liberando después el elemento. La
+    memoria no crece con el tamaño del feed y, si source es el stream de la
+    respuesta HTTP, las primeras incidencias salen antes de acabar la descarga.
+
+    Args:
+        source: bytes del XML o un objeto tipo fichero (p. ej. response.raw)
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+
+    for _, feature in etree.iterparse(source, events=('end',), tag=_FEATURE_TAG):
+        incidencia = Incidencia()
+        coords_elem = None
+
+        afectacion = next(feature.iter(_AFECTACION_TAG), None)
+        if afectacion is not None:
+            incidencia.tiene_afectacion = True
+            for elem in afectacion:
+                campo = _CAMPO_POR_TAG.get(elem.tag)
+                if campo is not None:
+                    setattr(incidencia, campo, elem.text)
+                elif coords_elem is None and len(elem):
+                    # cite:geom > gml:Point > gml:coordinates
+                    coords_elem = next(elem.iter(_COORDS_TAG), None)
+        if coords_elem is None:
+            coords_elem = next(feature.iter(_COORDS_TAG), None)
+
+        # Formato: "lon,lat" (ej: "2.55206464,41.86143144")
+        if coords_elem is not None and coords_elem.text:
+            parts = coords_elem.text.strip().split(',')
+            if len(parts) >= 2:
+                try:
+                    lon = float(parts[0])
+                    lat = float(parts[1])
+                    incidencia.lon = lon
+                    incidencia.lat = lat
+                except ValueError:
+                    pass
+
+        # Liberar la feature procesada y las anteriores que cuelgan de la raíz
+        feature.clear(keep_tail=False)
+        while feature.getprevious() is not None:
+            del feature.getparent()[0]
+
+        yield incidencia
+
+
+# Claves de los diccionarios de incidencia_a_detalle (para proyecciones con fields=)
+CAMPOS_DETALLE = (
+    'identificador', 'lat', 'lon', 'carretera', 'pk_inici', 'pk_fi', 'descripcion',
+    'tipo', 'causa', 'nivel', 'sentit', 'cap_a', 'data', 'subtipus',
+)
+
+
+def incidencia_a_detalle(incidencia: Incidencia) -> Dict:
+    """Vista de una Incidencia con las claves que usan los endpoints (lat/lon, tipo, nivel...)."""
+    return {
+        'identificador': incidencia.identificador,
+        'lat': incidencia.lat,
+        'lon': incidencia.lon,
+        'carretera': incidencia.carretera,
+        'pk_inici': incidencia.pk_inici,
+        'pk_fi': incidencia.pk_fi,
+        'descripcion': incidencia.descripcio,
+        'tipo': incidencia.descripcio_tipus,
+        'causa': incidencia.causa,
+        'nivel': incidencia.nivell,
+        'sentit': incidencia.sentit,
+        'cap_a': incidencia.cap_a,
+        'data': incidencia.data,
+        'subtipus': incidencia.subtipus
+    }
+
+
+def _stream_feed(url: str):
+    """Abre la descarga en streaming (el cuerpo se lee a medida que se parsea)."""
+    host = urlsplit(url).hostname
+    inicio = time.perf_counter()
+    try:
+        response = requests.get(url, timeout=10, stream=True)
+    except requests.exceptions.RequestException:
+        metrics.observar_upstream(host, None, time.perf_counter() - inicio)
+        raise
+    # Hasta las cabeceras: el cuerpo aún no se ha leído (se usa Content-Length si viene)
+    longitud = response.headers.get("Content-Length")
+    metrics.observar_upstream(
+        host, response.status_code, time.perf_counter() - inicio, int(longitud) if longitud and longitud.isdigit() else None,
+    )
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return response
+
+
+def extraer_coordenadas_xml(url: str = SCT_INCIDENCIES_URL) -> List[Dict]:
     """
     Extrae las coordenadas del archivo XML de incidencias viarias de la Generalitat.
-    
+
     Args:
         url: URL del XML de incidencias (por defecto usa el de incidenciesGML.xml)
-    
+
     Returns:
         Lista de diccionarios con información de coordenadas e incidencias
     """
     try:
-        # Descargar el XML
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        # Parsear el XML
-        root = etree.fromstring(response.content)
-        
-        # Definir namespaces
-        namespaces = {
-            'gml': 'http://www.opengis.net/gml',
-            'cite': 'http://www.opengeospatial.net/cite',
-            'wfs': 'http://www.opengis.net/wfs'
-        }
-        
-        coordenadas_list = []
-        
-        # Buscar todos los featureMember
-        for feature in root.xpath('.//gml:featureMember', namespaces=namespaces):
-            # Buscar gml:coordinates dentro de cada feature
-            coords_elem = feature.find('.//gml:coordinates', namespaces)
-            
-            if coords_elem is not None and coords_elem.text:
-                # Formato: "lon,lat" (ej: "2.55206464,41.86143144")
-                coord_text = coords_elem.text.strip()
-                parts = coord_text.split(',')
-                
-                if len(parts) >= 2:
-                    try:
-                        lon = float(parts[0])
-                        lat = float(parts[1])
-                        
-                        coordenadas_list.append({
-                            'lat': lat,
-                            'lon': lon,
-                            'tipo': 'point'
-                        })
-                    except ValueError:
-                        continue
-        
+        with _stream_feed(url) as response:
+            coordenadas_list = [
+                {'lat': inc.lat, 'lon': inc.lon, 'tipo': 'point'}
+                for inc in iterar_incidencias(response.raw)
+                if inc.lat is not None
+            ]
+
         # Print de las coordenadas extraídas
         print(f"\n📍 Coordenadas extraídas ({len(coordenadas_list)} total):")
         for i, coord in enumerate(coordenadas_list, 1):
             print(f"  {i}. lat: {coord['lat']}, lon: {coord['lon']}")
-        
+
         return coordenadas_list
-    
+
     except requests.exceptions.RequestException as e:
         print(f"Error al descargar el XML: {e}")
         return []
@@ -71,107 +191,48 @@ def extraer_coordenadas_xml(url: str = "https://www.gencat.cat/transit/opendata/
         return []
 
 
-def extraer_coordenadas_con_detalles(url: str = "https://www.gencat.cat/transit/opendata/incidenciesGML.xml") -> List[Dict]:
+def extraer_coordenadas_con_detalles(url: str = SCT_INCIDENCIES_URL) -> List[Dict]:
     """
     Extrae coordenadas junto con información adicional de las incidencias.
-    
+
     Args:
         url: URL del XML de incidencias
-    
+
     Returns:
         Lista de diccionarios con coordenadas y detalles de la incidencia
     """
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        root = etree.fromstring(response.content)
-        
-        namespaces = {
-            'gml': 'http://www.opengis.net/gml',
-            'cite': 'http://www.opengeospatial.net/cite',
-            'wfs': 'http://www.opengis.net/wfs'
-        }
-        
-        incidencias = []
-        
-        # Buscar todos los featureMember
-        for feature in root.xpath('.//gml:featureMember', namespaces=namespaces):
-            # Extraer coordenadas
-            coords_elem = feature.find('.//gml:coordinates', namespaces)
-            
-            if coords_elem is not None and coords_elem.text:
-                coord_text = coords_elem.text.strip()
-                parts = coord_text.split(',')
-                
-                if len(parts) >= 2:
-                    try:
-                        lon = float(parts[0])
-                        lat = float(parts[1])
-                        
-                        # Extraer información adicional
-                        afectacion = feature.find('.//cite:mct2_v_afectacions_data', namespaces)
-                        
-                        incidencia = {
-                            'lat': lat,
-                            'lon': lon,
-                            'carretera': None,
-                            'pk_inici': None,
-                            'pk_fi': None,
-                            'descripcion': None,
-                            'tipo': None,
-                            'causa': None,
-                            'nivel': None,
-                            'sentit': None,
-                            'cap_a': None,
-                            'data': None,
-                            'subtipus': None
-                        }
-                        
-                        if afectacion is not None:
-                            for elem in afectacion:
-                                tag = elem.tag.split('}')[-1]
-                                
-                                if tag == 'carretera':
-                                    incidencia['carretera'] = elem.text
-                                elif tag == 'pk_inici':
-                                    incidencia['pk_inici'] = elem.text
-                                elif tag == 'pk_fi':
-                                    incidencia['pk_fi'] = elem.text
-                                elif tag == 'descripcio':
-                                    incidencia['descripcion'] = elem.text
-                                elif tag == 'descripcio_tipus':
-                                    incidencia['tipo'] = elem.text
-                                elif tag == 'causa':
-                                    incidencia['causa'] = elem.text
-                                elif tag == 'nivell':
-                                    incidencia['nivel'] = elem.text
-                                elif tag == 'sentit':
-                                    incidencia['sentit'] = elem.text
-                                elif tag == 'cap_a':
-                                    incidencia['cap_a'] = elem.text
-                                elif tag == 'data':
-                                    incidencia['data'] = elem.text
-                                elif tag == 'subtipus':
-                                    incidencia['subtipus'] = elem.text
-                        
-                        incidencias.append(incidencia)
-                    except ValueError:
-                        continue
-        
-        return incidencias
-    
+        return obtener_incidencias_detalladas(url)
     except Exception as e:
         print(f"Error al extraer coordenadas con detalles: {e}")
         return []
 
 
+def obtener_incidencias_detalladas(url: str = SCT_INCIDENCIES_URL) -> List[Dict]:
+    """
+    Igual que extraer_coordenadas_con_detalles pero propaga los errores de red/XML
+    (lo usa la caché de snapshots para no guardar una lista vacía si falla la descarga).
+    """
+    with _stream_feed(url) as response:
+        return parsear_incidencias_detalladas(response.raw)
+
+
+@metrics.medir("parse_feed")
+def parsear_incidencias_detalladas(content: Union[bytes, BinaryIO]) -> List[Dict]:
+    """Parsea incidenciesGML.xml a la lista de incidencias detalladas (sólo las que tienen coordenadas)."""
+    return [
+        incidencia_a_detalle(inc)
+        for inc in iterar_incidencias(content)
+        if inc.lat is not None
+    ]
+
+
 # Ejecutar cuando se llama directamente el script
 if __name__ == "__main__":
     print("Extrayendo coordenadas del XML...\n")
     coordenadas = extraer_coordenadas_xml()
-    
+
     if coordenadas:
         print(f"\n✅ Extracción completada exitosamente!")
     else:
-        print(f"\n❌ No se encontraron coordenadas o hubo un error.")
\ No newline at end of file
+        print(f"\n❌ No se encontraron coordenadas o hubo un error.")
@@ -0,0 +1,338 @@
+"""
+Poller en segundo plano del feed de incidencias con GET condicional.
+
+Guarda el último ETag / Last-Modified y el hash del contenido: si el
+servidor responde 304 no se descarga ni se parsea nada, y si devuelve
+exactamente los mismos bytes se descarta lo parseado y no se construye un
+valor nuevo (se reutiliza el anterior).
+
+El poller es una tarea asyncio que usa el cliente HTTP compartido
+(http_client). El cuerpo se lee en streaming: cada trozo actualiza el hash
+y se pasa a un objeto tipo fichero del que el parser (iterparse, en el
+threadpool) va leyendo mientras sigue la descarga, así que no se guarda el
+documento entero en memoria y el parseo acaba casi a la vez que la
+descarga. Ese hilo del threadpool queda ocupado mientras dura la descarga
+(como mucho, el timeout). El paso caro que depende del resultado
+(construir, p. ej. el snapshot con sus índices) sólo se ejecuta si el
+contenido ha cambiado.
+
+Cada descarga tiene un plazo total (timeout) y, opcionalmente, reintentos
+con backoff exponencial ante errores transitorios (red, timeout, 429/5xx).
+"""
+import asyncio
+import hashlib
+import inspect
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Callable, List, NamedTuple, Optional
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+import http_client
+
+
+class DescargaInterrumpida(Exception):
+    """La descarga se ha cortado (error, timeout, cancelación) antes de que el parser leyera el final."""
+
+
+class _Flujo:
+    """
+    Objeto tipo fichero entre la descarga (event loop, escribe) y el parser
+    (un hilo, lee con read() y se bloquea hasta que llega el siguiente trozo).
+    """
+
+    _FIN = object()
+
+    def __init__(self):
+        self._trozos = queue.SimpleQueue()
+        self._pendiente = b""
+        self._fin = False
+        self._error: Optional[BaseException] = None
+
+    def escribir(self, trozo: bytes) -> None:
+        self._trozos.put(trozo)
+
+    def cerrar(self, error: Optional[BaseException] = None) -> None:
+        self._trozos.put(self._FIN if error is None else error)
+
+    def _siguiente(self) -> None:
+        trozo = self._trozos.get()
+        if trozo is self._FIN:
+            self._fin = True
+        elif isinstance(trozo, BaseException):
+            self._fin = True
+            self._error = trozo
+        else:
+            self._pendiente = trozo
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            partes = [self._pendiente]
+            self._pendiente = b""
+            while not self._fin:
+                self._siguiente()
+                partes.append(self._pendiente)
+                self._pendiente = b""
+            if self._error is not None:
+                raise self._error
+            return b"".join(partes)
+        while not self._pendiente and not self._fin:
+            self._siguiente()
+        if not self._pendiente and self._error is not None:
+            raise self._error
+        datos, self._pendiente = self._pendiente[:n], self._pendiente[n:]
+        return datos
+
+
+class _Descarga(NamedTuple):
+    response: httpx.Response
+    # Sólo en respuestas 2xx: hash y tamaño del cuerpo y el parseo (en curso)
+    content_hash: Optional[str] = None
+    tamano: int = 0
+    parseo: Optional[asyncio.Future] = None
+
+
+def _recoger(parseo: asyncio.Future) -> None:
+    # Parseo de una descarga abandonada: se recoge la excepción para que no salga en el log
+    if not parseo.cancelled():
+        parseo.exception()
+
+
+class FeedPoller:
+    def __init__(
+        self,
+        url: str,
+        parser: Callable[[BinaryIO], Any],
+        interval: float = 30.0,
+        timeout: float = 10.0,
+        retries: int = 0,
+        backoff: float = 1.0,
+        construir: Optional[Callable[[Any], Any]] = None,
+    ):
+        """
+        Args:
+            url: URL del feed
+            parser: función fichero -> valor (p. ej. lista de incidencias); lee el
+                cuerpo con read() a medida que se descarga
+            interval: segundos entre consultas
+            timeout: plazo total de cada intento de descarga
+            retries: reintentos ante errores transitorios en una misma consulta
+            backoff: segundos de espera antes del primer reintento (se dobla en cada uno)
+            construir: función resultado del parser -> valor, sólo si el contenido ha cambiado
+        """
+        self.url = url
+        self.parser = parser
+        self.construir = construir
+        self.interval = interval
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.content_hash: Optional[str] = None
+        self.value: Any = None
+        self._task: Optional[asyncio.Task] = None
+        self._despertar: Optional[asyncio.Event] = None
+        # Peticiones esperando a que acabe la consulta en curso o la siguiente (actualizar)
+        self._esperando: List[asyncio.Future] = []
+        self.stats = {
+            "polls": 0,
+            "updates": 0,
+            "not_modified": 0,
+            "unchanged": 0,
+            "errors": 0,
+            "retries": 0,
+            "last_status": None,
+            "last_success": None,
+            "last_change": None,
+            "last_fetch_seconds": None,
+            # Lo que tarda el parseo (y construir) tras recibir el último byte
+            "last_parse_seconds": None,
+            "last_bytes": None,
+            "last_error": None,
+        }
+
+    async def load(self, client: Optional[httpx.AsyncClient] = None) -> Any:
+        """Consulta el feed una vez y devuelve el valor actual (lanza excepción si falla)."""
+        headers = {}
+        if self.value is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+        self.stats["polls"] += 1
+        inicio = time.perf_counter()
+        try:
+            descarga = await self._descargar(client, headers)
+            response = descarga.response
+            self.stats["last_fetch_seconds"] = round(time.perf_counter() - inicio, 4)
+            self.stats["last_status"] = response.status_code
+
+            if response.status_code == 304 and self.value is not None:
+                self.stats["not_modified"] += 1
+                self._marcar_exito()
+                return self.value
+
+            response.raise_for_status()
+            self.stats["last_bytes"] = descarga.tamano
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+
+            inicio = time.perf_counter()
+            if descarga.content_hash == self.content_hash and self.value is not None:
+                # Mismos bytes: lo parseado se descarta sin construir nada
+                descarga.parseo.add_done_callback(_recoger)
+                self.stats["unchanged"] += 1
+                self._marcar_exito()
+                return self.value
+
+            value = await descarga.parseo
+            if self.construir is not None:
+                value = await run_in_threadpool(self.construir, value)
+            self.stats["last_parse_seconds"] = round(time.perf_counter() - inicio, 4)
+        except Exception as exc:
+            self.stats["errors"] += 1
+            self.stats["last_error"] = str(exc)
+            raise
+
+        self.value = value
+        self.content_hash = descarga.content_hash
+        self.stats["updates"] += 1
+        self.stats["last_change"] = datetime.now(timezone.utc).isoformat()
+        self._marcar_exito()
+        return value
+
+    async def _descargar(self, client: Optional[httpx.AsyncClient], headers: dict) -> _Descarga:
+        intento = 0
+        while True:
+            try:
+                # Plazo total: un servidor que envía muy despacio no retiene la consulta indefinidamente
+                descarga = await asyncio.wait_for(self._leer(client, headers), self.timeout)
+                status = descarga.response.status_code
+                if status != 429 and status < 500:
+                    return descarga
+                if intento >= self.retries:
+                    return descarga
+            except httpx.TransportError:
+                if intento >= self.retries:
+                    raise
+            except asyncio.TimeoutError:
+                if intento >= self.retries:
+                    raise TimeoutError(f"Sin respuesta de {self.url} en {self.timeout} s") from None
+            intento += 1
+            self.stats["retries"] += 1
+            # Backoff exponencial con jitter para no sincronizar reintentos entre fuentes
+            await asyncio.sleep(self.backoff * (2 ** (intento - 1)) * random.uniform(0.5, 1.5))
+
+    async def _leer(self, client: Optional[httpx.AsyncClient], headers: dict) -> _Descarga:
+        """Un intento: lee el cuerpo de una respuesta 2xx pasándolo al parser y al hash a medida que llega."""
+        if client is not None:
+            peticion = client.stream("GET", self.url, headers=headers, timeout=self.timeout)
+        else:
+            peticion = http_client.stream("GET", self.url, reenviar=False, headers=headers, timeout=self.timeout)
+        async with peticion as response:
+            if not response.is_success:
+                return _Descarga(response)
+            flujo = _Flujo()
+            parseo = asyncio.ensure_future(run_in_threadpool(self.parser, flujo))
+            hasher = hashlib.sha256()
+            tamano = 0
+            try:
+                async for trozo in response.aiter_bytes():
+                    hasher.update(trozo)
+                    tamano += len(trozo)
+                    flujo.escribir(trozo)
+            except BaseException:
+                # El hilo del parser está esperando el siguiente trozo: se le despierta con un error
+                flujo.cerrar(DescargaInterrumpida(f"Descarga de {self.url} interrumpida"))
+                parseo.add_done_callback(_recoger)
+                raise
+            flujo.cerrar()
+            return _Descarga(response, hasher.hexdigest(), tamano, parseo)
+
+    def start(self, publicar: Optional[Callable[[Any], None]] = None) -> None:
+        """
+        Arranca la tarea de consulta periódica. Debe llamarse desde el event loop.
+
+        Args:
+            publicar: función (o corrutina) a la que se pasa el valor tras cada
+                consulta correcta (p. ej. SnapshotCache.set para alimentar la caché).
+        """
+        if self._task is not None and not self._task.done():
+            return
+        self._despertar = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._bucle(publicar))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def actualizar(self, timeout: Optional[float] = None) -> Any:
+        """
+        Pide una consulta inmediata y espera a que termine. Sirve de loader
+        para SnapshotCache: la descarga bajo demanda la sigue haciendo la
+        tarea del poller.
+
+        Si el poller no está arrancado (scripts, shell) consulta directamente.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if self._task is None or self._task.done():
+            return await self.load()
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._esperando.append(futuro)
+        self._despertar.set()
+        try:
+            return await asyncio.wait_for(futuro, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timeout esperando el feed {self.url}") from None
+        finally:
+            if futuro in self._esperando:
+                self._esperando.remove(futuro)
+
+    def status(self) -> dict:
+        return {"url": self.url, "interval": self.interval, "etag": self.etag,
+                "last_modified": self.last_modified, "content_hash": self.content_hash,
+                "running": self._task is not None and not self._task.done(), **self.stats}
+
+    def _marcar_exito(self) -> None:
+        self.stats["last_success"] = datetime.now(timezone.utc).isoformat()
+        self.stats["last_error"] = None
+
+    async def _bucle(self, publicar: Optional[Callable[[Any], None]]) -> None:
+        while True:
+            error = None
+            try:
+                value = await self.load()
+                if publicar is not None:
+                    resultado = publicar(value)
+                    if inspect.isawaitable(resultado):
+                        await resultado
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                error = exc
+                print(f"Error consultando el feed {self.url}: {exc}")
+            esperando, self._esperando = self._esperando, []
+            for futuro in esperando:
+                if futuro.done():
+                    continue
+                if error is not None:
+                    futuro.set_exception(error)
+                else:
+                    futuro.set_result(self.value)
+            # Las peticiones de consulta llegadas durante esta consulta ya quedan servidas
+            self._despertar.clear()
+            try:
+                await asyncio.wait_for(self._despertar.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
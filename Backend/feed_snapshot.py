@@ -0,0 +1,51 @@
+"""
+Snapshot del feed SCT: las incidencias detalladas más las estructuras
+derivadas que se calculan una sola vez por snapshot.
+"""
+from typing import List, Optional
+
+import metrics
+from incident_index import IndiceIncidencias
+from json_cache import RespuestasPrecalculadas
+from incident_table import TablaIncidencias
+from pk_index import IndicePK
+from spatial_index import IndiceEspacial
+
+
+class FeedSnapshot:
+    """
+    Incidencias detalladas de un snapshot del feed, su índice de agregados,
+    su tabla columnar, su índice espacial (construido sobre la tabla si no se pasa)
+    y su índice lineal por carretera/PK.
+    Las respuestas JSON de los endpoints se serializan una vez por snapshot (respuestas).
+    """
+
+    def __init__(
+        self,
+        incidencias: List[dict],
+        indice: IndiceIncidencias,
+        tabla: TablaIncidencias,
+        espacial: Optional[IndiceEspacial] = None,
+    ):
+        self.incidencias = incidencias
+        self.indice = indice
+        self.tabla = tabla
+        if espacial is None:
+            with metrics.etapa("spatial_index"):
+                espacial = IndiceEspacial(tabla.lat, tabla.lon)
+        self.espacial = espacial
+        with metrics.etapa("pk_index"):
+            self.lineal = IndicePK(tabla)
+        self.respuestas = RespuestasPrecalculadas()
+
+
+def construir_snapshot(incidencias: List[dict], anterior: Optional[FeedSnapshot] = None) -> FeedSnapshot:
+    """Crea el snapshot reutilizando el índice del anterior si existe."""
+    with metrics.etapa("aggregate_index"):
+        if anterior is None:
+            indice = IndiceIncidencias(incidencias)
+        else:
+            indice = anterior.indice.actualizar(incidencias)
+    with metrics.etapa("columnar_table"):
+        tabla = TablaIncidencias(incidencias)
+    return FeedSnapshot(incidencias, indice, tabla)
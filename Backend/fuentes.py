@@ -0,0 +1,315 @@
+"""
+Ingesta de varias fuentes de incidencias con adaptadores intercambiables.
+
+Cada fuente del catálogo se describe con un Adaptador:
+  - planificación: cada cuántos segundos se consulta, plazo y reintentos
+  - parser: cuerpo descargado (bytes o fichero) -> registros en bruto (iterable de dicts)
+  - mapeo: registro en bruto -> incidencia en el esquema común (o None para descartarla)
+
+El esquema común es el mismo diccionario que ya usan los endpoints del feed
+SCT (datasets.CAMPOS_DETALLE), con 'data' en el formato del feed
+("Wed, 14 Jan 2026 12:51:30 GMT"), así que TablaIncidencias, el índice y
+las consultas de Grafana funcionan igual con cualquier fuente.
+
+El Planificador crea un FeedPoller por adaptador: cada fuente tiene su propia
+tarea en el event loop (GET condicional, plazo total y reintentos con
+backoff), así que una fuente lenta o caída no retrasa a las demás. El
+resultado de cada consulta se publica en el AlmacenFuentes, que guarda la
+última versión normalizada de cada fuente y su fusión sin duplicados.
+"""
+import asyncio
+import hashlib
+import re
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from lxml import etree
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from datasets import CAMPOS_DETALLE
+from feed_poller import FeedPoller
+from feed_snapshot import FeedSnapshot, construir_snapshot
+from fusion import Fusionador
+from incident_table import Categoria
+
+# Esquema de las incidencias combinadas: el común más la procedencia (fusion.py)
+CAMPOS_FUENTE = CAMPOS_DETALLE + ('fuente', 'fuentes', 'duplicados')
+
+# Zona por defecto para las fuentes de ámbito estatal (Catalunya: sur, oeste, norte, este)
+ZONA_CATALUNYA = (40.5, 0.15, 42.9, 3.35)
+
+
+@dataclass
+class Adaptador:
+    nombre: str
+    url: str
+    parser: Callable[[Union[bytes, BinaryIO]], Iterable[dict]]
+    mapear: Callable[[dict], Optional[dict]]
+    intervalo: float = 60.0
+    timeout: float = 10.0
+    reintentos: int = 2
+    # Dataset del catálogo (DATASETS en main.py) del que sale la fuente
+    dataset_id: Optional[int] = None
+
+    def normalizar(self, content: Union[bytes, BinaryIO]) -> List[dict]:
+        """Parsea y mapea una descarga (bytes o el flujo del FeedPoller) al esquema común."""
+        incidencias = []
+        for registro in self.parser(content):
+            incidencia = self.mapear(registro)
+            if incidencia is None:
+                continue
+            fila = {campo: incidencia.get(campo) for campo in CAMPOS_DETALLE}
+            # Los identificadores sólo son únicos dentro de cada fuente
+            fila['identificador'] = f"{self.nombre}:{fila['identificador'] or _hash_registro(fila)}"
+            incidencias.append(fila)
+        return incidencias
+
+
+def _hash_registro(fila: dict) -> str:
+    base = "|".join(str(fila.get(c)) for c in ('carretera', 'descripcion', 'tipo', 'data'))
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+
+
+def formatear_data(instante: Optional[datetime]) -> Optional[str]:
+    """datetime -> formato del campo 'data' del feed SCT (UTC)."""
+    if instante is None:
+        return None
+    if instante.tzinfo is not None:
+        instante = instante.astimezone(timezone.utc)
+    return instante.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+
+def _nombre_local(elemento) -> str:
+    return etree.QName(elemento).localname if isinstance(elemento.tag, str) else ""
+
+
+def _texto(elemento) -> Optional[str]:
+    if elemento is None or elemento.text is None:
+        return None
+    return elemento.text.strip() or None
+
+
+def _abrir(content: Union[bytes, BinaryIO]) -> BinaryIO:
+    return BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+
+
+def _liberar(elemento) -> None:
+    # Elemento ya procesado: se vacía y se quitan los hermanos anteriores (memoria acotada)
+    elemento.clear()
+    while elemento.getprevious() is not None:
+        del elemento.getparent()[0]
+
+
+# --- RSS (Rodalies) ---
+
+def parsear_rss(content: Union[bytes, BinaryIO]) -> Iterator[dict]:
+    """Cada <item> como dict {etiqueta: texto} (sin namespaces)."""
+    for _, item in etree.iterparse(_abrir(content), events=("end",), tag="item", recover=True, resolve_entities=False):
+        yield {_nombre_local(hijo): _texto(hijo) for hijo in item}
+        _liberar(item)
+
+
+_LINEA_RODALIES = re.compile(r"\b(R\d{1,2}[NS]?|RG1|RT\d|RL\d)\b")
+
+
+def mapear_rodalies(item: dict) -> Optional[dict]:
+    titulo = item.get("title")
+    if not titulo:
+        return None
+    descripcion = item.get("description")
+    linea = _LINEA_RODALIES.search(titulo) or _LINEA_RODALIES.search(descripcion or "")
+    fecha = None
+    if item.get("pubDate"):
+        try:
+            fecha = parsedate_to_datetime(item["pubDate"])
+        except (TypeError, ValueError):
+            fecha = None
+    return {
+        'identificador': item.get("guid") or item.get("link"),
+        'carretera': linea.group(1) if linea else None,
+        'descripcion': f"{titulo}. {descripcion}" if descripcion and descripcion != titulo else titulo,
+        'tipo': "Rodalies",
+        'causa': item.get("category"),
+        'data': formatear_data(fecha),
+    }
+
+
+# --- DATEX II (DGT) ---
+
+_NIVEL_DATEX = {"lowest": "1", "low": "2", "medium": "3", "high": "4", "highest": "5"}
+
+
+def parsear_datex2(content: Union[bytes, BinaryIO]) -> Iterator[dict]:
+    """
+    Cada situationRecord de una publicación DATEX II (v2 o v3) con los campos
+    que se usan, buscados por nombre local para no depender de la versión.
+    """
+    for _, registro in etree.iterparse(_abrir(content), events=("end",), recover=True, resolve_entities=False, huge_tree=True):
+        nombre_registro = _nombre_local(registro)
+        if nombre_registro == "situation":
+            _liberar(registro)
+        if nombre_registro != "situationRecord":
+            continue
+        campos: Dict[str, object] = {"id": registro.get("id")}
+        tipo_xsi = registro.get("{http://www.w3.org/2001/XMLSchema-instance}type")
+        campos["recordType"] = tipo_xsi.split(":")[-1] if tipo_xsi else None
+        pks = []
+        comentarios = []
+        for elemento in registro.iter():
+            nombre = _nombre_local(elemento)
+            if nombre in ("latitude", "longitude", "roadNumber", "roadName", "causeType", "severity",
+                          "overallStartTime", "tpegDirection", "municipality", "province"):
+                campos.setdefault(nombre, _texto(elemento))
+            elif nombre in ("kilometerPoint", "referentPointDistance"):
+                pks.append(_texto(elemento))
+            elif nombre == "value" and _nombre_local(elemento.getparent()) == "values":
+                comentarios.append(_texto(elemento))
+        campos["pks"] = [pk for pk in pks if pk]
+        campos["comment"] = next((c for c in comentarios if c), None)
+        yield campos
+        registro.clear()
+
+
+def mapear_dgt(registro: dict, zona: Optional[Tuple[float, float, float, float]] = ZONA_CATALUNYA) -> Optional[dict]:
+    try:
+        lat = float(registro.get("latitude"))
+        lon = float(registro.get("longitude"))
+    except (TypeError, ValueError):
+        lat = lon = None
+    if zona is not None:
+        sur, oeste, norte, este = zona
+        if lat is None or not (sur <= lat <= norte and oeste <= lon <= este):
+            return None
+    fecha = None
+    if registro.get("overallStartTime"):
+        try:
+            fecha = datetime.fromisoformat(registro["overallStartTime"].replace("Z", "+00:00"))
+        except ValueError:
+            fecha = None
+    pks = registro.get("pks") or []
+    return {
+        'identificador': registro.get("id"),
+        'lat': lat,
+        'lon': lon,
+        'carretera': registro.get("roadNumber") or registro.get("roadName"),
+        'pk_inici': pks[0] if pks else None,
+        'pk_fi': pks[1] if len(pks) > 1 else None,
+        'descripcion': registro.get("comment"),
+        'tipo': registro.get("recordType"),
+        'causa': registro.get("causeType"),
+        'nivel': _NIVEL_DATEX.get((registro.get("severity") or "").lower()),
+        'sentit': registro.get("tpegDirection"),
+        'data': formatear_data(fecha),
+    }
+
+
+def adaptadores_catalogo(urls: Dict[str, str], intervalo: Optional[float] = None,
+                         timeout: Optional[float] = None, reintentos: Optional[int] = None) -> List[Adaptador]:
+    """
+    Adaptadores de las fuentes del catálogo con un feed de incidencias legible
+    por máquina, para las URLs de `urls` (nombre -> URL; las ausentes no se crean).
+    """
+    conocidos = {
+        "rodalies": dict(parser=parsear_rss, mapear=mapear_rodalies, intervalo=60.0, dataset_id=7),
+        "dgt": dict(parser=parsear_datex2, mapear=mapear_dgt, intervalo=120.0, timeout=30.0, dataset_id=8),
+    }
+    adaptadores = []
+    for nombre, url in urls.items():
+        if nombre not in conocidos or not url:
+            continue
+        opciones = dict(conocidos[nombre])
+        if intervalo is not None:
+            opciones["intervalo"] = intervalo
+        if timeout is not None:
+            opciones["timeout"] = timeout
+        if reintentos is not None:
+            opciones["reintentos"] = reintentos
+        adaptadores.append(Adaptador(nombre=nombre, url=url, **opciones))
+    return adaptadores
+
+
+class AlmacenFuentes:
+    """
+    Última versión normalizada de cada fuente y la vista combinada sin
+    duplicados (fusion.Fusionador), que se actualiza de forma incremental.
+    """
+
+    def __init__(self, fusionador: Optional[Fusionador] = None):
+        self._por_fuente: Dict[str, List[dict]] = {}
+        self._actualizado: Dict[str, str] = {}
+        self.fusion = fusionador or Fusionador()
+        self._lock = threading.Lock()
+        self._combinado: Optional[Tuple[int, FeedSnapshot]] = None
+
+    def actualizar(self, nombre: str, incidencias: List[dict]) -> None:
+        """Publica la versión actual de una fuente (bloqueante: fusiona los cambios; llamar desde el threadpool)."""
+        with self._lock:
+            if self._por_fuente.get(nombre) is incidencias:
+                return
+            self._por_fuente[nombre] = incidencias
+            self._actualizado[nombre] = datetime.now(timezone.utc).isoformat()
+            with metrics.etapa("source_merge"):
+                self.fusion.actualizar(nombre, incidencias)
+
+    def fuentes(self) -> Dict[str, dict]:
+        return {
+            nombre: {"incidencies": len(incidencias), "updated": self._actualizado.get(nombre)}
+            for nombre, incidencias in self._por_fuente.items()
+        }
+
+    def combinado(self) -> FeedSnapshot:
+        """
+        Incidencias canónicas de todas las fuentes (con 'fuente', 'fuentes' y
+        'duplicados') con su índice y su tabla; se recalcula sólo si la fusión cambia.
+        """
+        with self._lock:
+            cache = self._combinado
+            if cache is not None and cache[0] == self.fusion.version:
+                return cache[1]
+            incidencias = self.fusion.incidencias()
+            snapshot = construir_snapshot(incidencias, cache[1] if cache is not None else None)
+            snapshot.tabla.categorias['fuente'] = Categoria([incidencia['fuente'] for incidencia in incidencias])
+            self._combinado = (self.fusion.version, snapshot)
+            return snapshot
+
+
+class Planificador:
+    """Un FeedPoller por adaptador, todos en el mismo event loop y publicando en el mismo almacén."""
+
+    def __init__(self, adaptadores: Iterable[Adaptador], almacen: AlmacenFuentes):
+        self.almacen = almacen
+        self.adaptadores = {a.nombre: a for a in adaptadores}
+        self.pollers: Dict[str, FeedPoller] = {
+            nombre: FeedPoller(
+                a.url, a.normalizar, interval=a.intervalo, timeout=a.timeout, retries=a.reintentos,
+            )
+            for nombre, a in self.adaptadores.items()
+        }
+
+    def start(self) -> None:
+        for nombre, poller in self.pollers.items():
+            poller.start(
+                lambda incidencias, nombre=nombre: run_in_threadpool(self.almacen.actualizar, nombre, incidencias)
+            )
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(poller.stop() for poller in self.pollers.values()))
+
+    def status(self) -> Dict[str, dict]:
+        almacenadas = self.almacen.fuentes()
+        estado = {}
+        for nombre, poller in self.pollers.items():
+            adaptador = self.adaptadores[nombre]
+            estado[nombre] = {
+                "dataset_id": adaptador.dataset_id,
+                "timeout": adaptador.timeout,
+                "retries": adaptador.reintentos,
+                **poller.status(),
+                **almacenadas.get(nombre, {"incidencies": 0, "updated": None}),
+            }
+        return estado
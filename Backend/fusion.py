@@ -0,0 +1,270 @@
+"""
+Deduplicación y fusión de incidencias entre fuentes.
+
+La misma incidencia puede llegar por varias fuentes (SCT, DGT...) con
+coordenadas, carretera/PK y hora ligeramente distintas. El Fusionador
+agrupa los candidatos a duplicado y mantiene, para cada grupo, una
+incidencia canónica con su procedencia:
+
+  - dos incidencias de fuentes distintas son la misma si están a menos de
+    RADIO_KM (o, sin coordenadas, en la misma carretera a menos de PK_KM),
+    su hora difiere menos de VENTANA_SEGUNDOS (si ambas la tienen) y, si
+    ambas indican carretera, es la misma. Dentro de una misma fuente no se
+    fusiona nada: cada fuente ya identifica sus incidencias.
+  - la canónica parte del miembro de la fuente con más prioridad y completa
+    los campos vacíos con los demás; el nivel es el máximo del grupo.
+    'fuentes' y 'duplicados' indican de dónde sale.
+
+Es incremental: cada actualización de una fuente sólo procesa las
+incidencias que han cambiado o desaparecido. Los candidatos se buscan en
+una rejilla con celdas del orden del radio (se mantiene con diccionarios
+porque cambia en cada actualización) y en un índice por carretera y tramo
+de PK para las que no tienen coordenadas, así que el coste no es cuadrático.
+"""
+import math
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from incident_index import parse_nivel
+from incident_table import _epoch
+from spatial_index import RADIO_TIERRA_KM
+
+RADIO_KM = 0.5
+PK_KM = 1.0
+VENTANA_SEGUNDOS = 2 * 3600
+# Orden de preferencia para elegir la incidencia canónica (las no listadas van detrás)
+PRIORIDAD = ('sct', 'dgt', 'amb', 'rodalies')
+
+Clave = Tuple[str, str]  # (fuente, identificador)
+
+
+def normalizar_carretera(carretera: Optional[str]) -> Optional[str]:
+    """'AP-7', 'ap 7' y 'AP7' son la misma carretera."""
+    if not carretera:
+        return None
+    return re.sub(r"[\s\-_.]+", "", str(carretera)).upper() or None
+
+
+def _pk(valor) -> Optional[float]:
+    try:
+        return float(str(valor).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+
+
+def _coordenadas(inc: dict) -> Optional[Tuple[float, float]]:
+    try:
+        lat, lon = float(inc.get('lat')), float(inc.get('lon'))
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lon)) or lat == 0 or lon == 0:
+        return None
+    return lat, lon
+
+
+def _distancia_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+class _Miembro:
+    __slots__ = ('clave', 'inc', 'punto', 'carretera', 'pk', 'instante', 'grupo')
+
+    def __init__(self, clave: Clave, inc: dict):
+        self.clave = clave
+        self.inc = inc
+        self.punto = _coordenadas(inc)
+        self.carretera = normalizar_carretera(inc.get('carretera'))
+        self.pk = _pk(inc.get('pk_inici'))
+        instante = _epoch(inc.get('data'))
+        self.instante = None if math.isnan(instante) else instante
+        self.grupo: Optional[int] = None
+
+
+class _Grupo:
+    __slots__ = ('id', 'miembros', 'fuentes', 'canonica')
+
+    def __init__(self, id_: int):
+        self.id = id_
+        self.miembros: Dict[Clave, _Miembro] = {}
+        # Una fuente aporta como mucho un miembro a cada grupo
+        self.fuentes: Set[str] = set()
+        self.canonica: Optional[dict] = None
+
+
+def _prioridad(fuente: str) -> int:
+    return PRIORIDAD.index(fuente) if fuente in PRIORIDAD else len(PRIORIDAD)
+
+
+class Fusionador:
+    def __init__(self, radio_km: float = RADIO_KM, ventana: float = VENTANA_SEGUNDOS, pk_km: float = PK_KM):
+        self.radio_km = radio_km
+        self.ventana = ventana
+        self.pk_km = pk_km
+        # Celda de dos radios en latitud: en longitud sigue cubriendo el radio hasta ~60° de latitud,
+        # así que basta con mirar las 8 celdas vecinas
+        self._celda_grados = 2 * radio_km / (math.pi * RADIO_TIERRA_KM / 180)
+        self._miembros: Dict[Clave, _Miembro] = {}
+        self._grupos: Dict[int, _Grupo] = {}
+        self._siguiente_grupo = 0
+        # Rejilla celda -> grupos con un miembro en ella; (carretera, tramo de PK) -> grupos
+        self._rejilla: Dict[Tuple[int, int], Set[int]] = {}
+        self._por_tramo: Dict[Tuple[str, int, bool], Set[int]] = {}
+        self._celdas_grupo: Dict[int, Set[Tuple[int, int]]] = {}
+        self._tramos_grupo: Dict[int, Set[Tuple[str, int, bool]]] = {}
+        self.version = 0
+        self._cache: Optional[Tuple[int, List[dict]]] = None
+        self.stats = {"updates": 0, "processed": 0, "merged": 0, "groups": 0, "members": 0}
+
+    def __len__(self) -> int:
+        return len(self._grupos)
+
+    # --- Actualización ---
+
+    def actualizar(self, fuente: str, incidencias: Iterable[dict]) -> None:
+        """Sustituye las incidencias de `fuente` por las actuales (sólo procesa las diferencias)."""
+        actuales = {(fuente, str(inc.get('identificador'))): inc for inc in incidencias}
+        anteriores = [clave for clave in self._miembros if clave[0] == fuente]
+        tocados: Set[int] = set()
+
+        for clave in anteriores:
+            nueva = actuales.get(clave)
+            miembro = self._miembros[clave]
+            if nueva is miembro.inc or nueva == miembro.inc:
+                continue
+            tocados.add(self._quitar(miembro))
+        for clave, inc in actuales.items():
+            if clave in self._miembros:
+                continue
+            tocados.add(self._insertar(_Miembro(clave, inc)))
+            self.stats["processed"] += 1
+
+        for id_grupo in tocados:
+            self._recalcular(id_grupo)
+        self.stats["updates"] += 1
+        self.stats["groups"] = len(self._grupos)
+        self.stats["members"] = len(self._miembros)
+        self.stats["merged"] = len(self._miembros) - len(self._grupos)
+        if tocados:
+            self.version += 1
+
+    def _candidatos(self, miembro: _Miembro) -> Set[int]:
+        grupos: Set[int] = set()
+        if miembro.punto is not None:
+            cy, cx = self._celda(miembro.punto)
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    grupos |= self._rejilla.get((cy + dy, cx + dx), set())
+        tramo = self._tramo(miembro)
+        if tramo is not None:
+            carretera, numero, _ = tramo
+            # Entre dos miembros con coordenadas decide la distancia: por carretera/PK
+            # sólo hace falta buscar los que no tienen (o todos, si es éste el que no tiene)
+            con_punto = (False,) if miembro.punto is not None else (False, True)
+            for vecino in (numero - 1, numero, numero + 1):
+                for punto in con_punto:
+                    grupos |= self._por_tramo.get((carretera, vecino, punto), set())
+        return grupos
+
+    def _celda(self, punto: Tuple[float, float]) -> Tuple[int, int]:
+        return math.floor(punto[1] / self._celda_grados), math.floor(punto[0] / self._celda_grados)
+
+    def _tramo(self, miembro: _Miembro) -> Optional[Tuple[str, int, bool]]:
+        # (carretera, tramo de pk_km, si tiene coordenadas)
+        if miembro.carretera is None or miembro.pk is None:
+            return None
+        return miembro.carretera, math.floor(miembro.pk / self.pk_km), miembro.punto is not None
+
+    def _coinciden(self, a: _Miembro, b: _Miembro) -> bool:
+        if a.clave[0] == b.clave[0]:
+            return False
+        if a.instante is not None and b.instante is not None and abs(a.instante - b.instante) > self.ventana:
+            return False
+        if a.carretera and b.carretera and a.carretera != b.carretera:
+            return False
+        if a.punto is not None and b.punto is not None:
+            return _distancia_km(a.punto, b.punto) <= self.radio_km
+        # Sin coordenadas en alguna: misma carretera y PK cercano
+        if a.carretera and a.carretera == b.carretera and a.pk is not None and b.pk is not None:
+            return abs(a.pk - b.pk) <= self.pk_km
+        return False
+
+    def _insertar(self, miembro: _Miembro) -> int:
+        self._miembros[miembro.clave] = miembro
+        for id_grupo in sorted(self._candidatos(miembro)):
+            grupo = self._grupos[id_grupo]
+            if miembro.clave[0] in grupo.fuentes:
+                continue
+            if any(self._coinciden(miembro, otro) for otro in grupo.miembros.values()):
+                break
+        else:
+            grupo = _Grupo(self._siguiente_grupo)
+            self._siguiente_grupo += 1
+            self._grupos[grupo.id] = grupo
+        grupo.miembros[miembro.clave] = miembro
+        grupo.fuentes.add(miembro.clave[0])
+        miembro.grupo = grupo.id
+        self._indexar(grupo.id, miembro)
+        return grupo.id
+
+    def _indexar(self, id_grupo: int, miembro: _Miembro) -> None:
+        if miembro.punto is not None:
+            celda = self._celda(miembro.punto)
+            self._rejilla.setdefault(celda, set()).add(id_grupo)
+            self._celdas_grupo.setdefault(id_grupo, set()).add(celda)
+        tramo = self._tramo(miembro)
+        if tramo is not None:
+            self._por_tramo.setdefault(tramo, set()).add(id_grupo)
+            self._tramos_grupo.setdefault(id_grupo, set()).add(tramo)
+
+    def _quitar(self, miembro: _Miembro) -> int:
+        del self._miembros[miembro.clave]
+        id_grupo = miembro.grupo
+        grupo = self._grupos[id_grupo]
+        del grupo.miembros[miembro.clave]
+        grupo.fuentes.discard(miembro.clave[0])
+        # Se reconstruyen las entradas del grupo en los índices con los miembros que quedan
+        for celda in self._celdas_grupo.pop(id_grupo, ()):
+            self._rejilla[celda].discard(id_grupo)
+            if not self._rejilla[celda]:
+                del self._rejilla[celda]
+        for tramo in self._tramos_grupo.pop(id_grupo, ()):
+            self._por_tramo[tramo].discard(id_grupo)
+            if not self._por_tramo[tramo]:
+                del self._por_tramo[tramo]
+        for otro in grupo.miembros.values():
+            self._indexar(id_grupo, otro)
+        return id_grupo
+
+    def _recalcular(self, id_grupo: int) -> None:
+        grupo = self._grupos.get(id_grupo)
+        if grupo is None:
+            return
+        if not grupo.miembros:
+            del self._grupos[id_grupo]
+            return
+        miembros = sorted(grupo.miembros.values(), key=lambda m: (_prioridad(m.clave[0]), m.clave))
+        canonica = dict(miembros[0].inc)
+        for otro in miembros[1:]:
+            for campo, valor in otro.inc.items():
+                if canonica.get(campo) in (None, "") and valor not in (None, ""):
+                    canonica[campo] = valor
+        niveles = [m.inc.get('nivel') for m in miembros if m.inc.get('nivel')]
+        if niveles:
+            canonica['nivel'] = max(niveles, key=parse_nivel)
+        canonica['fuente'] = miembros[0].clave[0]
+        canonica['fuentes'] = sorted({m.clave[0] for m in miembros}, key=_prioridad)
+        canonica['duplicados'] = [m.inc.get('identificador') for m in miembros[1:]]
+        grupo.canonica = canonica
+
+    # --- Lectura ---
+
+    def incidencias(self) -> List[dict]:
+        """Incidencias canónicas (una por grupo); la lista se reutiliza mientras no haya cambios."""
+        cache = self._cache
+        if cache is not None and cache[0] == self.version:
+            return cache[1]
+        canonicas = [grupo.canonica for grupo in self._grupos.values()]
+        self._cache = (self.version, canonicas)
+        return canonicas
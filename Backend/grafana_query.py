@@ -0,0 +1,219 @@
+"""
+Consultas agrupadas para Grafana: un único POST /grafana/query responde a
+todas las métricas de un dashboard a partir del mismo snapshot.
+
+Cada objetivo (target) describe una métrica:
+
+    {
+        "refId": "greus_per_tipus",
+        "metric": "count",            # count | avg | distinct | percent | rate
+        "dimension": "tipo",          # opcional: carretera, causa, tipo, sentit, region, nivel, weekday, hour
+        "filter": {"severe": true},   # opcional, ver FILTROS
+        "field": "carretera",         # sólo para distinct
+        "top": 10,                    # opcional: limita las filas de una dimensión
+        "source": "live"              # live (snapshot SCT actual) | historial | auto | all (todas las fuentes)
+    }
+
+La respuesta es una tabla larga [{"refId", "label", "value"}, ...] que el
+datasource Infinity carga tal cual; cada panel se queda con sus filas con
+la transformación "Filter data by values" sobre refId.
+"""
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from incident_index import DIAS_SEMANA, NIVEL_GRAVE
+from incident_table import TablaIncidencias
+
+METRICAS = ('count', 'avg', 'distinct', 'percent', 'rate')
+DIMENSIONES_CATEGORICAS = ('carretera', 'causa', 'tipo', 'sentit', 'region')
+DIMENSIONES = DIMENSIONES_CATEGORICAS + ('nivel', 'weekday', 'hour')
+FUENTES = ('live', 'historial', 'auto', 'all')
+FILTROS = (
+    'severe', 'nivel_min', 'nivel_max', 'carretera', 'causa', 'tipo', 'region',
+    'tipo_contiene', 'causa_contiene', 'cortadas', 'new',
+)
+MAXIMO_OBJETIVOS = 50
+
+
+class ConsultaInvalida(ValueError):
+    """Objetivo mal formado (se responde con 400)."""
+
+
+def validar_objetivo(objetivo: dict) -> dict:
+    if not isinstance(objetivo, dict):
+        raise ConsultaInvalida("Cada target debe ser un objeto")
+    ref_id = objetivo.get("refId")
+    if not ref_id or not isinstance(ref_id, str):
+        raise ConsultaInvalida("Cada target necesita un refId")
+    metrica = objetivo.get("metric", "count")
+    if metrica not in METRICAS:
+        raise ConsultaInvalida(f"{ref_id}: metric debe ser una de {', '.join(METRICAS)}")
+    dimension = objetivo.get("dimension")
+    if dimension is not None and dimension not in DIMENSIONES:
+        raise ConsultaInvalida(f"{ref_id}: dimension debe ser una de {', '.join(DIMENSIONES)}")
+    if metrica == "distinct" and objetivo.get("field", "carretera") not in DIMENSIONES_CATEGORICAS:
+        raise ConsultaInvalida(f"{ref_id}: field debe ser una de {', '.join(DIMENSIONES_CATEGORICAS)}")
+    if objetivo.get("source", "live") not in FUENTES:
+        raise ConsultaInvalida(f"{ref_id}: source debe ser una de {', '.join(FUENTES)}")
+    filtro = objetivo.get("filter") or {}
+    if not isinstance(filtro, dict):
+        raise ConsultaInvalida(f"{ref_id}: filter debe ser un objeto")
+    desconocidos = [f for f in filtro if f not in FILTROS]
+    if desconocidos:
+        raise ConsultaInvalida(f"{ref_id}: filtros desconocidos {', '.join(desconocidos)}")
+    top = objetivo.get("top")
+    if top is not None and (not isinstance(top, int) or top < 1):
+        raise ConsultaInvalida(f"{ref_id}: top debe ser un entero positivo")
+    return objetivo
+
+
+def mascara_filtro(tabla: TablaIncidencias, filtro: Optional[dict]) -> np.ndarray:
+    """Máscara de las filas que cumplen el filtro ('new' lo resuelve la carga del histórico)."""
+    filtro = filtro or {}
+    mascara = tabla.mascara_rango_nivel(filtro.get("nivel_min"), filtro.get("nivel_max"))
+    if filtro.get("severe"):
+        mascara &= tabla.mascara_graves(NIVEL_GRAVE)
+    for campo in ('carretera', 'causa', 'tipo', 'region'):
+        if filtro.get(campo) is not None:
+            mascara &= tabla.mascara_igual(campo, filtro[campo])
+    if filtro.get("tipo_contiene"):
+        mascara &= tabla.categorias['tipo'].mascara_contiene(filtro["tipo_contiene"])
+    if filtro.get("causa_contiene"):
+        mascara &= tabla.categorias['causa'].mascara_contiene(filtro["causa_contiene"])
+    if filtro.get("cortadas"):
+        mascara &= tabla.mascara_cortadas()
+    return mascara
+
+
+def _agrupar(tabla: TablaIncidencias, dimension: str, mascara: np.ndarray) -> Counter:
+    if dimension == 'nivel':
+        return tabla.contar_por_nivel(mascara)
+    if dimension == 'weekday':
+        return tabla.contar_por_dia_semana(mascara)
+    if dimension == 'hour':
+        return tabla.contar_por_hora(mascara)
+    return tabla.contar_por(dimension, mascara)
+
+
+def _media_nivel(tabla: TablaIncidencias, mascara: np.ndarray) -> float:
+    con_nivel = mascara & tabla.con_nivel
+    n = int(con_nivel.sum())
+    return round(float(tabla.nivel[con_nivel].astype(np.int64).sum()) / n, 2) if n else 0
+
+
+def _etiquetas(dimension: str, valores: Dict, top: Optional[int]) -> List[tuple]:
+    """(etiqueta, valor) en el orden natural de la dimensión (o de mayor a menor, recortado a top)."""
+    if dimension == 'weekday':
+        return [(dia, valores.get(i, 0)) for i, dia in enumerate(DIAS_SEMANA)]
+    if dimension == 'hour':
+        return [(f"{h:02d}:00", valores.get(h, 0)) for h in range(24)]
+    if dimension == 'nivel':
+        # Niveles 1-5 siempre presentes para que las barras no desaparezcan
+        niveles = {i: 0 for i in range(1, 6)}
+        niveles.update({k: v for k, v in valores.items() if k > 0})
+        return [(str(k), v) for k, v in sorted(niveles.items())]
+    filas = sorted(((k, v) for k, v in valores.items() if k), key=lambda kv: kv[1], reverse=True)
+    return filas[:top] if top else filas
+
+
+def evaluar(tabla: TablaIncidencias, objetivo: dict, horas: float = 24.0) -> List[dict]:
+    """
+    Filas [{"refId", "label", "value"}] de un objetivo sobre una tabla.
+
+    Args:
+        horas: duración del rango, para la métrica rate (incidencias por hora)
+    """
+    ref_id = objetivo["refId"]
+    metrica = objetivo.get("metric", "count")
+    dimension = objetivo.get("dimension")
+    mascara = mascara_filtro(tabla, objetivo.get("filter"))
+
+    if metrica == 'distinct':
+        campo = objetivo.get("field", "carretera")
+        conteo = tabla.contar_por(campo, mascara)
+        valor = sum(1 for k, v in conteo.items() if k and k != 'Desconocida' and v)
+        return [{"refId": ref_id, "label": None, "value": valor}]
+
+    if metrica == 'percent':
+        total = len(tabla)
+        valor = round(int(mascara.sum()) / total * 100, 2) if total else 0
+        return [{"refId": ref_id, "label": None, "value": valor}]
+
+    if dimension is None:
+        if metrica == 'avg':
+            valor = _media_nivel(tabla, mascara)
+        elif metrica == 'rate':
+            valor = round(int(mascara.sum()) / horas, 2) if horas else 0
+        else:
+            valor = int(mascara.sum())
+        return [{"refId": ref_id, "label": None, "value": valor}]
+
+    if metrica == 'avg':
+        codigos = _codigos_dimension(tabla, dimension)
+        valores = {}
+        for etiqueta, _ in _agrupar(tabla, dimension, mascara).items():
+            valores[etiqueta] = _media_nivel(tabla, mascara & (codigos == _codigo(tabla, dimension, etiqueta)))
+    else:
+        valores = _agrupar(tabla, dimension, mascara)
+        if metrica == 'rate' and horas:
+            valores = {k: round(v / horas, 2) for k, v in valores.items()}
+    return [
+        {"refId": ref_id, "label": etiqueta, "value": valor}
+        for etiqueta, valor in _etiquetas(dimension, valores, objetivo.get("top"))
+    ]
+
+
+def _codigos_dimension(tabla: TablaIncidencias, dimension: str) -> np.ndarray:
+    if dimension == 'nivel':
+        return tabla.nivel.astype(np.int64)
+    if dimension == 'weekday':
+        return np.where(np.isnan(tabla.data), -1, ((np.nan_to_num(tabla.data) // 86400).astype(np.int64) + 3) % 7)
+    if dimension == 'hour':
+        return np.where(np.isnan(tabla.data), -1, (np.nan_to_num(tabla.data) % 86400 // 3600).astype(np.int64))
+    return tabla.codigos(dimension)
+
+
+def _codigo(tabla: TablaIncidencias, dimension: str, etiqueta) -> int:
+    if dimension in ('nivel', 'weekday', 'hour'):
+        return etiqueta
+    return tabla.categorias[dimension].codigo(etiqueta)
+
+
+def responder(
+    objetivos: List[dict],
+    tabla_live: TablaIncidencias,
+    tabla_historial: Callable[[bool], Tuple[TablaIncidencias, bool]],
+    horas: float,
+    tabla_fuentes: Optional[Callable[[], TablaIncidencias]] = None,
+) -> List[dict]:
+    """
+    Evalúa todos los objetivos de una petición.
+
+    Args:
+        tabla_live: tabla del snapshot actual
+        tabla_historial: función (solo_nuevas) -> (tabla del histórico en el rango pedido,
+            si el histórico cubre todo el rango). Se llama como mucho una vez por variante.
+        horas: duración del rango pedido
+        tabla_fuentes: función () -> tabla con las incidencias actuales de todas las fuentes
+            (source "all"; sin ella se usa la del snapshot actual)
+    """
+    cargadas: Dict[bool, Tuple[TablaIncidencias, bool]] = {}
+
+    filas: List[dict] = []
+    for objetivo in objetivos:
+        fuente = objetivo.get("source", "live")
+        tabla = tabla_live
+        if fuente == 'all' and tabla_fuentes is not None:
+            tabla = tabla_fuentes()
+        elif fuente in ('historial', 'auto'):
+            solo_nuevas = bool((objetivo.get("filter") or {}).get("new"))
+            if solo_nuevas not in cargadas:
+                cargadas[solo_nuevas] = tabla_historial(solo_nuevas)
+            del_historial, cubre = cargadas[solo_nuevas]
+            # auto: el histórico sólo si cubre el rango; si no, el snapshot actual
+            if fuente == 'historial' or cubre:
+                tabla = del_historial
+        filas.extend(evaluar(tabla, objetivo, horas))
+    return filas
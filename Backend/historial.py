@@ -0,0 +1,273 @@
+"""
+Histórico persistente de incidencias del feed SCT.
+
+Cada snapshot nuevo del poller se ingesta en la tabla IncidenciaHistorial
+(misma base de datos que el resto del backend). Las incidencias se
+deduplican por `identificador` y se guarda cuándo se vieron por primera y
+última vez y cuándo desaparecieron del feed (resuelta). Las consultas por
+rango de tiempo usan los índices de first_seen / resolved_at.
+
+Todas las fechas son datetime con zona horaria UTC.
+"""
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from sqlmodel import SQLModel, Field, Session, select, and_, or_, func
+
+from incident_index import parse_data, parse_nivel
+
+
+class IncidenciaHistorial(SQLModel, table=True):
+    __table_args__ = {"extend_existing": True}
+    id: Optional[int] = Field(default=None, primary_key=True)
+    identificador: str = Field(index=True, unique=True)
+    carretera: Optional[str] = Field(default=None, index=True)
+    pk_inici: Optional[str] = None
+    pk_fi: Optional[str] = None
+    descripcion: Optional[str] = None
+    tipo: Optional[str] = Field(default=None, index=True)
+    causa: Optional[str] = Field(default=None, index=True)
+    nivel: int = Field(default=0, index=True)
+    sentit: Optional[str] = None
+    cap_a: Optional[str] = None
+    lat: Optional[float] = Field(default=None, index=True)
+    lon: Optional[float] = None
+    data: Optional[str] = None
+    # Inicio de la incidencia según el campo 'data' del feed
+    inicio: Optional[datetime] = Field(default=None, index=True)
+    first_seen: datetime = Field(index=True)
+    last_seen: datetime = Field(index=True)
+    resolved_at: Optional[datetime] = Field(default=None, index=True)
+
+
+def ahora_utc() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def clave_incidencia(inc: dict) -> str:
+    """identificador del feed o, si no viene, un hash estable de los campos que la describen."""
+    identificador = inc.get('identificador')
+    if identificador:
+        return str(identificador).strip()
+    base = "|".join(str(inc.get(c)) for c in ('carretera', 'pk_inici', 'pk_fi', 'tipo', 'causa', 'sentit', 'data'))
+    return "h:" + hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+
+def _copiar_campos(fila: IncidenciaHistorial, inc: dict) -> None:
+    fila.carretera = inc.get('carretera')
+    fila.pk_inici = inc.get('pk_inici')
+    fila.pk_fi = inc.get('pk_fi')
+    fila.descripcion = inc.get('descripcion')
+    fila.tipo = inc.get('tipo')
+    fila.causa = inc.get('causa')
+    fila.nivel = parse_nivel(inc.get('nivel'))
+    fila.sentit = inc.get('sentit')
+    fila.cap_a = inc.get('cap_a')
+    fila.lat = inc.get('lat')
+    fila.lon = inc.get('lon')
+    fila.data = inc.get('data')
+    inicio = parse_data(inc.get('data'))
+    fila.inicio = inicio.replace(tzinfo=timezone.utc) if inicio else None
+
+
+def ingestar_snapshot(session: Session, incidencias: Iterable[dict], visto: Optional[datetime] = None) -> dict:
+    """
+    Ingesta un snapshot completo del feed:
+      - incidencias nuevas -> fila nueva (first_seen = last_seen = visto)
+      - incidencias ya activas -> se actualiza last_seen y los campos
+      - incidencias resueltas que reaparecen -> se reabren
+      - activas que ya no están en el feed -> resolved_at = visto
+
+    Returns:
+        Conteo de nuevas, actualizadas, reabiertas y resueltas
+    """
+    visto = visto or ahora_utc()
+    actuales = {clave_incidencia(inc): inc for inc in incidencias}
+
+    activas = {
+        fila.identificador: fila
+        for fila in session.exec(select(IncidenciaHistorial).where(IncidenciaHistorial.resolved_at == None))  # noqa: E711
+    }
+    pendientes = [clave for clave in actuales if clave not in activas]
+    reabrir = {}
+    if pendientes:
+        # Búsqueda indexada por identificador, en bloques para no pasar el límite de parámetros
+        for i in range(0, len(pendientes), 500):
+            bloque = pendientes[i:i + 500]
+            for fila in session.exec(select(IncidenciaHistorial).where(IncidenciaHistorial.identificador.in_(bloque))):
+                reabrir[fila.identificador] = fila
+
+    resumen = Counter()
+    for clave, inc in actuales.items():
+        fila = activas.get(clave)
+        if fila is not None:
+            resumen["actualizadas"] += 1
+        elif clave in reabrir:
+            fila = reabrir[clave]
+            fila.resolved_at = None
+            resumen["reabiertas"] += 1
+        else:
+            fila = IncidenciaHistorial(identificador=clave, first_seen=visto, last_seen=visto)
+            resumen["nuevas"] += 1
+        _copiar_campos(fila, inc)
+        fila.last_seen = visto
+        session.add(fila)
+
+    for clave, fila in activas.items():
+        if clave not in actuales:
+            fila.resolved_at = visto
+            session.add(fila)
+            resumen["resueltas"] += 1
+
+    session.commit()
+    return dict(resumen)
+
+
+def _filtro_rango(desde: Optional[datetime], hasta: Optional[datetime]):
+    """Incidencias activas en algún momento del rango [desde, hasta]."""
+    condiciones = []
+    if hasta is not None:
+        condiciones.append(IncidenciaHistorial.first_seen <= hasta)
+    if desde is not None:
+        condiciones.append(or_(IncidenciaHistorial.resolved_at == None, IncidenciaHistorial.resolved_at >= desde))  # noqa: E711
+    return condiciones
+
+
+def _filtros(
+    desde: Optional[datetime],
+    hasta: Optional[datetime],
+    bbox: Optional[Tuple[float, float, float, float]],
+    carretera: Optional[str],
+    tipo: Optional[str],
+    causa: Optional[str],
+    nivel_min: Optional[int],
+    nivel_max: Optional[int],
+) -> list:
+    """Condiciones comunes de incidencias_en_rango y contar_en_rango."""
+    condiciones = _filtro_rango(desde, hasta)
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        condiciones += [
+            IncidenciaHistorial.lat >= min_lat, IncidenciaHistorial.lat <= max_lat,
+            IncidenciaHistorial.lon >= min_lon, IncidenciaHistorial.lon <= max_lon,
+        ]
+    for columna, valor in (
+        (IncidenciaHistorial.carretera, carretera), (IncidenciaHistorial.tipo, tipo), (IncidenciaHistorial.causa, causa),
+    ):
+        if valor is not None:
+            condiciones.append(columna == valor)
+    if nivel_min is not None:
+        condiciones.append(IncidenciaHistorial.nivel >= nivel_min)
+    if nivel_max is not None:
+        condiciones.append(IncidenciaHistorial.nivel <= nivel_max)
+    return condiciones
+
+
+def incidencias_en_rango(
+    session: Session,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    limite: int = 1000,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    despues_de: Optional[Tuple[datetime, int]] = None,
+    carretera: Optional[str] = None,
+    tipo: Optional[str] = None,
+    causa: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+) -> List[IncidenciaHistorial]:
+    """
+    Incidencias activas en el rango, de la más reciente a la más antigua
+    (first_seen, id). Con bbox (min_lon, min_lat, max_lon, max_lat) sólo las de
+    la zona; con despues_de = (first_seen, id) de la última fila de la página
+    anterior se continúa a partir de ella (keyset, sin OFFSET).
+    """
+    consulta = select(IncidenciaHistorial).where(
+        *_filtros(desde, hasta, bbox, carretera, tipo, causa, nivel_min, nivel_max)
+    )
+    if despues_de is not None:
+        visto, ultimo_id = despues_de
+        consulta = consulta.where(or_(
+            IncidenciaHistorial.first_seen < visto,
+            and_(IncidenciaHistorial.first_seen == visto, IncidenciaHistorial.id < ultimo_id),
+        ))
+    consulta = consulta.order_by(IncidenciaHistorial.first_seen.desc(), IncidenciaHistorial.id.desc())
+    return list(session.exec(consulta.limit(limite)))
+
+
+def contar_en_rango(
+    session: Session,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    carretera: Optional[str] = None,
+    tipo: Optional[str] = None,
+    causa: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+) -> int:
+    """Número de incidencias de incidencias_en_rango con los mismos filtros (todas las páginas)."""
+    consulta = select(func.count()).select_from(IncidenciaHistorial).where(
+        *_filtros(desde, hasta, bbox, carretera, tipo, causa, nivel_min, nivel_max)
+    )
+    return session.exec(consulta).one()
+
+
+def detalles_en_rango(session: Session, desde: datetime, hasta: datetime, solo_nuevas: bool = False) -> List[dict]:
+    """
+    Incidencias activas en el rango (o sólo las aparecidas en él) como diccionarios
+    con las claves de los detalles del feed, para construir una TablaIncidencias.
+    """
+    columnas = (
+        IncidenciaHistorial.identificador, IncidenciaHistorial.carretera, IncidenciaHistorial.causa,
+        IncidenciaHistorial.tipo, IncidenciaHistorial.nivel, IncidenciaHistorial.sentit,
+        IncidenciaHistorial.descripcion, IncidenciaHistorial.lat, IncidenciaHistorial.lon,
+        IncidenciaHistorial.data, IncidenciaHistorial.pk_inici, IncidenciaHistorial.pk_fi,
+    )
+    consulta = select(*columnas)
+    if solo_nuevas:
+        consulta = consulta.where(IncidenciaHistorial.first_seen >= desde, IncidenciaHistorial.first_seen <= hasta)
+    else:
+        consulta = consulta.where(*_filtro_rango(desde, hasta))
+    claves = ('identificador', 'carretera', 'causa', 'tipo', 'nivel', 'sentit', 'descripcion', 'lat', 'lon', 'data',
+              'pk_inici', 'pk_fi')
+    detalles = []
+    for fila in session.exec(consulta):
+        detalle = dict(zip(claves, fila))
+        detalle['nivel'] = str(detalle['nivel'])
+        detalles.append(detalle)
+    return detalles
+
+
+def nuevas_en_rango(session: Session, desde: datetime, hasta: datetime) -> List[datetime]:
+    """Instantes first_seen de las incidencias aparecidas en [desde, hasta] (escaneo por índice)."""
+    consulta = select(IncidenciaHistorial.first_seen).where(
+        IncidenciaHistorial.first_seen >= desde, IncidenciaHistorial.first_seen <= hasta
+    )
+    return list(session.exec(consulta))
+
+
+def por_hora(session: Session, desde: datetime, hasta: datetime) -> List[dict]:
+    """Incidencias nuevas por hora en el rango (incluye las horas sin incidencias)."""
+    conteo = Counter(ts.replace(minute=0, second=0, microsecond=0) for ts in nuevas_en_rango(session, desde, hasta))
+    hora = desde.replace(minute=0, second=0, microsecond=0)
+    resultado = []
+    while hora <= hasta:
+        resultado.append({"hora": hora.isoformat(), "cantidad": conteo.get(hora, 0)})
+        hora += timedelta(hours=1)
+    return resultado
+
+
+def por_dia_semana(session: Session, desde: datetime, hasta: datetime) -> Counter:
+    """Incidencias que empezaron en el rango por día de la semana (0 = dilluns)."""
+    consulta = select(IncidenciaHistorial.inicio, IncidenciaHistorial.first_seen).where(
+        IncidenciaHistorial.first_seen >= desde, IncidenciaHistorial.first_seen <= hasta
+    )
+    return Counter((inicio or first_seen).weekday() for inicio, first_seen in session.exec(consulta))
+
+
+def cobertura(session: Session) -> Optional[datetime]:
+    """Primer instante del que hay histórico (None si está vacío)."""
+    return session.exec(select(func.min(IncidenciaHistorial.first_seen))).one()
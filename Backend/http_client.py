@@ -0,0 +1,107 @@
+"""
+Cliente HTTP asíncrono compartido para todas las llamadas a servicios externos
+(gencat.cat, endpoint de inferencia del chatbot...).
+
+Un único httpx.AsyncClient reutiliza conexiones keep-alive entre peticiones;
+además se limita el número de peticiones simultáneas por host para que un
+servidor lento no acumule conexiones. Las descargas en streaming (cuyo
+cuerpo se reenvía al cliente a su ritmo) tienen su propio límite por host
+para que un cliente lento no deje sin turno al poller del feed.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+import metrics
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "50"))
+UPSTREAM_MAX_PER_HOST = int(os.getenv("UPSTREAM_MAX_PER_HOST", "8"))
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_TIMEOUT_SECONDS", "10"))
+UPSTREAM_MAX_STREAMS_PER_HOST = int(os.getenv("UPSTREAM_MAX_STREAMS_PER_HOST", "16"))
+
+_client: Optional[httpx.AsyncClient] = None
+_semaforos: Dict[str, asyncio.Semaphore] = {}
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT_SECONDS, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+            follow_redirects=True,
+        )
+    return _client
+
+
+def _semaforo(host: str, streaming: bool = False) -> asyncio.Semaphore:
+    clave = f"{host}#stream" if streaming else host
+    semaforo = _semaforos.get(clave)
+    if semaforo is None:
+        limite = UPSTREAM_MAX_STREAMS_PER_HOST if streaming else UPSTREAM_MAX_PER_HOST
+        semaforo = _semaforos[clave] = asyncio.Semaphore(limite)
+    return semaforo
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Petición con el cliente compartido respetando el límite de concurrencia por host."""
+    host = httpx.URL(url).host
+    async with _semaforo(host):
+        inicio = time.perf_counter()
+        try:
+            response = await get_client().request(method, url, **kwargs)
+        except httpx.HTTPError:
+            metrics.observar_upstream(host, None, time.perf_counter() - inicio)
+            raise
+        metrics.observar_upstream(host, response.status_code, time.perf_counter() - inicio, len(response.content))
+        return response
+
+
+@asynccontextmanager
+async def stream(method: str, url: str, reenviar: bool = True, **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    Petición en streaming: el cuerpo se lee del socket a medida que se
+    consume (aiter_raw / aiter_bytes) sin cargarlo entero en memoria.
+
+    Args:
+        reenviar: el cuerpo se reenvía a un cliente (límite de streams por host);
+            False si lo consume el propio servidor (p. ej. el poller del feed),
+            que cuenta en el límite de peticiones normales
+    """
+    host = httpx.URL(url).host
+    async with _semaforo(host, streaming=reenviar):
+        inicio = time.perf_counter()
+        status, descargados = None, None
+        try:
+            async with get_client().stream(method, url, **kwargs) as response:
+                status = response.status_code
+                try:
+                    yield response
+                finally:
+                    descargados = response.num_bytes_downloaded
+        finally:
+            metrics.observar_upstream(host, status, time.perf_counter() - inicio, descargados)
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await request("POST", url, **kwargs)
+
+
+async def close() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _semaforos.clear()
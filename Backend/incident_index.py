@@ -0,0 +1,209 @@
+"""
+Índice de agregados de incidencias, calculado una vez por snapshot del feed.
+
+Los endpoints de Grafana y /api/incidencies/* leen de aquí los conteos por
+dimensión (carretera, causa, tipo, nivel, región, día de la semana), los de
+las incidencias graves y las medias de severidad, en lugar de recorrer toda
+la lista en cada petición.
+
+Cuando llega un snapshot nuevo el índice se actualiza de forma incremental:
+sólo se restan las incidencias que han desaparecido/cambiado y se suman las
+nuevas.
+"""
+import math
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+NIVEL_GRAVE = 3
+# PK máximo admitido (km): por encima, o no finito ("inf", "1e300"), es un dato erróneo del feed
+PK_MAXIMO_KM = 10000.0
+
+DIAS_SEMANA = ["Dilluns", "Dimarts", "Dimecres", "Dijous", "Divendres", "Dissabte", "Diumenge"]
+
+# Claves del diccionario de incidencia detallada (datasets.incidencia_a_detalle)
+_CAMPOS = ('identificador', 'lat', 'lon', 'carretera', 'pk_inici', 'pk_fi', 'descripcion', 'tipo',
+           'causa', 'nivel', 'sentit', 'cap_a', 'data', 'subtipus')
+
+
+def parse_nivel(valor) -> int:
+    try:
+        return int(valor)
+    except Exception:
+        return 0
+
+
+def parse_pk(valor) -> float:
+    """Punto kilométrico en km ("48.3", "48,3" o "48+300"); NaN si no se puede parsear o está fuera de [0, PK_MAXIMO_KM]."""
+    if valor is None:
+        return float('nan')
+    texto = str(valor).strip().replace(',', '.')
+    try:
+        if '+' in texto:
+            km, metros = texto.split('+', 1)
+            pk = float(km) + float(metros) / 1000
+        else:
+            pk = float(texto)
+    except ValueError:
+        return float('nan')
+    if not math.isfinite(pk) or not 0 <= pk <= PK_MAXIMO_KM:
+        return float('nan')
+    return pk
+
+
+def region_from_incidence(inc: dict) -> str:
+    """Clasifica en regiones gruesas para Grafana (evita 'Desconeguda')."""
+    try:
+        lat = float(inc.get('lat', 'nan'))
+        lon = float(inc.get('lon', inc.get('lng', 'nan')))
+    except Exception:
+        lat = float('nan')
+        lon = float('nan')
+
+    carretera = (inc.get('carretera') or '').upper().strip()
+
+    # Prefer coordenadas si existen
+    if not (lat != lat or lon != lon):  # check for NaN
+        if 41.2 <= lat <= 41.7 and 1.9 <= lon <= 2.5:
+            return 'AMB'
+        if 40.5 <= lat <= 43.8 and -1.5 <= lon <= 3.6:
+            return 'Catalunya'
+
+    # Fallbacks basados en carretera (B- suelen ser area BCN)
+    if carretera.startswith('B-') or carretera.startswith('BV-'):
+        return 'AMB'
+    if carretera.startswith('C-') or carretera.startswith('AP-') or carretera.startswith('A-'):
+        return 'Catalunya'
+
+    return 'Desconeguda'
+
+
+def parse_data(data: Optional[str]) -> Optional[datetime]:
+    """Parsea el campo 'data' del feed (formato: "Wed, 14 Jan 2026 12:51:30 GMT")."""
+    if not data:
+        return None
+    try:
+        return datetime.strptime(data, "%a, %d %b %Y %H:%M:%S %Z")
+    except Exception:
+        return None
+
+
+def _sumar(counter: Counter, clave, delta: int) -> None:
+    valor = counter[clave] + delta
+    if valor > 0:
+        counter[clave] = valor
+    else:
+        del counter[clave]
+
+
+def _clave(inc: dict) -> tuple:
+    return tuple(inc.get(campo) for campo in _CAMPOS)
+
+
+class IndiceIncidencias:
+    def __init__(self, incidencias: Iterable[dict] = ()):
+        self.total = 0
+        self.graves = 0
+        self.retenciones = 0
+        # Suma y número de niveles informados (para la media de severidad)
+        self.suma_nivel = 0
+        self.con_nivel = 0
+
+        # Conteos por dimensión con el valor tal cual viene del feed (None incluido)
+        self.por_carretera = Counter()
+        self.por_causa = Counter()
+        self.por_tipo = Counter()
+        self.por_nivel = Counter()
+        self.por_region = Counter()
+        self.por_dia_semana = Counter()
+
+        # Lo mismo restringido a incidencias graves (nivel >= 3)
+        self.graves_por_carretera = Counter()
+        self.graves_por_causa = Counter()
+        self.graves_por_tipo = Counter()
+
+        self._registros = Counter()
+        for inc in incidencias:
+            self._registros[_clave(inc)] += 1
+            self._aplicar(inc, 1)
+
+    # --- Construcción ---
+
+    def actualizar(self, incidencias: List[dict]) -> "IndiceIncidencias":
+        """
+        Devuelve el índice de un snapshot nuevo reutilizando este. No modifica
+        self (puede haber peticiones leyendo el snapshot anterior).
+        """
+        registros = Counter()
+        ejemplos = {}
+        for inc in incidencias:
+            clave = _clave(inc)
+            registros[clave] += 1
+            ejemplos[clave] = inc
+
+        nuevos = registros - self._registros
+        eliminados = self._registros - registros
+        cambios = sum(nuevos.values()) + sum(eliminados.values())
+        if cambios > len(incidencias) // 2:
+            # Si cambia casi todo sale más barato recalcular desde cero
+            return IndiceIncidencias(incidencias)
+
+        indice = self._copia()
+        for clave, n in eliminados.items():
+            indice._aplicar(dict(zip(_CAMPOS, clave)), -n)
+        for clave, n in nuevos.items():
+            indice._aplicar(ejemplos[clave], n)
+        indice._registros = registros
+        return indice
+
+    def _copia(self) -> "IndiceIncidencias":
+        indice = IndiceIncidencias()
+        for nombre, valor in vars(self).items():
+            if isinstance(valor, Counter):
+                valor = Counter(valor)
+            setattr(indice, nombre, valor)
+        return indice
+
+    def _aplicar(self, inc: dict, delta: int) -> None:
+        """Suma (delta > 0) o resta (delta < 0) una incidencia a todos los agregados."""
+        carretera = inc.get('carretera')
+        causa = inc.get('causa')
+        tipo = inc.get('tipo')
+        nivel = parse_nivel(inc.get('nivel'))
+        grave = nivel >= NIVEL_GRAVE
+
+        self.total += delta
+        _sumar(self.por_carretera, carretera, delta)
+        _sumar(self.por_causa, causa, delta)
+        _sumar(self.por_tipo, tipo, delta)
+        _sumar(self.por_nivel, nivel, delta)
+        _sumar(self.por_region, region_from_incidence(inc), delta)
+
+        dt = parse_data(inc.get('data'))
+        if dt is not None:
+            _sumar(self.por_dia_semana, dt.weekday(), delta)
+
+        if inc.get('nivel'):
+            self.suma_nivel += nivel * delta
+            self.con_nivel += delta
+
+        if tipo and 'retenc' in tipo.lower():
+            self.retenciones += delta
+
+        if grave:
+            self.graves += delta
+            _sumar(self.graves_por_carretera, carretera, delta)
+            _sumar(self.graves_por_causa, causa, delta)
+            _sumar(self.graves_por_tipo, tipo, delta)
+
+    # --- Consultas ---
+
+    def carreteras_distintas(self, solo_graves: bool = False) -> int:
+        counter = self.graves_por_carretera if solo_graves else self.por_carretera
+        return sum(1 for carretera in counter if carretera and carretera != 'Desconocida')
+
+    def media_severidad(self) -> float:
+        return round(self.suma_nivel / self.con_nivel, 2) if self.con_nivel else 0
+
+    def porcentaje_graves(self) -> float:
+        return round(self.graves / self.total * 100, 2) if self.total else 0
@@ -0,0 +1,131 @@
+"""
+Difusión en tiempo real (Server-Sent Events) de los cambios del feed.
+
+Cada suscriptor recibe una vez el snapshot completo y después sólo los
+deltas (incidencias añadidas, actualizadas y resueltas, por identificador)
+cada vez que el poller publica un snapshot nuevo. Cada delta se serializa
+una sola vez y se reparte a todos los suscriptores del proceso.
+
+Cada suscriptor tiene una cola acotada: si un cliente no consume al ritmo
+de los cambios y su cola se llena, se le expulsa (el EventSource del
+navegador se reconecta solo y vuelve a empezar por un snapshot completo).
+"""
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import json_cache
+
+# Cada cuántos segundos se envía un comentario para mantener viva la conexión
+HEARTBEAT_SECONDS = 15.0
+
+
+def _clave(inc: dict) -> str:
+    return str(inc.get('identificador') or '')
+
+
+def calcular_delta(anteriores: List[dict], actuales: List[dict]) -> dict:
+    """
+    Diferencias entre dos snapshots por identificador.
+
+    Returns:
+        {"added": [...], "updated": [...], "resolved": [identificadores]}
+    """
+    previas: Dict[str, dict] = {_clave(inc): inc for inc in anteriores}
+    nuevas: Dict[str, dict] = {_clave(inc): inc for inc in actuales}
+    added, updated = [], []
+    for clave, inc in nuevas.items():
+        previa = previas.get(clave)
+        if previa is None:
+            added.append(inc)
+        elif previa != inc:
+            updated.append(inc)
+    resolved = [clave for clave in previas if clave not in nuevas]
+    return {"added": added, "updated": updated, "resolved": resolved}
+
+
+def delta_vacio(delta: dict) -> bool:
+    return not (delta["added"] or delta["updated"] or delta["resolved"])
+
+
+def evento_sse(evento: str, datos: bytes, id_evento: Optional[int] = None) -> bytes:
+    cabecera = f"event: {evento}\n"
+    if id_evento is not None:
+        cabecera += f"id: {id_evento}\n"
+    return cabecera.encode("utf-8") + b"data: " + datos + b"\n\n"
+
+
+class Suscriptor:
+    def __init__(self, maximo_cola: int):
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=maximo_cola)
+        self.expulsado = False
+
+
+class Difusor:
+    """Reparto en proceso de eventos ya serializados a muchos suscriptores."""
+
+    def __init__(self, maximo_suscriptores: int = 500, maximo_cola: int = 32):
+        """
+        Args:
+            maximo_suscriptores: conexiones simultáneas admitidas
+            maximo_cola: eventos pendientes por suscriptor antes de expulsarlo
+        """
+        self.maximo_suscriptores = maximo_suscriptores
+        self.maximo_cola = maximo_cola
+        self.version = 0
+        self._suscriptores: Set[Suscriptor] = set()
+        self.stats = {"published": 0, "delivered": 0, "evicted": 0, "rejected": 0}
+
+    @property
+    def suscriptores(self) -> int:
+        return len(self._suscriptores)
+
+    def suscribir(self) -> Optional[Suscriptor]:
+        """Nuevo suscriptor, o None si ya se ha alcanzado el máximo."""
+        if len(self._suscriptores) >= self.maximo_suscriptores:
+            self.stats["rejected"] += 1
+            return None
+        suscriptor = Suscriptor(self.maximo_cola)
+        self._suscriptores.add(suscriptor)
+        return suscriptor
+
+    def cancelar(self, suscriptor: Suscriptor) -> None:
+        self._suscriptores.discard(suscriptor)
+
+    def publicar_delta(self, delta: dict) -> int:
+        """Serializa el delta una vez y lo encola a todos los suscriptores. Debe llamarse desde el event loop."""
+        self.version += 1
+        mensaje = evento_sse("delta", json_cache.dumps({"version": self.version, **delta}), self.version)
+        self.stats["published"] += 1
+        for suscriptor in list(self._suscriptores):
+            try:
+                suscriptor.cola.put_nowait((self.version, mensaje))
+                self.stats["delivered"] += 1
+            except asyncio.QueueFull:
+                # Consumidor lento: se le desconecta en lugar de acumular memoria
+                suscriptor.expulsado = True
+                self._suscriptores.discard(suscriptor)
+                self.stats["evicted"] += 1
+        return self.version
+
+    async def emitir(self, suscriptor: Suscriptor, snapshot: bytes, version_snapshot: int) -> AsyncIterator[bytes]:
+        """
+        Flujo SSE de un suscriptor: el snapshot completo y luego los deltas
+        posteriores a él. Termina si el suscriptor es expulsado.
+        """
+        try:
+            yield b"retry: 3000\n\n"
+            yield evento_sse("snapshot", snapshot, version_snapshot)
+            while not suscriptor.expulsado:
+                try:
+                    version, mensaje = await asyncio.wait_for(suscriptor.cola.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if version > version_snapshot:
+                    yield mensaje
+            yield evento_sse("evicted", b'{"reason":"slow consumer"}')
+        finally:
+            self.cancelar(suscriptor)
+
+    def status(self) -> dict:
+        return {"subscribers": self.suscriptores, "version": self.version, **self.stats}
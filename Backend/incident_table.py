@@ -0,0 +1,219 @@
+"""
+Tabla columnar (NumPy) de incidencias.
+
+En lugar de listas de diccionarios, cada campo es un array: lat/lon y
+PK en float64, nivel en int8, fecha como epoch (float64, NaN si no hay)
+y los campos categóricos (carretera, causa, tipo, sentit) codificados como
+enteros sobre un diccionario de valores (-1 = sin valor). Los filtros y
+group-by se hacen vectorizados, así que siguen siendo baratos aunque se
+cargue el histórico completo.
+"""
+import calendar
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from incident_index import parse_data, parse_nivel, parse_pk, region_from_incidence
+
+CATEGORICAS = ('carretera', 'causa', 'tipo', 'sentit')
+
+
+class Categoria:
+    """Diccionario valor <-> código de una columna categórica."""
+
+    def __init__(self, valores: Sequence[Optional[str]]):
+        self.valores: List[str] = []
+        self._codigos: Dict[str, int] = {}
+        self.codigos = np.fromiter((self.codificar(v) for v in valores), dtype=np.int32, count=len(valores))
+
+    def codificar(self, valor: Optional[str]) -> int:
+        if valor is None:
+            return -1
+        codigo = self._codigos.get(valor)
+        if codigo is None:
+            codigo = len(self.valores)
+            self._codigos[valor] = codigo
+            self.valores.append(valor)
+        return codigo
+
+    def codigo(self, valor: Optional[str]) -> int:
+        """Código de un valor existente (-2 si no aparece en la tabla)."""
+        if valor is None:
+            return -1
+        return self._codigos.get(valor, -2)
+
+    def mascara_contiene(self, texto: str) -> np.ndarray:
+        """Filas cuyo valor contiene texto (sin distinguir mayúsculas). Se evalúa una vez por categoría."""
+        texto = texto.lower()
+        por_categoria = np.array([texto in v.lower() for v in self.valores] + [False], dtype=bool)
+        # El código -1 (sin valor) indexa la última posición, que es False
+        return por_categoria[self.codigos]
+
+
+_MESES = {m: i for i, m in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), start=1)}
+
+
+@lru_cache(maxsize=8192)
+def _epoch(data: Optional[str]) -> float:
+    """Epoch UTC del campo 'data' ("Wed, 14 Jan 2026 12:51:30 GMT"), NaN si no se puede parsear."""
+    if not data:
+        return np.nan
+    try:
+        # Camino rápido sin strptime: es el formato fijo del feed
+        _, dia, mes, anio, hora, _zona = data.split()
+        h, m, sec = hora.split(':')
+        return float(calendar.timegm((int(anio), _MESES[mes], int(dia), int(h), int(m), int(sec))))
+    except (ValueError, KeyError):
+        dt = parse_data(data)
+        return float(calendar.timegm(dt.timetuple())) if dt is not None else np.nan
+
+
+class TablaIncidencias:
+    def __init__(self, incidencias: Iterable[dict] = ()):
+        incidencias = list(incidencias)
+        n = len(incidencias)
+        # Clave de ordenación estable para la paginación por cursor
+        self.identificador = np.array([str(inc.get('identificador') or '') for inc in incidencias], dtype=str).reshape(n)
+        self._orden_id: Optional[np.ndarray] = None
+        self.lat = np.array([inc.get('lat') for inc in incidencias], dtype=np.float64).reshape(n)
+        self.lon = np.array([inc.get('lon') for inc in incidencias], dtype=np.float64).reshape(n)
+        self.nivel = np.fromiter(
+            (max(-128, min(127, parse_nivel(inc.get('nivel')))) for inc in incidencias), dtype=np.int8, count=n
+        )
+        self.data = np.fromiter((_epoch(inc.get('data')) for inc in incidencias), dtype=np.float64, count=n)
+        # Puntos kilométricos en km (NaN si no hay), para el índice lineal por carretera
+        self.pk_inici = np.fromiter((parse_pk(inc.get('pk_inici')) for inc in incidencias), dtype=np.float64, count=n)
+        self.pk_fi = np.fromiter((parse_pk(inc.get('pk_fi')) for inc in incidencias), dtype=np.float64, count=n)
+        # Si el nivel viene informado (para la media de severidad, igual que el índice)
+        self.con_nivel = np.fromiter((bool(inc.get('nivel')) for inc in incidencias), dtype=bool, count=n)
+        self.categorias: Dict[str, Categoria] = {
+            campo: Categoria([inc.get(campo) for inc in incidencias]) for campo in CATEGORICAS
+        }
+        self.categorias['region'] = Categoria([region_from_incidence(inc) for inc in incidencias])
+        # La descripción es texto libre: sólo se guarda lo que usan los filtros
+        self.descripcion_tallat = np.fromiter(
+            ('tallat' in (inc.get('descripcion') or '').lower() for inc in incidencias), dtype=bool, count=n
+        )
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def codigos(self, campo: str) -> np.ndarray:
+        return self.categorias[campo].codigos
+
+    @staticmethod
+    def filas(mascara: np.ndarray) -> List[int]:
+        """Índices de las filas que cumplen la máscara (para recuperar los diccionarios)."""
+        return np.flatnonzero(mascara).tolist()
+
+    # --- Paginación ---
+
+    @property
+    def orden_identificador(self) -> np.ndarray:
+        """Filas ordenadas por (identificador, posición); se calcula una vez por tabla."""
+        if self._orden_id is None:
+            self._orden_id = np.argsort(self.identificador, kind="stable")
+        return self._orden_id
+
+    def pagina(
+        self,
+        mascara: np.ndarray,
+        despues_de: Optional[tuple] = None,
+        limite: int = 100,
+    ) -> tuple:
+        """
+        Filas que cumplen la máscara en orden de identificador, a partir de la
+        clave (identificador, fila) del cursor.
+
+        Returns:
+            (filas, siguiente): índices de la página y clave para la siguiente (None si no hay más)
+        """
+        orden = self.orden_identificador
+        inicio = 0
+        if despues_de is not None:
+            identificador, fila = despues_de
+            ids = self.identificador[orden]
+            inicio = int(np.searchsorted(ids, identificador, side="left"))
+            fin = int(np.searchsorted(ids, identificador, side="right"))
+            # Dentro del mismo identificador el orden es por fila (argsort estable)
+            inicio += int(np.searchsorted(orden[inicio:fin], fila, side="right"))
+        candidatas = orden[inicio:]
+        seleccion = candidatas[np.flatnonzero(mascara[candidatas])[:limite + 1]]
+        filas = seleccion[:limite].tolist()
+        siguiente = None
+        if len(seleccion) > limite:
+            ultima = filas[-1]
+            siguiente = (str(self.identificador[ultima]), ultima)
+        return filas, siguiente
+
+    # --- Filtros (devuelven máscaras booleanas) ---
+
+    def mascara_graves(self, nivel_minimo: int = 3) -> np.ndarray:
+        return self.nivel >= nivel_minimo
+
+    def mascara_con_coordenadas(self) -> np.ndarray:
+        # Igual que "if inc.get('lat') and inc.get('lon')": excluye NaN y 0
+        return (np.nan_to_num(self.lat) != 0) & (np.nan_to_num(self.lon) != 0)
+
+    def mascara_cortadas(self) -> np.ndarray:
+        """Calles/carreteras cortadas: descripción 'tallat', tipo 'tall' o nivel >= 4."""
+        return self.descripcion_tallat | self.categorias['tipo'].mascara_contiene('tall') | (self.nivel >= 4)
+
+    def mascara_contiene_alguno(self, campos: Sequence[str], textos: Sequence[str]) -> np.ndarray:
+        """Filas en las que alguno de los campos contiene alguno de los textos."""
+        mascara = np.zeros(len(self), dtype=bool)
+        for campo in campos:
+            for texto in textos:
+                mascara |= self.categorias[campo].mascara_contiene(texto)
+        return mascara
+
+    def mascara_igual(self, campo: str, valor: Optional[str]) -> np.ndarray:
+        return self.codigos(campo) == self.categorias[campo].codigo(valor)
+
+    def mascara_rango_nivel(self, minimo: Optional[int] = None, maximo: Optional[int] = None) -> np.ndarray:
+        mascara = np.ones(len(self), dtype=bool)
+        if minimo is not None:
+            mascara &= self.nivel >= minimo
+        if maximo is not None:
+            mascara &= self.nivel <= maximo
+        return mascara
+
+    def mascara_rango_data(self, desde: Optional[float] = None, hasta: Optional[float] = None) -> np.ndarray:
+        mascara = ~np.isnan(self.data)
+        if desde is not None:
+            mascara &= self.data >= desde
+        if hasta is not None:
+            mascara &= self.data <= hasta
+        return mascara
+
+    # --- Group-by ---
+
+    def contar_por(self, campo: str, mascara: Optional[np.ndarray] = None) -> Counter:
+        """Conteo por valor de una columna categórica (None para las filas sin valor)."""
+        valores = [None] + self.categorias[campo].valores
+        # Desplazamos +1 para que el -1 (sin valor) caiga en la posición 0; la máscara
+        # se aplica como peso para no copiar la columna
+        conteo = np.bincount(self.codigos(campo) + 1, weights=mascara, minlength=len(valores))
+        return Counter({valores[i]: int(conteo[i]) for i in np.flatnonzero(conteo)})
+
+    def contar_por_nivel(self, mascara: Optional[np.ndarray] = None) -> Counter:
+        conteo = np.bincount(self.nivel.astype(np.int16) + 128, weights=mascara, minlength=256)
+        return Counter({int(i) - 128: int(conteo[i]) for i in np.flatnonzero(conteo)})
+
+    def contar_por_hora(self, mascara: Optional[np.ndarray] = None) -> Counter:
+        """Hora del día (UTC) del campo 'data'."""
+        data = self.data if mascara is None else self.data[mascara]
+        data = data[~np.isnan(data)]
+        horas = ((data % 86400) // 3600).astype(np.int64)
+        return Counter({int(h): int(c) for h, c in enumerate(np.bincount(horas, minlength=24)) if c})
+
+    def contar_por_dia_semana(self, mascara: Optional[np.ndarray] = None) -> Counter:
+        """0 = dilluns ... 6 = diumenge (el 1/1/1970 fue jueves)."""
+        data = self.data if mascara is None else self.data[mascara]
+        data = data[~np.isnan(data)]
+        dias = ((data // 86400).astype(np.int64) + 3) % 7
+        return Counter({int(d): int(c) for d, c in enumerate(np.bincount(dias, minlength=7)) if c})
+
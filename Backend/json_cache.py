@@ -0,0 +1,165 @@
+"""
+Respuestas JSON precalculadas por snapshot del feed.
+
+Cada endpoint pesado (/api/incidencies/raw, /incidencias, /api/incidents-map...)
+se serializa una sola vez por snapshot con orjson y se guarda como bytes
+junto con un ETag fuerte (hash del contenido). Las variantes gzip y brotli
+se comprimen la primera vez que se piden y también se guardan, así que una
+petición caliente sólo copia bytes; si el cliente ya tiene la versión
+actual (If-None-Match) se responde 304 sin cuerpo.
+
+orjson y brotli son opcionales: sin ellos se usa json de la librería
+estándar y sólo gzip.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import Request, Response
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dependencia opcional
+    brotli = None
+
+# Por debajo de este tamaño no compensa comprimir
+TAMANO_MINIMO_COMPRESION = 1024
+GZIP_NIVEL = 6
+BROTLI_CALIDAD = 5
+
+
+def dumps(value: Any) -> bytes:
+    """Serializa a JSON compacto en UTF-8 (mismo formato que JSONResponse)."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY, default=str)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _comprimir(body: bytes, codificacion: str) -> bytes:
+    if codificacion == "br":
+        return brotli.compress(body, quality=BROTLI_CALIDAD)
+    return gzip.compress(body, compresslevel=GZIP_NIVEL, mtime=0)
+
+
+class RespuestaJSON:
+    """Cuerpo JSON serializado, su ETag y sus variantes comprimidas (calculadas bajo demanda)."""
+
+    def __init__(self, value: Any):
+        with metrics.etapa("serialize_json"):
+            self.body = dumps(value)
+        self.etag_base = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self._variantes: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def etag(self, codificacion: Optional[str] = None) -> str:
+        # Cada representación (identidad, gzip, br) tiene su propio ETag fuerte
+        return f'"{self.etag_base}-{codificacion}"' if codificacion else f'"{self.etag_base}"'
+
+    def variante(self, codificacion: Optional[str]) -> bytes:
+        if not codificacion:
+            return self.body
+        cuerpo = self._variantes.get(codificacion)
+        if cuerpo is None:
+            with self._lock:
+                cuerpo = self._variantes.get(codificacion)
+                if cuerpo is None:
+                    cuerpo = self._variantes[codificacion] = _comprimir(self.body, codificacion)
+        return cuerpo
+
+    def coincide(self, if_none_match: Optional[str]) -> bool:
+        """True si el cliente ya tiene alguna representación de este contenido."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        for etiqueta in if_none_match.split(","):
+            etiqueta = etiqueta.strip()
+            if etiqueta.startswith("W/"):
+                etiqueta = etiqueta[2:]
+            if etiqueta.strip('"').split("-", 1)[0] == self.etag_base:
+                return True
+        return False
+
+
+class RespuestasPrecalculadas:
+    """Respuestas ya serializadas de un snapshot, por nombre de endpoint (o firma de la consulta)."""
+
+    def __init__(self, maximo: int = 256):
+        """
+        Args:
+            maximo: respuestas guardadas como mucho; a partir de ahí se construyen sin guardarlas
+        """
+        self.maximo = maximo
+        self._respuestas: Dict[str, RespuestaJSON] = {}
+        self._lock = threading.Lock()
+
+    def get(self, clave: str) -> Optional[RespuestaJSON]:
+        return self._respuestas.get(clave)
+
+    def obtener(self, clave: str, construir: Callable[[], Any]) -> RespuestaJSON:
+        """
+        Devuelve la respuesta serializada, construyéndola si hace falta. Las
+        peticiones concurrentes esperan a la misma construcción (sólo se
+        serializa una vez por snapshot).
+        """
+        respuesta = self._respuestas.get(clave)
+        if respuesta is not None:
+            return respuesta
+        with self._lock:
+            respuesta = self._respuestas.get(clave)
+            if respuesta is None:
+                respuesta = RespuestaJSON(construir())
+                if len(self._respuestas) < self.maximo:
+                    self._respuestas[clave] = respuesta
+        return respuesta
+
+
+def negociar_codificacion(accept_encoding: Optional[str], permitir_br: bool = True) -> Optional[str]:
+    """Elige br o gzip según Accept-Encoding (None = sin comprimir)."""
+    if not accept_encoding:
+        return None
+    aceptadas = {}
+    for parte in accept_encoding.lower().split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        q = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                q = float(parametros[2:])
+            except ValueError:
+                q = 0.0
+        aceptadas[nombre.strip()] = q
+    if permitir_br and brotli is not None and aceptadas.get("br", 0) > 0:
+        return "br"
+    if aceptadas.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def responder(request: Request, respuesta: RespuestaJSON) -> Response:
+    """Response con el cuerpo precalculado, ETag fuerte, 304 condicional y compresión."""
+    codificacion = None
+    if len(respuesta.body) >= TAMANO_MINIMO_COMPRESION:
+        codificacion = negociar_codificacion(request.headers.get("accept-encoding"))
+    headers = {
+        "ETag": respuesta.etag(codificacion),
+        "Vary": "Accept-Encoding",
+        # El cliente puede guardarla pero debe revalidar (barato: 304)
+        "Cache-Control": "no-cache",
+    }
+    if respuesta.coincide(request.headers.get("if-none-match")):
+        metrics.respuestas_json.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    metrics.respuestas_json.labels(codificacion or "identity").inc()
+    if codificacion:
+        headers["Content-Encoding"] = codificacion
+    return Response(content=respuesta.variante(codificacion), media_type="application/json", headers=headers)
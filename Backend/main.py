@@ -1,34 +1,68 @@
-from typing import Optional, List
+from typing import AsyncIterator, Optional, List, Tuple
 from collections import Counter
-from fastapi import FastAPI, HTTPException, Depends, Request, Response, status, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import SQLModel, Field, create_engine, Session, select
-from passlib.context import CryptContext
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlmodel import SQLModel, Field, Session, select, or_
+import sqlalchemy
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from jose import jwt, JWTError
 import uuid
-import requests
+import zlib
+import hashlib
+from urllib.parse import quote
+from contextlib import AsyncExitStack
+import httpx
+from starlette.concurrency import run_in_threadpool
 from lxml import etree
-from io import StringIO
 from analizar_dataset_1 import extraer_incidencias
-from datasets import extraer_coordenadas_xml, extraer_coordenadas_con_detalles
+from datasets import parsear_incidencias_detalladas, CAMPOS_DETALLE
+from snapshot_cache import SnapshotCache
+from feed_poller import FeedPoller
+import http_client
+from incident_index import IndiceIncidencias, DIAS_SEMANA
+from incident_table import TablaIncidencias
+from feed_snapshot import FeedSnapshot, construir_snapshot
+import json_cache
+import historial
+import spatial_index
+import pk_index
+import paginacion
+import incident_stream
+import grafana_query
+import metrics
+import xml_txt
+import dataset_store
+import racc_dataset
+import fuentes
+import auth_cache
+import password_hashing
+import compactacion
+import database
 import os
-import json
-import csv
-import xml.etree.ElementTree as ET
 
 
 app = FastAPI()
 HF_API_TOKEN = os.getenv("HF_API_TOKEN")
-HF_ENDPOINT = "https://api-inference.huggingface.co/models/gpt2"
+HF_ENDPOINT = os.getenv("HF_ENDPOINT", "https://api-inference.huggingface.co/models/gpt2")
 
 
     
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database.db")
+# Pool de conexiones por worker (PostgreSQL o SQLite en fichero): fijas, extra, espera máxima,
+# reciclado en segundos y comprobación de la conexión antes de usarla
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# SQLite: journal WAL (varios workers a la vez) y segundos de espera si otro proceso está escribiendo
+SQLITE_WAL = os.getenv("SQLITE_WAL", "1") == "1"
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", "5"))
 
 # Security settings
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGEME_GENERATE_A_STRONG_KEY")
@@ -36,21 +70,75 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Feed SCT: segundos que un snapshot es fresco y segundos extra que se sirve viejo mientras se revalida
+SCT_FEED_URL = os.getenv("SCT_FEED_URL", "https://www.gencat.cat/transit/opendata/incidenciesGML.xml")
+SCT_FEED_POLL_SECONDS = float(os.getenv("SCT_FEED_POLL_SECONDS", "30"))
+SCT_FEED_TTL_SECONDS = float(os.getenv("SCT_FEED_TTL_SECONDS", "60"))
+SCT_FEED_STALE_SECONDS = float(os.getenv("SCT_FEED_STALE_SECONDS", "600"))
+# Máximo que una petición espera al feed cuando aún no hay ningún snapshot (arranque en frío)
+SCT_FEED_WAIT_SECONDS = float(os.getenv("SCT_FEED_WAIT_SECONDS", "5"))
+# Guardar cada snapshot nuevo en el histórico (tabla IncidenciaHistorial)
+SCT_HISTORIAL_ENABLED = os.getenv("SCT_HISTORIAL_ENABLED", "1") == "1"
+# Mapa: por debajo de este zoom las incidencias se devuelven agrupadas
+MAP_CLUSTER_MAX_ZOOM = int(os.getenv("MAP_CLUSTER_MAX_ZOOM", "12"))
+# Push de cambios (SSE): conexiones máximas y eventos pendientes por cliente antes de expulsarlo
+SCT_STREAM_MAX_SUBSCRIBERS = int(os.getenv("SCT_STREAM_MAX_SUBSCRIBERS", "500"))
+SCT_STREAM_QUEUE_SIZE = int(os.getenv("SCT_STREAM_QUEUE_SIZE", "32"))
+# Ficheros de datasets subidos: directorio del almacén (por hash) y tamaño máximo por fichero
+DATASET_STORE_DIR = os.getenv("DATASET_STORE_DIR", "./dataset_store")
+DATASET_UPLOAD_MAX_BYTES = int(os.getenv("DATASET_UPLOAD_MAX_BYTES", str(5 * 1024 ** 3)))
+# Dataset RACC: Excel de origen y directorio de su conversión columnar (se rehace si cambia el Excel)
+RACC_XLSX_PATH = os.getenv("RACC_XLSX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset_racc", "dataset_Racc.xlsx"))
+RACC_CACHE_DIR = os.getenv("RACC_CACHE_DIR", "./racc_cache")
+# Otras fuentes del catálogo con feed de incidencias (fuentes.py): cuáles se consultan y sus URLs
+FUENTES_ACTIVAS = [f.strip() for f in os.getenv("FUENTES_ACTIVAS", "rodalies,dgt").split(",") if f.strip()]
+RODALIES_FEED_URL = os.getenv("RODALIES_FEED_URL", "https://www.gencat.cat/rodalies/incidencies_rodalies_rss_ca_ES.xml")
+DGT_FEED_URL = os.getenv("DGT_FEED_URL", "https://nap.dgt.es/datex2/v3/dgt/SituationPublication/datex2_v36.xml")
+# Plazo por descarga y reintentos de cada fuente (vacío = los valores propios de cada adaptador)
+FUENTES_TIMEOUT_SECONDS = float(os.getenv("FUENTES_TIMEOUT_SECONDS")) if os.getenv("FUENTES_TIMEOUT_SECONDS") else None
+FUENTES_RETRIES = int(os.getenv("FUENTES_RETRIES")) if os.getenv("FUENTES_RETRIES") else None
+# Auth: tokens verificados en memoria y cada cuántos segundos se leen los logouts de otros procesos
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_REVOCATION_SYNC_SECONDS = float(os.getenv("AUTH_REVOCATION_SYNC_SECONDS", "5"))
+# Segundos hacia atrás que se releen en cada sincronización (revocaciones confirmadas tarde, desfase de relojes)
+AUTH_REVOCATION_SYNC_OVERLAP_SECONDS = float(os.getenv("AUTH_REVOCATION_SYNC_OVERLAP_SECONDS", "30"))
+# Contraseñas: esquema y coste de los hashes nuevos (los antiguos se rehacen en el login),
+# procesos del pool de hash y operaciones pendientes admitidas antes de responder 429
+PASSWORD_SCHEME = os.getenv("PASSWORD_SCHEME", "pbkdf2_sha256")
+PASSWORD_ROUNDS = int(os.getenv("PASSWORD_ROUNDS")) if os.getenv("PASSWORD_ROUNDS") else None
+PASSWORD_HASH_PROCESSES = int(os.getenv("PASSWORD_HASH_PROCESSES")) if os.getenv("PASSWORD_HASH_PROCESSES") else None
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING")) if os.getenv("PASSWORD_HASH_MAX_PENDING") else None
+# Borrado periódico de refresh tokens caducados/revocados y de sesiones revocadas caducadas (0 = desactivado)
+TOKEN_COMPACTION_SECONDS = float(os.getenv("TOKEN_COMPACTION_SECONDS", "3600"))
+TOKEN_COMPACTION_BATCH = int(os.getenv("TOKEN_COMPACTION_BATCH", "5000"))
+
+passwords = password_hashing.HasherPasswords(
+    PASSWORD_SCHEME, PASSWORD_ROUNDS, PASSWORD_HASH_PROCESSES, PASSWORD_HASH_MAX_PENDING
+)
+metrics.registrar_estadisticas("password_hash_pool", lambda: passwords.stats, gauges=("in_flight", "processes"))
 
 class User(SQLModel, table=True):
     __table_args__ = {"extend_existing": True}
     id: Optional[int] = Field(default=None, primary_key=True)
-    username: str
+    username: str = Field(index=True)
     hashed_password: str
 
 class RefreshToken(SQLModel, table=True):
     __table_args__ = {"extend_existing": True}
     id: Optional[int] = Field(default=None, primary_key=True)
-    jti: str
-    user_id: int
-    expires_at: datetime
-    revoked: bool = False
+    jti: str = Field(index=True, unique=True)
+    user_id: int = Field(index=True)
+    # Índices para la compactación (compactacion.py): caducados o revocados
+    expires_at: datetime = Field(index=True)
+    revoked: bool = Field(default=False, index=True)
+
+class SesionRevocada(SQLModel, table=True):
+    """Sesión cerrada con /logout: sus access y refresh tokens dejan de valer aunque no hayan caducado."""
+    __table_args__ = {"extend_existing": True}
+    sid: str = Field(primary_key=True)
+    user_id: int = Field(index=True)
+    expires_at: datetime = Field(index=True)
+    revoked_at: datetime = Field(index=True)
 
 class Dataset(SQLModel, table=True):
     __table_args__ = {"extend_existing": True}
@@ -64,6 +152,19 @@ class Dataset(SQLModel, table=True):
     link: str
     logo: Optional[str] = None
 
+class DatasetArchivo(SQLModel, table=True):
+    """Fichero subido de un dataset (el contenido está en el almacén, por sha256)."""
+    __table_args__ = {"extend_existing": True}
+    dataset_id: int = Field(primary_key=True)
+    sha256: str = Field(index=True)
+    size: int
+    filename: str
+    content_type: str
+    uploaded_by: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+TIPOS_ARCHIVO = {"CSV": "text/csv", "JSON": "application/json", "XML": "application/xml"}
+
 DATASETS = [
     {
       "id": 1,
@@ -169,8 +270,26 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricasHTTP)
+
+engine = database.crear_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pre_ping=DB_POOL_PRE_PING,
+    sqlite_busy_timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+    sqlite_wal=SQLITE_WAL,
+)
+metrics.instrumentar_engine(engine)
+metrics.registrar_estadisticas(
+    "db_pool", lambda: database.estado_pool(engine), gauges=("size", "checkedin", "checkedout", "overflow")
+)
+# Con varios workers, sólo uno (el que tiene el bloqueo) ingesta el histórico y compacta los tokens
+lider_tareas = database.Liderazgo(engine, "tareas")
 
-engine = create_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+almacen_datasets = dataset_store.AlmacenDatasets(DATASET_STORE_DIR, DATASET_UPLOAD_MAX_BYTES)
 
 def get_session():
     with Session(engine) as session:
@@ -179,6 +298,12 @@ def get_session():
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # for FastAPI docs
 
 # Token helpers
+# Cada login abre una sesión (sid) que se mantiene al rotar el refresh token; /logout la revoca
+tokens_verificados = auth_cache.CacheTokens(AUTH_TOKEN_CACHE_SIZE)
+revocaciones = auth_cache.Revocaciones(AUTH_REVOCATION_SYNC_SECONDS, AUTH_REVOCATION_SYNC_OVERLAP_SECONDS)
+metrics.registrar_estadisticas("auth_token_cache", lambda: tokens_verificados.stats, gauges=("size",))
+metrics.registrar_estadisticas("auth_revocations", lambda: revocaciones.stats, gauges=("revoked",))
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     now = datetime.now(timezone.utc)
@@ -187,63 +312,171 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_refresh_token(user_id: int, expires_delta: Optional[timedelta] = None):
+def create_refresh_token(user_id: int, expires_delta: Optional[timedelta] = None, sid: Optional[str] = None):
     jti = str(uuid.uuid4())
     now = datetime.now(timezone.utc)
     expire = now + (expires_delta or timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
-    payload = {"jti": jti, "sub": str(user_id), "exp": expire, "iat": now}
+    payload = {"jti": jti, "sid": sid or jti, "sub": str(user_id), "exp": expire, "iat": now}
     token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
     return token, jti, expire
 
-def verify_access_token(token: str):
+def decode_access_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = int(payload.get("sub"))
-        return user_id
-    except JWTError:
+        int(payload.get("sub"))
+        return payload
+    except (JWTError, TypeError, ValueError):
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
 
+def verify_access_token(token: str):
+    return int(decode_access_token(token)["sub"])
+
+def _cargar_revocaciones(desde: Optional[datetime]):
+    """Sesiones revocadas (todas las vigentes o las revocadas a partir de `desde`)."""
+    consulta = select(SesionRevocada.sid, SesionRevocada.expires_at, SesionRevocada.revoked_at)
+    if desde is None:
+        consulta = consulta.where(SesionRevocada.expires_at > datetime.now(timezone.utc))
+    else:
+        consulta = consulta.where(SesionRevocada.revoked_at >= desde)
+    with Session(engine) as session:
+        return session.exec(consulta).all()
+
+def _sesion_revocada(sid: Optional[str]) -> bool:
+    revocaciones.sincronizar_si_toca(_cargar_revocaciones)
+    return sid is not None and revocaciones.revocada(sid)
+
 # Dependency: validates Authorization Bearer <access_token>
-def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
+def get_current_user(token: str = Depends(oauth2_scheme)):
+    """
+    Usuario del access token. Los tokens ya verificados se sirven de la caché
+    (sin decodificar el JWT ni abrir sesión de base de datos) hasta que caducan;
+    sólo se comprueba que su sesión no se haya cerrado.
+    """
     if not token:
         raise HTTPException(status_code=401, detail="No se ha proporcionado token")
-    user_id = verify_access_token(token)
-    user = session.get(User, user_id)
-    if not user:
-        raise HTTPException(status_code=401, detail="Usuario no válido")
+    verificado = tokens_verificados.obtener(token)
+    if verificado is None:
+        payload = decode_access_token(token)
+        with Session(engine) as session:
+            user = session.get(User, int(payload["sub"]))
+            if user is not None:
+                # Copia desligada de la sesión: se comparte entre peticiones
+                user = User(**user.model_dump())
+        if not user:
+            raise HTTPException(status_code=401, detail="Usuario no válido")
+        verificado = (user, payload.get("sid"))
+        tokens_verificados.guardar(token, verificado, float(payload["exp"]))
+    user, sid = verificado
+    if _sesion_revocada(sid):
+        raise HTTPException(status_code=401, detail="Sesión cerrada")
     return user
 
-@app.on_event("startup")
-def on_startup():
+compactador_tokens = compactacion.Compactador(
+    engine,
+    [
+        ("refresh_tokens", RefreshToken, RefreshToken.id,
+         lambda ahora: or_(RefreshToken.revoked == True, RefreshToken.expires_at < ahora)),  # noqa: E712
+        ("revoked_sessions", SesionRevocada, SesionRevocada.sid, lambda ahora: SesionRevocada.expires_at < ahora),
+    ],
+    TOKEN_COMPACTION_SECONDS,
+    TOKEN_COMPACTION_BATCH,
+    # Con varios workers compacta sólo el líder
+    debe_compactar=lider_tareas.es_lider,
+)
+metrics.registrar_estadisticas(
+    "token_compaction", lambda: compactador_tokens.stats, gauges=("refresh_tokens_rows", "revoked_sessions_rows")
+)
+
+def _crear_indices() -> None:
+    # create_all no añade índices a tablas que ya existían (bases de datos de versiones anteriores)
+    inspector = sqlalchemy.inspect(engine)
+    for tabla in SQLModel.metadata.sorted_tables:
+        existentes = {i["name"]: bool(i["unique"]) for i in inspector.get_indexes(tabla.name)}
+        for indice in tabla.indexes:
+            if indice.name in existentes and existentes[indice.name] != bool(indice.unique):
+                # Mismo índice con otra unicidad (p. ej. jti pasó a ser único): se rehace
+                indice.drop(bind=engine)
+                del existentes[indice.name]
+            if indice.name not in existentes:
+                indice.create(bind=engine)
+
+def _migrar_y_sembrar() -> None:
     SQLModel.metadata.create_all(engine)
+    _crear_indices()
     with Session(engine) as session:
-        count = session.exec(select(Dataset)).all()
-        if len(count) == 0:
+        if session.exec(select(Dataset.id).limit(1)).first() is None:
             for d in DATASETS:
-                if session.get(Dataset, d["id"]) is None:
-                    session.add(Dataset(**d))
+                session.add(Dataset(**d))
+            session.flush()
+            database.sincronizar_secuencia(session, Dataset.__tablename__)
             session.commit()
         if not session.exec(select(User).where(User.username == "admin")).first():
-            hashed = pwd_context.hash("admin")
+            with metrics.etapa("password_hash"):
+                hashed = passwords.contexto.hash("admin")
             session.add(User(username="admin", hashed_password=hashed))
             session.commit()
 
+@app.on_event("startup")
+def on_startup():
+    # Cada worker ejecuta el startup: la migración y la siembra, sólo la primera vez por versión del esquema
+    huella = database.huella_esquema(SQLModel.metadata, DATASETS)
+    if database.ejecutar_una_vez(engine, "esquema", huella, _migrar_y_sembrar):
+        print("Esquema de base de datos creado/actualizado")
+
+@app.on_event("startup")
+async def iniciar_poller():
+    # La tarea del poller vive en el event loop y publica cada consulta en la caché (y en el histórico)
+    sct_poller.start(_publicar_snapshot)
+    planificador_fuentes.start()
+    compactador_tokens.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await sct_poller.stop()
+    await planificador_fuentes.stop()
+    await compactador_tokens.stop()
+    await http_client.close()
+    passwords.cerrar()
+    lider_tareas.liberar()
+
 # --- Auth endpoints (tokens in JSON body) ---
 
+def _buscar_usuario(username: Optional[str]) -> Optional[User]:
+    with Session(engine) as session:
+        return session.exec(select(User).where(User.username == username)).first()
+
+def _abrir_sesion(user: User, nuevo_hash: Optional[str]) -> Tuple[str, str]:
+    """Guarda el refresh token de la sesión nueva (y el hash rehecho, si lo hay)."""
+    refresh_token, jti, expires_at = create_refresh_token(user.id)
+    with Session(engine) as session:
+        if nuevo_hash is not None:
+            guardado = session.get(User, user.id)
+            guardado.hashed_password = nuevo_hash
+            session.add(guardado)
+        session.add(RefreshToken(jti=jti, user_id=user.id, expires_at=expires_at, revoked=False))
+        session.commit()
+    return refresh_token, jti
+
 @app.post("/login")
-def login(data: dict, session: Session = Depends(get_session)):
+async def login(data: dict):
     username = data.get("username")
     password = data.get("password")
-    user = session.exec(select(User).where(User.username == username)).first()
-    if not user or not pwd_context.verify(password, user.hashed_password):
+    user = await run_in_threadpool(_buscar_usuario, username)
+    valida, nuevo_hash = False, None
+    if user and isinstance(password, str):
+        # La verificación (CPU) va al pool de procesos, no al threadpool ni al event loop
+        try:
+            with metrics.etapa("password_verify"):
+                valida, nuevo_hash = await passwords.verificar(password, user.hashed_password)
+        except password_hashing.PoolSaturado:
+            raise HTTPException(status_code=429, detail="Demasiados inicios de sesión simultáneos",
+                                headers={"Retry-After": "1"})
+    if not valida:
         raise HTTPException(status_code=401, detail="Usuario o contraseña incorrectos")
 
-    access_token = create_access_token({"sub": str(user.id)})
-    refresh_token, jti, expires_at = create_refresh_token(user.id)
-
-    rt = RefreshToken(jti=jti, user_id=user.id, expires_at=expires_at, revoked=False)
-    session.add(rt)
-    session.commit()
+    refresh_token, jti = await run_in_threadpool(_abrir_sesion, user, nuevo_hash)
+    # Nueva sesión: el sid es el jti del primer refresh token
+    access_token = create_access_token({"sub": str(user.id), "sid": jti})
 
     # RETURN both tokens in JSON (client will store refresh token)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer", "username": username}
@@ -256,9 +489,13 @@ def refresh(data: dict, session: Session = Depends(get_session)):
     try:
         payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
         jti = payload.get("jti")
+        sid = payload.get("sid") or jti
         user_id = int(payload.get("sub"))
-    except JWTError:
+    except (JWTError, TypeError, ValueError):
         raise HTTPException(status_code=401, detail="Refresh token inválido")
+    # Sesión cerrada: se rechaza sin ir a la base de datos
+    if _sesion_revocada(sid):
+        raise HTTPException(status_code=401, detail="Refresh token revocado o no encontrado")
 
     rt = session.exec(select(RefreshToken).where(RefreshToken.jti == jti)).first()
     if not rt or rt.revoked:
@@ -271,15 +508,15 @@ def refresh(data: dict, session: Session = Depends(get_session)):
     if expires_at < datetime.now(timezone.utc):
         raise HTTPException(status_code=401, detail="Refresh token expirado")
 
-    # rotate: revoke old and create new
+    # rotate: revoke old and create new (same session)
     rt.revoked = True
     session.add(rt)
-    new_refresh_token, new_jti, new_expires_at = create_refresh_token(user_id)
+    new_refresh_token, new_jti, new_expires_at = create_refresh_token(user_id, sid=sid)
     new_rt = RefreshToken(jti=new_jti, user_id=user_id, expires_at=new_expires_at, revoked=False)
     session.add(new_rt)
     session.commit()
 
-    access_token = create_access_token({"sub": str(user_id)})
+    access_token = create_access_token({"sub": str(user_id), "sid": sid})
     return {"access_token": access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
 
 @app.post("/logout")
@@ -289,19 +526,24 @@ def logout(data: dict, session: Session = Depends(get_session)):
         try:
             payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
             jti = payload.get("jti")
+            sid = payload.get("sid") or jti
             rt = session.exec(select(RefreshToken).where(RefreshToken.jti == jti)).first()
             if rt:
                 rt.revoked = True
                 session.add(rt)
+                # Cierra la sesión entera: también los access tokens que sigan vigentes
+                expira = datetime.fromtimestamp(payload["exp"], timezone.utc)
+                if session.get(SesionRevocada, sid) is None:
+                    session.add(SesionRevocada(sid=sid, user_id=rt.user_id, expires_at=expira,
+                                               revoked_at=datetime.now(timezone.utc)))
                 session.commit()
+                revocaciones.revocar(sid, expira.timestamp())
         except JWTError:
             pass
     return {"msg": "Logged out"}
 
 @app.get("/me")
-def me(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
-    user_id = verify_access_token(token)
-    user = session.get(User, user_id)
+def me(user: User = Depends(get_current_user)):
     return {"username": user.username}
 
 # --- Public endpoints ---
@@ -323,6 +565,9 @@ def create_dataset(payload: Dataset, user: User = Depends(get_current_user), ses
     if session.get(Dataset, payload.id):
         raise HTTPException(status_code=400, detail="Dataset con ese id ya existe")
     session.add(payload)
+    session.flush()
+    if payload.id is not None:
+        database.sincronizar_secuencia(session, Dataset.__tablename__)
     session.commit()
     session.refresh(payload)
     return payload
@@ -339,57 +584,90 @@ def upload_dataset(
     user: User = Depends(get_current_user),
     session: Session = Depends(get_session)
 ):
-    """Upload a dataset file (CSV, JSON, or XML)"""
+    """
+    Upload a dataset file (CSV, JSON, or XML).
+
+    El fichero se copia por trozos al almacén validándolo de forma incremental
+    (nunca se carga entero en memoria) y queda descargable en /datasets/{id}/file.
+    """
+    formato = format.upper()
+    if formato not in dataset_store.VALIDADORES:
+        raise HTTPException(status_code=400, detail=f"Format deve ser un de: {', '.join(dataset_store.VALIDADORES)}")
+
+    try:
+        with metrics.etapa("dataset_upload"):
+            subida = almacen_datasets.guardar(file.file, formato)
+    except dataset_store.ArchivoDemasiadoGrande as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except dataset_store.ContenidoInvalido as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {format} content: {str(e)}")
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading dataset: {str(e)}")
+
+    # Bajo el bloqueo del hash hasta el commit: un borrado concurrente de otro dataset con el
+    # mismo fichero no puede borrarlo entretanto (y si ya no estaba, se vuelve a crear)
+    try:
+        with almacen_datasets.confirmar(subida):
+            return _registrar_subida(session, subida, formato, file.filename, user, Dataset(
+                title=title,
+                description=description,
+                format=formato,
+                lastUpdate=lastUpdate,
+                category=category,
+                coverage=coverage,
+                link="",
+                logo=None
+            ))
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading dataset: {str(e)}")
+
+def _registrar_subida(
+    session: Session, subida: dataset_store.Subida, formato: str, nombre: Optional[str], user: User, new_dataset: Dataset
+) -> Dataset:
     try:
-        # Validate file format
-        allowed_formats = ['CSV', 'JSON', 'XML']
-        if format.upper() not in allowed_formats:
-            raise HTTPException(status_code=400, detail=f"Format deve ser un de: {', '.join(allowed_formats)}")
-        
-        # Read file content
-        content = file.file.read()
-        
-        # Validate content based on format
-        try:
-            if format.upper() == 'JSON':
-                json.loads(content if isinstance(content, str) else content.decode('utf-8'))
-            elif format.upper() == 'CSV':
-                # Basic CSV validation
-                text_content = content if isinstance(content, str) else content.decode('utf-8')
-                csv.reader(StringIO(text_content))
-            elif format.upper() == 'XML':
-                ET.fromstring(content)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid {format} content: {str(e)}")
-        
-        # Generate next ID
-        existing = session.exec(select(Dataset)).all()
-        next_id = max([d.id for d in existing], default=0) + 1
-        
-        # Create dataset record
-        new_dataset = Dataset(
-            id=next_id,
-            title=title,
-            description=description,
-            format=format.upper(),
-            lastUpdate=lastUpdate,
-            category=category,
-            coverage=coverage,
-            link=f"uploaded_by_{user.username}",
-            logo=None
-        )
-        
         session.add(new_dataset)
+        # El id lo asigna la base de datos (autoincremento) al insertar: único aunque haya
+        # subidas concurrentes o varios workers, y sin leer el catálogo entero
+        session.flush()
+        next_id = new_dataset.id
+        new_dataset.link = f"/datasets/{next_id}/file"
+        session.add(DatasetArchivo(
+            dataset_id=next_id,
+            sha256=subida.sha256,
+            size=subida.tamano,
+            filename=os.path.basename(nombre or "") or f"dataset_{next_id}.{formato.lower()}",
+            content_type=TIPOS_ARCHIVO[formato],
+            uploaded_by=user.username,
+        ))
         session.commit()
         session.refresh(new_dataset)
-        
         return new_dataset
-    
-    except HTTPException:
-        raise
     except Exception as e:
+        session.rollback()
+        # Ya con el bloqueo del hash (confirmar)
+        if not _contenido_en_uso(session, subida.sha256):
+            almacen_datasets.eliminar(subida.sha256)
         raise HTTPException(status_code=500, detail=f"Error uploading dataset: {str(e)}")
 
+def _contenido_en_uso(session: Session, sha256: str) -> bool:
+    # El contenido se comparte entre datasets con el mismo fichero: sólo se borra si ya nadie lo usa
+    return session.exec(select(DatasetArchivo.dataset_id).where(DatasetArchivo.sha256 == sha256).limit(1)).first() is not None
+
+@app.get("/datasets/{dataset_id}/file")
+def download_dataset_file(dataset_id: int, session: Session = Depends(get_session)):
+    archivo = session.get(DatasetArchivo, dataset_id)
+    if not archivo or not almacen_datasets.existe(archivo.sha256):
+        raise HTTPException(status_code=404, detail="Fichero no encontrado")
+    return FileResponse(
+        almacen_datasets.ruta(archivo.sha256),
+        media_type=archivo.content_type,
+        headers={
+            "Content-Disposition": _content_disposition("attachment", archivo.filename),
+            # Contenido inmutable: el hash sirve de ETag
+            "ETag": f'"{archivo.sha256}"',
+        },
+    )
+
 @app.put("/datasets/{dataset_id}", response_model=Dataset)
 def update_dataset(dataset_id: int, payload: Dataset, user: User = Depends(get_current_user), session: Session = Depends(get_session)):
     existing = session.get(Dataset, dataset_id)
@@ -407,8 +685,13 @@ def delete_dataset(dataset_id: int, user: User = Depends(get_current_user), sess
     existing = session.get(Dataset, dataset_id)
     if not existing:
         raise HTTPException(status_code=404, detail="Dataset no encontrado")
+    archivo = session.get(DatasetArchivo, dataset_id)
     session.delete(existing)
+    if archivo:
+        session.delete(archivo)
     session.commit()
+    if archivo:
+        almacen_datasets.eliminar_si_sin_uso(archivo.sha256, lambda: _contenido_en_uso(session, archivo.sha256))
     return
 
 @app.get("/configuracion")
@@ -417,37 +700,543 @@ def configuracion(user: User = Depends(get_current_user)):
 
 
 # --- Incidències de trànsit (SCT) ---
-def _safe_incidencies_detallades() -> List[dict]:
-    """Obtiene incidencias detalladas manejando errores de red/XML."""
+# Un único snapshot del feed compartido por todos los endpoints (la lista no se debe modificar).
+# El poller lo refresca en segundo plano con GET condicional; si el snapshot caduca, la caché le pide
+# una consulta inmediata y espera el resultado (la descarga siempre la hace la tarea asíncrona del poller).
+def _construir_snapshot_sct(incidencias: List[dict]) -> FeedSnapshot:
+    """Snapshot del feed parseado, actualizando el índice de agregados a partir del anterior."""
+    anterior = incidencias_cache.peek()
+    return construir_snapshot(incidencias, anterior.value if anterior else None)
+
+
+sct_poller = FeedPoller(
+    SCT_FEED_URL, parsear_incidencias_detalladas, interval=SCT_FEED_POLL_SECONDS, construir=_construir_snapshot_sct,
+)
+incidencias_cache = SnapshotCache(
+    loader=sct_poller.actualizar,
+    ttl=SCT_FEED_TTL_SECONDS,
+    stale_ttl=SCT_FEED_STALE_SECONDS,
+    wait_timeout=SCT_FEED_WAIT_SECONDS,
+)
+
+
+_SNAPSHOT_VACIO = FeedSnapshot([], IndiceIncidencias(), TablaIncidencias())
+
+
+@metrics.medir("historial_ingest")
+def _ingestar_historial(incidencias: List[dict]) -> dict:
+    with Session(engine) as session:
+        return historial.ingestar_snapshot(session, incidencias)
+
+
+incidencias_difusor = incident_stream.Difusor(SCT_STREAM_MAX_SUBSCRIBERS, SCT_STREAM_QUEUE_SIZE)
+
+# Contadores propios de cada componente, expuestos en /metrics al hacer scrape
+# (las claves de `gauges` son un estado actual, no un acumulado)
+GAUGES_POLLER = ("last_status", "last_bytes")
+metrics.registrar_estadisticas("feed_poller", lambda: sct_poller.stats, gauges=GAUGES_POLLER)
+metrics.registrar_estadisticas("stream", incidencias_difusor.status, gauges=("subscribers", "version"))
+
+# Resto de fuentes: cada una con su poller; todas (también el SCT) publican en el mismo almacén normalizado
+almacen_fuentes = fuentes.AlmacenFuentes()
+planificador_fuentes = fuentes.Planificador(
+    fuentes.adaptadores_catalogo(
+        {
+            nombre: url for nombre, url in (("rodalies", RODALIES_FEED_URL), ("dgt", DGT_FEED_URL))
+            if nombre in FUENTES_ACTIVAS
+        },
+        timeout=FUENTES_TIMEOUT_SECONDS,
+        reintentos=FUENTES_RETRIES,
+    ),
+    almacen_fuentes,
+)
+for _nombre, _poller in planificador_fuentes.pollers.items():
+    metrics.registrar_estadisticas(f"source_{_nombre}", lambda poller=_poller: poller.stats, gauges=GAUGES_POLLER)
+metrics.registrar_estadisticas(
+    "source_merge", lambda: almacen_fuentes.fusion.stats, gauges=("groups", "members", "merged")
+)
+
+
+def _preparar_publicacion(snapshot: FeedSnapshot, anteriores: List[dict]) -> dict:
+    """Trabajo de CPU previo a publicar: respuestas serializadas y delta respecto al anterior."""
+    with metrics.etapa("precompute_responses"):
+        _precalcular_respuestas(snapshot)
+    with metrics.etapa("stream_delta"):
+        return incident_stream.calcular_delta(anteriores, snapshot.incidencias)
+
+
+async def _publicar_snapshot(snapshot: FeedSnapshot) -> None:
+    """Publica el snapshot en la caché, difunde el delta a los suscriptores y lo guarda en el histórico."""
+    anterior = incidencias_cache.peek()
+    if anterior is not None and anterior.value is snapshot:
+        incidencias_cache.set(snapshot)
+        return
+    # Las respuestas se serializan antes de publicar para que las peticiones encuentren los bytes listos
+    anteriores = anterior.value.incidencias if anterior is not None else []
+    delta = await run_in_threadpool(_preparar_publicacion, snapshot, anteriores)
+    # Sin await entre medias: un suscriptor nuevo ve el snapshot y la versión del delta que ya contiene
+    incidencias_cache.set(snapshot)
+    metrics.snapshot_incidencias.set(len(snapshot.incidencias))
+    if not incident_stream.delta_vacio(delta):
+        incidencias_difusor.publicar_delta(delta)
+    # Vista combinada con el resto de fuentes (fusión incremental de los cambios)
+    await run_in_threadpool(almacen_fuentes.actualizar, "sct", snapshot.incidencias)
+    if not SCT_HISTORIAL_ENABLED or not await run_in_threadpool(lider_tareas.es_lider):
+        return
+    try:
+        await run_in_threadpool(_ingestar_historial, snapshot.incidencias)
+    except Exception as exc:
+        print(f"Error guardando el histórico de incidencias: {exc}")
+
+
+async def _safe_snapshot() -> FeedSnapshot:
+    """
+    Obtiene el snapshot actual (incidencias + índice) manejando errores de red/XML.
+    Es async para que esperar al feed (arranque en frío) no ocupe hilos del threadpool.
+    """
     try:
-        incidencies = extraer_coordenadas_con_detalles()
-        return incidencies or []
+        return await incidencias_cache.get_async() or _SNAPSHOT_VACIO
     except Exception as exc:  # pragma: no cover - logging prop
         print(f"Error obtenint incidencies: {exc}")
-        return []
+        return _SNAPSHOT_VACIO
 
 
-def _parse_nivel(valor) -> int:
-    try:
-        return int(valor)
-    except Exception:
-        return 0
+async def _snapshot_fuente(source: Optional[str] = None) -> FeedSnapshot:
+    """
+    Snapshot SCT actual o, con source=all, la vista combinada de todas las
+    fuentes (sin duplicados, ver fusion.py).
+    """
+    if source == "all":
+        return await run_in_threadpool(almacen_fuentes.combinado)
+    if source not in (None, "", "live"):
+        raise HTTPException(status_code=400, detail="source debe ser live o all")
+    return await _safe_snapshot()
+
+
+async def _safe_indice(source: Optional[str] = None) -> IndiceIncidencias:
+    """Índice de agregados del snapshot SCT actual o de la vista combinada (source=all)."""
+    return (await _snapshot_fuente(source)).indice
+
+
+async def _respuesta_snapshot(request: Request, clave: str) -> Response:
+    """Respuesta JSON precalculada del snapshot actual (serializada una vez por snapshot)."""
+    snapshot = await _safe_snapshot()
+    respuesta = snapshot.respuestas.get(clave)
+    if respuesta is None:
+        construir = _RESPUESTAS_SNAPSHOT[clave]
+        respuesta = await run_in_threadpool(snapshot.respuestas.obtener, clave, lambda: construir(snapshot))
+    return json_cache.responder(request, respuesta)
+
+
+def _construir_raw(snapshot: FeedSnapshot) -> dict:
+    return {"incidencies": snapshot.incidencias, "total": len(snapshot.incidencias)}
 
 
 @app.get("/api/incidencies/raw")
-def api_incidencies_raw():
-    incidencies = _safe_incidencies_detallades()
-    return {"incidencies": incidencies, "total": len(incidencies)}
+async def api_incidencies_raw(
+    request: Request,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    carretera: Optional[str] = None,
+    tipo: Optional[str] = None,
+    causa: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+):
+    """
+    Incidencias del snapshot actual. Sin parámetros devuelve todas (respuesta precalculada);
+    con paginación, proyección (fields=) o filtros devuelve una página en orden de
+    identificador con next_cursor para pedir la siguiente.
+    """
+    # Sólo los parámetros propios: otros (?_= para saltar cachés...) no deben paginar la respuesta
+    if all(v is None for v in (limit, cursor, fields, carretera, tipo, causa, nivel_min, nivel_max, desde, hasta)):
+        return await _respuesta_snapshot(request, "raw")
+
+    campos = paginacion.parse_fields(fields, CAMPOS_DETALLE)
+    limite = paginacion.limitar(limit)
+    posicion = paginacion.decodificar_cursor(cursor)
+    despues_de = None
+    if posicion is not None:
+        try:
+            despues_de = (str(posicion["id"]), int(posicion["fila"]))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+    inicio, fin = _parse_instante(desde), _parse_instante(hasta)
+
+    snapshot = await _safe_snapshot()
+    tabla = snapshot.tabla
+    # Filtros vectorizados sobre la tabla columnar (códigos categóricos, nivel int8, fecha epoch)
+    mascara = tabla.mascara_rango_nivel(nivel_min, nivel_max)
+    for campo, valor in (("carretera", carretera), ("tipo", tipo), ("causa", causa)):
+        if valor is not None:
+            mascara &= tabla.mascara_igual(campo, valor)
+    if inicio is not None or fin is not None:
+        mascara &= tabla.mascara_rango_data(
+            inicio.timestamp() if inicio else None, fin.timestamp() if fin else None
+        )
 
+    filas, siguiente = tabla.pagina(mascara, despues_de, limite)
+    incidencias = snapshot.incidencias
+    return {
+        "incidencies": paginacion.proyectar((incidencias[i] for i in filas), campos),
+        "total": int(mascara.sum()),
+        "next_cursor": paginacion.codificar_cursor({"id": siguiente[0], "fila": siguiente[1]}) if siguiente else None,
+    }
+
+
+@app.get("/api/incidencies/stream")
+async def api_incidencies_stream(request: Request):
+    """
+    Server-Sent Events: un evento 'snapshot' con todas las incidencias (mismo cuerpo que /raw)
+    y después eventos 'delta' con added/updated/resolved por identificador.
+    El id de cada evento es la versión; los deltas se aplican en orden sobre el snapshot.
+    """
+    suscriptor = incidencias_difusor.suscribir()
+    if suscriptor is None:
+        raise HTTPException(status_code=503, detail="Demasiadas conexiones al stream de incidencias")
+    try:
+        snapshot = await _safe_snapshot()
+        # Versión leída sin await de por medio tras obtener el snapshot publicado
+        version = incidencias_difusor.version
+        respuesta = snapshot.respuestas.get("raw")
+        if respuesta is None:
+            respuesta = await run_in_threadpool(snapshot.respuestas.obtener, "raw", lambda: _construir_raw(snapshot))
+    except BaseException:
+        incidencias_difusor.cancelar(suscriptor)
+        raise
+    return StreamingResponse(
+        incidencias_difusor.emitir(suscriptor, respuesta.body, version),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/incidencies/feed-status")
+def api_incidencies_feed_status():
+    """Estado del poller del feed SCT y de la caché de snapshots"""
+    snap = incidencias_cache.peek()
+    return {
+        "poller": sct_poller.status(),
+        "stream": incidencias_difusor.status(),
+        "cache": {
+            **incidencias_cache.stats,
+            "age_seconds": round(snap.age(), 2) if snap else None,
+            "last_error": incidencias_cache.last_error,
+        },
+    }
+
+
+@app.get("/api/fuentes")
+def api_fuentes():
+    """Estado de cada fuente de incidencias: planificación, última consulta y registros normalizados"""
+    almacenadas = almacen_fuentes.fuentes()
+    return {
+        "sct": {
+            "dataset_id": 2,
+            **sct_poller.status(),
+            **almacenadas.get("sct", {"incidencies": 0, "updated": None}),
+        },
+        **planificador_fuentes.status(),
+    }
+
+
+@app.get("/api/fuentes/incidencies")
+async def api_fuentes_incidencies(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    fuente: Optional[str] = None,
+    carretera: Optional[str] = None,
+    tipo: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+):
+    """Incidencias actuales de todas las fuentes en el esquema común, paginadas por cursor (next_cursor)."""
+    campos = paginacion.parse_fields(fields, fuentes.CAMPOS_FUENTE)
+    limite = paginacion.limitar(limit)
+    posicion = paginacion.decodificar_cursor(cursor)
+    despues_de = None
+    if posicion is not None:
+        try:
+            despues_de = (str(posicion["id"]), int(posicion["fila"]))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+
+    # La vista combinada se reconstruye (CPU) la primera vez tras cambiar alguna fuente
+    combinado = await run_in_threadpool(almacen_fuentes.combinado)
+    incidencias, tabla = combinado.incidencias, combinado.tabla
+    mascara = tabla.mascara_rango_nivel(nivel_min, nivel_max)
+    for campo, valor in (("fuente", fuente), ("carretera", carretera), ("tipo", tipo)):
+        if valor is not None:
+            mascara &= tabla.mascara_igual(campo, valor)
+    filas, siguiente = tabla.pagina(mascara, despues_de, limite)
+    return {
+        "incidencies": paginacion.proyectar((incidencias[i] for i in filas), campos),
+        "total": int(mascara.sum()),
+        "next_cursor": paginacion.codificar_cursor({"id": siguiente[0], "fila": siguiente[1]}) if siguiente else None,
+    }
+
+
+def _estadisticas_cache() -> dict:
+    snap = incidencias_cache.peek()
+    return {**incidencias_cache.stats, "age_seconds": round(snap.age(), 2) if snap else None}
+
+
+metrics.registrar_estadisticas("snapshot_cache", _estadisticas_cache)
 
-@app.get("/api/incidencies/summary")
-def api_incidencies_summary():
-    incidencies = _safe_incidencies_detallades()
-    total = len(incidencies)
-    greus = sum(1 for inc in incidencies if _parse_nivel(inc.get("nivel")) >= 3)
-    percent_greus = (greus / total * 100) if total else 0.0
 
-    carretera_counts = Counter(str(inc.get("carretera") or "Desconeguda") for inc in incidencies)
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Métricas en formato de texto de Prometheus (latencias, upstream, etapas, BD, threadpool)."""
+    cuerpo, content_type = metrics.exponer()
+    return Response(content=cuerpo, media_type=content_type)
+
+
+# --- Histórico de incidencias ---
+
+def _parse_instante(valor: Optional[str]) -> Optional[datetime]:
+    """Acepta ISO 8601 o epoch en milisegundos (formato de Grafana); devuelve un datetime UTC."""
+    if valor is None or valor == "":
+        return None
+    try:
+        if valor.lstrip("-").isdigit():
+            return datetime.fromtimestamp(int(valor) / 1000, tz=timezone.utc)
+        instante = datetime.fromisoformat(valor.replace("Z", "+00:00"))
+    except (ValueError, OverflowError, OSError):
+        raise HTTPException(status_code=400, detail=f"Fecha no válida: {valor}")
+    if instante.tzinfo is None:
+        return instante.replace(tzinfo=timezone.utc)
+    return instante.astimezone(timezone.utc)
+
+
+def _rango_historial(desde: Optional[str], hasta: Optional[str], horas_por_defecto: int = 24):
+    fin = _parse_instante(hasta) or historial.ahora_utc()
+    inicio = _parse_instante(desde) or fin - timedelta(hours=horas_por_defecto)
+    if inicio > fin:
+        raise HTTPException(status_code=400, detail="'desde' debe ser anterior a 'hasta'")
+    return inicio, fin
+
+
+def _consultar_historial(funcion, *args, **kwargs):
+    with Session(engine) as session:
+        return funcion(session, *args, **kwargs)
+
+
+def _historial_nuevas_si_cubre(desde: datetime, hasta: datetime) -> Optional[int]:
+    """Incidencias aparecidas en el rango, o None si el histórico no cubre todo el rango."""
+    with Session(engine) as session:
+        primera = historial.cobertura(session)
+        if primera is None or primera > desde:
+            return None
+        return len(historial.nuevas_en_rango(session, desde, hasta))
+
+
+_CAMPOS_HISTORIAL = list(historial.IncidenciaHistorial.model_fields)
+
+
+@app.get("/api/historial/incidencies")
+async def api_historial_incidencies(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    bbox: Optional[str] = None,
+    carretera: Optional[str] = None,
+    tipo: Optional[str] = None,
+    causa: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+):
+    """
+    Incidencias activas en algún momento del rango (por defecto, las últimas 24h),
+    de la más reciente a la más antigua, paginadas por cursor (next_cursor).
+    """
+    posicion = paginacion.decodificar_cursor(cursor)
+    despues_de = None
+    if posicion is not None:
+        # El cursor fija el rango de la primera página para que las siguientes sean coherentes
+        desde, hasta = posicion.get("desde"), posicion.get("hasta")
+        try:
+            despues_de = (_parse_instante(posicion["t"]), int(posicion["id"]))
+        except (KeyError, TypeError, ValueError, HTTPException):
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+    inicio, fin = _rango_historial(desde, hasta)
+    limite = paginacion.limitar(limit)
+    campos = paginacion.parse_fields(fields, _CAMPOS_HISTORIAL)
+    try:
+        zona = spatial_index.parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filtros = dict(carretera=carretera, tipo=tipo, causa=causa, nivel_min=nivel_min, nivel_max=nivel_max)
+    filas = await run_in_threadpool(
+        _consultar_historial, historial.incidencias_en_rango, inicio, fin, limite + 1, zona, despues_de, **filtros
+    )
+    # Total de todas las páginas (mismos filtros, sin cursor), no el tamaño de ésta
+    total = await run_in_threadpool(_consultar_historial, historial.contar_en_rango, inicio, fin, zona, **filtros)
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        ultima = filas[-1]
+        siguiente = paginacion.codificar_cursor({
+            "t": ultima.first_seen.isoformat(), "id": ultima.id,
+            "desde": inicio.isoformat(), "hasta": fin.isoformat(),
+        })
+    return {
+        "desde": inicio.isoformat(),
+        "hasta": fin.isoformat(),
+        "incidencies": paginacion.proyectar((fila.model_dump() for fila in filas), campos),
+        "total": total,
+        "next_cursor": siguiente,
+    }
+
+
+@app.get("/grafana/historial/per-hour")
+async def grafana_historial_per_hour(desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Incidencias nuevas por hora según el histórico (serie temporal)"""
+    inicio, fin = _rango_historial(desde, hasta)
+    return await run_in_threadpool(_consultar_historial, historial.por_hora, inicio, fin)
+
+
+@app.get("/grafana/historial/by-weekday")
+async def grafana_historial_by_weekday(desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Incidencias por día de la semana según el histórico (por defecto, los últimos 30 días)"""
+    inicio, fin = _rango_historial(desde, hasta, horas_por_defecto=24 * 30)
+    por_dia = await run_in_threadpool(_consultar_historial, historial.por_dia_semana, inicio, fin)
+    return [{"day": day, "count": por_dia.get(i, 0)} for i, day in enumerate(DIAS_SEMANA)]
+
+
+def _ranking_trams_historial(desde: datetime, hasta: datetime, longitud_km: float, top: int,
+                             carretera: Optional[str], nivel_min: Optional[int]) -> list:
+    with Session(engine) as session:
+        detalles = historial.detalles_en_rango(session, desde, hasta)
+    return _ranking_trams(pk_index.IndicePK(TablaIncidencias(detalles)), longitud_km, top, carretera, nivel_min)
+
+
+@app.get("/api/historial/ranking_trams")
+async def api_historial_ranking_trams(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    longitud_km: float = pk_index.LONGITUD_TRAMO_KM,
+    top: int = 10,
+    carretera: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+):
+    """Ranking de tramos (por PK) con las incidencias activas en el rango (por defecto, los últimos 30 días)"""
+    inicio, fin = _rango_historial(desde, hasta, horas_por_defecto=24 * 30)
+    ranking = await run_in_threadpool(
+        _ranking_trams_historial, inicio, fin, longitud_km, max(1, min(top, 1000)), carretera, nivel_min
+    )
+    return {"desde": inicio.isoformat(), "hasta": fin.isoformat(), "trams": ranking}
+
+
+# --- Dataset RACC (Excel) ---
+racc = racc_dataset.AlmacenRACC(RACC_XLSX_PATH, RACC_CACHE_DIR)
+metrics.registrar_estadisticas("racc", lambda: racc.stats, gauges=("rows",))
+
+
+async def _tabla_racc() -> racc_dataset.TablaRACC:
+    # La primera llamada (o tras cambiar el Excel) puede convertir el fichero: fuera del event loop
+    try:
+        return await run_in_threadpool(racc.tabla)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Dataset RACC no disponible")
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"Error leyendo el dataset RACC: {str(e)}")
+
+
+def _mascara_racc(
+    tabla: racc_dataset.TablaRACC,
+    via: Optional[str], poblacio: Optional[str], tipus: Optional[str], sentit: Optional[str],
+    dia_setmana: Optional[str], nivel_min: Optional[int], nivel_max: Optional[int],
+    desde: Optional[str], hasta: Optional[str],
+):
+    filtros = {
+        campo: valor for campo, valor in (
+            ("via", via), ("poblacio", poblacio), ("tipus", tipus), ("sentit", sentit), ("dia_setmana", dia_setmana),
+        ) if valor is not None
+    }
+    inicio, fin = _parse_instante(desde), _parse_instante(hasta)
+    return tabla.mascara(
+        filtros, nivel_min, nivel_max,
+        inicio.timestamp() if inicio else None, fin.timestamp() if fin else None,
+    )
+
+
+@app.get("/api/racc/incidencies")
+async def api_racc_incidencies(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    via: Optional[str] = None,
+    poblacio: Optional[str] = None,
+    tipus: Optional[str] = None,
+    sentit: Optional[str] = None,
+    dia_setmana: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+):
+    """Incidencias del dataset RACC filtradas, en el orden del Excel y paginadas por cursor (next_cursor)."""
+    posicion = paginacion.decodificar_cursor(cursor)
+    despues_de = -1
+    if posicion is not None:
+        try:
+            despues_de = int(posicion["fila"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+    limite = paginacion.limitar(limit)
+
+    tabla = await _tabla_racc()
+    mascara = _mascara_racc(tabla, via, poblacio, tipus, sentit, dia_setmana, nivel_min, nivel_max, desde, hasta)
+    filas, siguiente = tabla.pagina(mascara, despues_de, limite)
+    return {
+        "incidencies": tabla.filas(filas),
+        "total": int(mascara.sum()),
+        "next_cursor": paginacion.codificar_cursor({"fila": siguiente}) if siguiente is not None else None,
+    }
+
+
+@app.get("/api/racc/estadistiques")
+async def api_racc_estadistiques(
+    per: Optional[str] = None,
+    top: Optional[int] = None,
+    via: Optional[str] = None,
+    poblacio: Optional[str] = None,
+    tipus: Optional[str] = None,
+    sentit: Optional[str] = None,
+    dia_setmana: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    nivel_max: Optional[int] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+):
+    """
+    Resumen y conteos del dataset RACC por via, poblacio, tipus, sentit, nivel o
+    dia_setmana (per=a,b; por defecto todas), con los mismos filtros que /api/racc/incidencies.
+    """
+    dimensiones = paginacion.parse_fields(per, racc_dataset.DIMENSIONES) or list(racc_dataset.DIMENSIONES)
+    tabla = await _tabla_racc()
+    mascara = _mascara_racc(tabla, via, poblacio, tipus, sentit, dia_setmana, nivel_min, nivel_max, desde, hasta)
+    resultado = tabla.resumen(mascara)
+    for dimension in dimensiones:
+        conteo = tabla.contar_por(dimension, mascara)
+        resultado[f"per_{dimension}"] = [
+            {dimension: valor, "count": total} for valor, total in (conteo[:top] if top else conteo)
+        ]
+    return resultado
+
+
+def _construir_summary(snapshot: FeedSnapshot) -> dict:
+    indice = snapshot.indice
+    total = indice.total
+
+    carretera_counts = Counter()
+    for carretera, count in indice.por_carretera.items():
+        carretera_counts[str(carretera or "Desconeguda")] += count
     top = carretera_counts.most_common(1)
     via_mes_afectada = None
     if top:
@@ -456,72 +1245,121 @@ def api_incidencies_summary():
 
     return {
         "total_incidents": total,
-        "percent_greus": percent_greus,
+        "percent_greus": (indice.graves / total * 100) if total else 0.0,
         "via_mes_afectada": via_mes_afectada,
     }
 
 
-@app.get("/api/incidencies/by_tipo")
-def api_incidencies_by_tipo():
-    incidencies = _safe_incidencies_detallades()
-    counts = Counter(str(inc.get("tipo") or "Desconegut") for inc in incidencies)
+@app.get("/api/incidencies/summary")
+async def api_incidencies_summary(request: Request):
+    return await _respuesta_snapshot(request, "summary")
+
+
+def _construir_by_tipo(snapshot: FeedSnapshot) -> list:
+    counts = Counter()
+    for tipo, total in snapshot.indice.por_tipo.items():
+        counts[str(tipo or "Desconegut")] += total
     return [
         {"tipo": tipo, "count": total}
         for tipo, total in counts.most_common()
     ]
 
 
-@app.get("/api/incidencies/by_nivel")
-def api_incidencies_by_nivel():
-    incidencies = _safe_incidencies_detallades()
-    counts = Counter(_parse_nivel(inc.get("nivel")) for inc in incidencies)
-    ordered = sorted(counts.items(), key=lambda x: x[0])
+@app.get("/api/incidencies/by_tipo")
+async def api_incidencies_by_tipo(request: Request):
+    return await _respuesta_snapshot(request, "by_tipo")
+
+
+def _construir_by_nivel(snapshot: FeedSnapshot) -> list:
+    ordered = sorted(snapshot.indice.por_nivel.items(), key=lambda x: x[0])
     return [{"nivel": nivel, "count": total} for nivel, total in ordered]
 
 
+@app.get("/api/incidencies/by_nivel")
+async def api_incidencies_by_nivel(request: Request):
+    return await _respuesta_snapshot(request, "by_nivel")
+
+
+def _construir_ranking_trams(snapshot: FeedSnapshot) -> list:
+    return snapshot.lineal.ranking_tramos(pk_index.LONGITUD_TRAMO_KM, 10)
+
+
+def _ranking_trams(
+    lineal: pk_index.IndicePK,
+    longitud_km: float,
+    top: int,
+    carretera: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+) -> list:
+    mascara = lineal.tabla.mascara_rango_nivel(nivel_min) if nivel_min is not None else None
+    try:
+        return lineal.ranking_tramos(longitud_km, top, carretera, mascara)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/incidencies/ranking_trams")
-def api_incidencies_ranking_trams():
-    incidencies = _safe_incidencies_detallades()
-    ranking = {}
-
-    for inc in incidencies:
-        carretera = str(inc.get("carretera") or "Desconeguda")
-        info = ranking.setdefault(
-            carretera,
-            {"carretera": carretera, "incidents": 0, "max_nivel": 0, "_tipos": Counter()},
-        )
-        info["incidents"] += 1
-        info["max_nivel"] = max(info["max_nivel"], _parse_nivel(inc.get("nivel")))
-        info["_tipos"].update([str(inc.get("tipo") or "Desconegut")])
-
-    resultado = []
-    for carretera, data in ranking.items():
-        tipo_principal = None
-        if data["_tipos"]:
-            tipo_principal = data["_tipos"].most_common(1)[0][0]
-        resultado.append(
-            {
-                "carretera": carretera,
-                "incidents": data["incidents"],
-                "max_nivel": data["max_nivel"],
-                "tipo_principal": tipo_principal,
-            }
-        )
+async def api_incidencies_ranking_trams(
+    request: Request,
+    longitud_km: Optional[float] = None,
+    top: Optional[int] = None,
+    carretera: Optional[str] = None,
+    nivel_min: Optional[int] = None,
+    source: Optional[str] = None,
+):
+    """
+    Tramos de carretera (de longitud_km, por PK; 5 por defecto) con más incidencias y, a igualdad,
+    más severidad (top 10 por defecto). Sin parámetros devuelve la respuesta precalculada del snapshot.
+    """
+    if all(v is None for v in (longitud_km, top, carretera, nivel_min, source)):
+        return await _respuesta_snapshot(request, "ranking_trams")
+    longitud_km = pk_index.LONGITUD_TRAMO_KM if longitud_km is None else longitud_km
+    top = 10 if top is None else top
+    snapshot = await _snapshot_fuente(source)
+    return await run_in_threadpool(_ranking_trams, snapshot.lineal, longitud_km, max(1, min(top, 1000)), carretera, nivel_min)
+
+
+@app.get("/api/incidencies/tram")
+async def api_incidencies_tram(
+    carretera: str,
+    pk_desde: Optional[float] = None,
+    pk_hasta: Optional[float] = None,
+    fields: Optional[str] = None,
+    source: Optional[str] = None,
+):
+    """Incidencias de la carretera cuyo tramo de PK se solapa con [pk_desde, pk_hasta]."""
+    desde = float("-inf") if pk_desde is None else pk_desde
+    hasta = float("inf") if pk_hasta is None else pk_hasta
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="pk_desde debe ser menor o igual que pk_hasta")
+    campos = paginacion.parse_fields(fields, fuentes.CAMPOS_FUENTE if source == "all" else CAMPOS_DETALLE)
+    snapshot = await _snapshot_fuente(source)
+    filas = snapshot.lineal.consultar(carretera, desde, hasta)
+    incidencias = snapshot.incidencias
+    return {
+        "carretera": carretera,
+        "incidencies": paginacion.proyectar((incidencias[i] for i in filas.tolist()), campos),
+        "total": len(filas),
+    }
 
-    resultado.sort(key=lambda x: x["incidents"], reverse=True)
-    return resultado[:10]
+
+def _construir_coordenadas(snapshot: FeedSnapshot) -> dict:
+    coordenadas = [{"lat": inc["lat"], "lon": inc["lon"], "tipo": "point"} for inc in snapshot.incidencias]
+    return {"coordenadas": coordenadas, "total": len(coordenadas)}
 
 @app.get("/coordenadas")
-def obtener_coordenadas():
+async def obtener_coordenadas(request: Request):
     """Endpoint público que obtiene coordenadas en tiempo real del XML de incidencias"""
-    coordenadas = extraer_coordenadas_xml()
-    return {"coordenadas": coordenadas, "total": len(coordenadas)}
+    return await _respuesta_snapshot(request, "coordenadas")
+
+
+def _construir_incidencias(snapshot: FeedSnapshot) -> dict:
+    return {"incidencias": snapshot.incidencias, "total": len(snapshot.incidencias)}
 
 @app.get("/incidencias")
-def obtener_incidencias():
+async def obtener_incidencias(request: Request):
     """Endpoint público que obtiene incidencias con detalles del XML"""
-    incidencias = extraer_coordenadas_con_detalles()
-    return {"incidencias": incidencias, "total": len(incidencias)}
+    return await _respuesta_snapshot(request, "incidencias")
 
 @app.post("/chatbot/ask")
 async def chatbot_ask(data: dict):
@@ -537,7 +1375,7 @@ async def chatbot_ask(data: dict):
     }
     payload = { "inputs": prompt }
     try:
-        response = requests.post(HF_ENDPOINT, headers=headers, json=payload, timeout=60)
+        response = await http_client.post(HF_ENDPOINT, headers=headers, json=payload, timeout=60)
         response.raise_for_status()
         data = response.json()
         # El formato puede variar según el modelo
@@ -555,55 +1393,107 @@ async def chatbot_ask(data: dict):
 
 # ==================== FUNCIONES XML TO TXT ====================
 
-def descargar_xml(url: str) -> str:
+async def descargar_xml(url: str) -> str:
     """Descarga un archivo XML de una URL"""
     try:
-        response = requests.get(url, timeout=10)
+        response = await http_client.get(url, timeout=10)
         response.raise_for_status()
         return response.text
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=400, detail=f"Error descargando XML: {str(e)}")
 
+@metrics.medir("xml_to_txt")
 def xml_to_txt(xml_content: str) -> str:
-    """Convierte contenido XML a formato TXT legible"""
+    """Convierte contenido XML a formato TXT legible (la conversión en streaming está en xml_txt)"""
     try:
-        # Parsear el XML
-        root = etree.fromstring(xml_content.encode('utf-8'))
-        
-        output = StringIO()
-        output.write("=" * 80 + "\n")
-        output.write("CONTENIDO XML CONVERTIDO A TXT\n")
-        output.write("=" * 80 + "\n\n")
-        
-        # Procesar recursivamente los elementos
-        def procesar_elemento(elemento, nivel=0):
-            indentacion = "  " * nivel
-            
-            # Escribir nombre del elemento
-            output.write(f"{indentacion}[{elemento.tag}]\n")
-            
-            # Escribir atributos si existen
-            if elemento.attrib:
-                for attr_name, attr_value in elemento.attrib.items():
-                    output.write(f"{indentacion}  @{attr_name}: {attr_value}\n")
-            
-            # Escribir texto del elemento
-            if elemento.text and elemento.text.strip():
-                output.write(f"{indentacion}  > {elemento.text.strip()}\n")
-            
-            # Procesar elementos hijos
-            for hijo in elemento:
-                procesar_elemento(hijo, nivel + 1)
-                # Escribir texto de cola (tail) si existe
-                if hijo.tail and hijo.tail.strip():
-                    output.write(f"{indentacion}  {hijo.tail.strip()}\n")
-        
-        procesar_elemento(root)
-        output.write("\n" + "=" * 80 + "\n")
-        
-        return output.getvalue()
+        return "".join(xml_txt.convertir([xml_content.encode('utf-8')]))
     except etree.XMLSyntaxError as e:
         raise HTTPException(status_code=400, detail=f"Error parseando XML: {str(e)}")
+
+
+# Texto convertido que se acumula antes de enviarlo al cliente
+TAMANO_TROZO_TXT = 64 * 1024
+
+
+def _dataset_xml(dataset_id: int) -> dict:
+    dataset = next((d for d in DATASETS if d["id"] == dataset_id), None)
+    if not dataset:
+        raise HTTPException(status_code=404, detail="Dataset no encontrado")
+    if dataset.get("format") != "XML":
+        raise HTTPException(status_code=400, detail="Este dataset no es de formato XML")
+    return dataset
+
+
+def _content_disposition(tipo: str, nombre: str) -> str:
+    # Las cabeceras son latin-1: nombre ASCII de reserva más filename* en UTF-8 (RFC 6266)
+    reserva = nombre.encode("ascii", "replace").decode("ascii").replace("?", "_").replace('"', "")
+    return f'{tipo}; filename="{reserva}"; filename*=UTF-8\'\'{quote(nombre)}'
+
+
+async def _abrir_xml(url: str) -> Tuple[AsyncExitStack, httpx.Response]:
+    """
+    Abre la descarga del XML en streaming (sólo las cabeceras). Si falla se
+    responde 400 antes de empezar a enviar nada; si no, quien consuma el
+    cuerpo debe cerrar la pila al terminar.
+    """
+    pila = AsyncExitStack()
+    try:
+        response = await pila.enter_async_context(http_client.stream("GET", url, timeout=10))
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        await pila.aclose()
+        raise HTTPException(status_code=400, detail=f"Error descargando XML: {str(e)}")
+    return pila, response
+
+
+async def _cerrando(trozos: AsyncIterator[bytes], pila: AsyncExitStack) -> AsyncIterator[bytes]:
+    """Reenvía los trozos y cierra la descarga al acabar (o si el cliente se desconecta)."""
+    try:
+        async for trozo in trozos:
+            yield trozo
+    finally:
+        await pila.aclose()
+
+
+async def _comprimir_gzip(trozos: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compresor = zlib.compressobj(json_cache.GZIP_NIVEL, zlib.DEFLATED, 31)
+    async for trozo in trozos:
+        comprimido = compresor.compress(trozo)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
+
+
+def _acepta_gzip(request: Request) -> bool:
+    return json_cache.negociar_codificacion(request.headers.get("accept-encoding"), permitir_br=False) == "gzip"
+
+
+async def _xml_a_txt(response: httpx.Response) -> AsyncIterator[bytes]:
+    """Convierte el XML a medida que llega; el parseo de cada trozo se hace en el threadpool."""
+    conversor = xml_txt.ConversorTXT()
+    pendiente: List[str] = []
+    tamano = 0
+    async for datos in response.aiter_bytes():
+        texto = await run_in_threadpool(conversor.alimentar, datos)
+        pendiente.append(texto)
+        tamano += len(texto)
+        if tamano >= TAMANO_TROZO_TXT:
+            yield "".join(pendiente).encode("utf-8")
+            pendiente.clear()
+            tamano = 0
+    pendiente.append(await run_in_threadpool(conversor.cerrar))
+    yield "".join(pendiente).encode("utf-8")
+
+
+async def _con_error_final(trozos: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Con la respuesta ya empezada no se puede cambiar el estado: el error va al final del texto
+    try:
+        async for trozo in trozos:
+            yield trozo
+    except etree.XMLSyntaxError as e:
+        yield f"\nERROR: XML mal formado: {e}\n".encode("utf-8")
+
+
 # ==================== ANÁLISIS DATASET 1 ====================
 
 def _build_stats(incidencias: List[dict]) -> dict:
@@ -628,7 +1518,7 @@ def _build_stats(incidencias: List[dict]) -> dict:
     }
 
 @app.get("/datasets/{dataset_id}/analyze-xml")
-def analyze_dataset_xml(dataset_id: int, user: User = Depends(get_current_user)):
+async def analyze_dataset_xml(dataset_id: int, user: User = Depends(get_current_user)):
     """
     Analiza el XML del dataset 1 (SCT Incidències) extrayendo estadísticas
     """
@@ -640,9 +1530,9 @@ def analyze_dataset_xml(dataset_id: int, user: User = Depends(get_current_user))
     if dataset.get("format") != "XML":
         raise HTTPException(status_code=400, detail="Este dataset no es de formato XML")
 
-    xml_content = descargar_xml(dataset["link"])
+    xml_content = await descargar_xml(dataset["link"])
     try:
-        incidencias = extraer_incidencias(xml_content)
+        incidencias = await run_in_threadpool(extraer_incidencias, xml_content)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error extrayendo incidencias: {str(e)}")
     
@@ -657,362 +1547,319 @@ def analyze_dataset_xml(dataset_id: int, user: User = Depends(get_current_user))
     }
 
 @app.get("/datasets/{dataset_id}/xml-to-txt")
-def convertir_dataset_xml_a_txt(dataset_id: int, user: User = Depends(get_current_user)):
+async def convertir_dataset_xml_a_txt(dataset_id: int, request: Request, user: User = Depends(get_current_user)):
     """
-    Descarga el XML de un dataset y lo convierte a TXT
+    Descarga el XML de un dataset y lo convierte a TXT en streaming (text/plain).
+    El texto se envía a medida que llega el XML: la memoria no depende del
+    tamaño del documento. Comprimido con gzip si el cliente lo acepta.
     """
-    # Buscar el dataset
-    dataset = None
-    for ds in DATASETS:
-        if ds["id"] == dataset_id:
-            dataset = ds
-            break
-    
-    if not dataset:
-        raise HTTPException(status_code=404, detail="Dataset no encontrado")
-    
-    # Verificar que sea XML
-    if dataset.get("format") != "XML":
-        raise HTTPException(status_code=400, detail="Este dataset no es de formato XML")
-    
-    # Descargar el XML
-    xml_content = descargar_xml(dataset["link"])
-    
-    # Convertir a TXT
-    txt_content = xml_to_txt(xml_content)
-    
-    return {
-        "dataset_id": dataset_id,
-        "dataset_title": dataset["title"],
-        "content": txt_content,
-        "tamanio": len(txt_content),
-        "caracteres": len(xml_content)
+    dataset = _dataset_xml(dataset_id)
+    headers = {
+        "Content-Disposition": _content_disposition("inline", f"{dataset['title']}.txt"),
+        "Vary": "Accept-Encoding",
     }
+    gzip_cliente = _acepta_gzip(request)
+    pila, response = await _abrir_xml(dataset["link"])
+
+    texto = _xml_a_txt(response)
+    # El primer trozo se convierte antes de responder: un XML inválido desde el principio sigue siendo un 400
+    try:
+        primero = await texto.__anext__()
+    except etree.XMLSyntaxError as e:
+        await pila.aclose()
+        raise HTTPException(status_code=400, detail=f"Error parseando XML: {str(e)}")
+    except BaseException:
+        await pila.aclose()
+        raise
+
+    async def cuerpo():
+        yield primero
+        async for trozo in texto:
+            yield trozo
+
+    trozos = _con_error_final(cuerpo())
+    if gzip_cliente:
+        trozos = _comprimir_gzip(trozos)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_cerrando(trozos, pila), media_type="text/plain; charset=utf-8", headers=headers)
 
 @app.get("/datasets/{dataset_id}/xml-download")
-def descargar_xml_dataset(dataset_id: int, user: User = Depends(get_current_user)):
+async def descargar_xml_dataset(dataset_id: int, request: Request, user: User = Depends(get_current_user)):
     """
-    Descarga el XML raw de un dataset
+    Descarga el XML raw de un dataset. Los bytes del upstream se reenvían al
+    cliente a medida que llegan, sin cargar el documento en memoria; si el
+    cliente acepta gzip se comprimen al vuelo (o se reenvían tal cual si el
+    upstream ya los manda comprimidos).
     """
-    # Buscar el dataset
-    dataset = None
-    for ds in DATASETS:
-        if ds["id"] == dataset_id:
-            dataset = ds
-            break
-    
-    if not dataset:
-        raise HTTPException(status_code=404, detail="Dataset no encontrado")
-    
-    if dataset.get("format") != "XML":
-        raise HTTPException(status_code=400, detail="Este dataset no es de formato XML")
-    
-    # Descargar el XML
-    xml_content = descargar_xml(dataset["link"])
-    
-    return Response(
-        content=xml_content,
-        media_type="application/xml",
-        headers={"Content-Disposition": f"attachment; filename={dataset['title']}.xml"}
-    )
+    dataset = _dataset_xml(dataset_id)
+    headers = {
+        "Content-Disposition": _content_disposition("attachment", f"{dataset['title']}.xml"),
+        "Vary": "Accept-Encoding",
+    }
+    gzip_cliente = _acepta_gzip(request)
+    pila, response = await _abrir_xml(dataset["link"])
+
+    codificacion = response.headers.get("content-encoding", "identity").lower()
+    longitud = response.headers.get("content-length")
+    if gzip_cliente:
+        headers["Content-Encoding"] = "gzip"
+        if codificacion == "gzip":
+            trozos = response.aiter_raw()
+            if longitud:
+                headers["Content-Length"] = longitud
+        else:
+            trozos = _comprimir_gzip(response.aiter_bytes())
+    elif codificacion == "identity":
+        trozos = response.aiter_raw()
+        if longitud:
+            headers["Content-Length"] = longitud
+    else:
+        trozos = response.aiter_bytes()
+    return StreamingResponse(_cerrando(trozos, pila), media_type="application/xml", headers=headers)
 
 # ==================== GRAFANA ENDPOINTS ====================
 
+def _tabla_historial(desde: datetime, hasta: datetime, solo_nuevas: bool):
+    """(tabla del histórico en el rango, si el histórico cubre el rango completo)."""
+    with Session(engine) as session:
+        primera = historial.cobertura(session)
+        detalles = historial.detalles_en_rango(session, desde, hasta, solo_nuevas)
+    return TablaIncidencias(detalles), primera is not None and primera <= desde
+
+
+def _instante_grafana(valor) -> Optional[datetime]:
+    # Grafana manda epoch en ms (${__from}) como número o texto, o ISO
+    return _parse_instante(None if valor is None else str(valor))
+
+
+@app.post("/grafana/query")
+async def grafana_batch_query(request: Request, data: dict):
+    """
+    Consulta agrupada: todas las métricas de un dashboard en una sola petición,
+    evaluadas sobre el mismo snapshot (o sobre el histórico en el rango from/to).
+
+    Body: {"from": ..., "to": ..., "targets": [{"refId", "metric", "dimension", "filter", ...}]}
+    (también se acepta "range": {"from", "to"} como envía Grafana).
+    Respuesta: tabla larga [{"refId", "label", "value"}].
+    """
+    objetivos = data.get("targets")
+    if not isinstance(objetivos, list) or not objetivos:
+        raise HTTPException(status_code=400, detail="targets debe ser una lista no vacía")
+    if len(objetivos) > grafana_query.MAXIMO_OBJETIVOS:
+        raise HTTPException(status_code=400, detail=f"Máximo {grafana_query.MAXIMO_OBJETIVOS} targets por consulta")
+    try:
+        objetivos = [grafana_query.validar_objetivo(o) for o in objetivos]
+    except grafana_query.ConsultaInvalida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    rango = data.get("range") if isinstance(data.get("range"), dict) else data
+    fin = _instante_grafana(rango.get("to")) or historial.ahora_utc()
+    inicio = _instante_grafana(rango.get("from")) or fin - timedelta(hours=24)
+    if inicio > fin:
+        raise HTTPException(status_code=400, detail="'from' debe ser anterior a 'to'")
+    horas = (fin - inicio).total_seconds() / 3600
+
+    snapshot = await _safe_snapshot()
+    usa_historial = any(o.get("source", "live") != "live" for o in objetivos)
+
+    @metrics.medir("grafana_query")
+    def calcular():
+        return grafana_query.responder(
+            objetivos, snapshot.tabla, lambda solo_nuevas: _tabla_historial(inicio, fin, solo_nuevas), horas,
+            lambda: almacen_fuentes.combinado().tabla,
+        )
+
+    if usa_historial:
+        filas = await run_in_threadpool(calcular)
+        return json_cache.responder(request, json_cache.RespuestaJSON(filas))
+    # Sólo snapshot actual (y rango irrelevante salvo para rate): misma respuesta para todos los
+    # clientes con el mismo dashboard mientras no cambie el snapshot
+    firma = json_cache.dumps({"targets": objetivos, "horas": round(horas, 3)})
+    clave = "grafana:" + hashlib.blake2b(firma, digest_size=16).hexdigest()
+    respuesta = snapshot.respuestas.get(clave)
+    if respuesta is None:
+        respuesta = await run_in_threadpool(snapshot.respuestas.obtener, clave, calcular)
+    return json_cache.responder(request, respuesta)
+
+
 @app.get("/grafana/incidents/total")
-def grafana_total_incidents():
+async def grafana_total_incidents(source: Optional[str] = None):
     """Total de incidencias activas"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        return {"value": len(incidencias)}
+        return {"value": (await _safe_indice(source)).total}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 
 @app.get("/grafana/incidents/per-hour")
-def grafana_incidents_per_hour():
-    """Ritmo medio de incidencias por hora (estimado sobre las últimas 24h)"""
+async def grafana_incidents_per_hour(source: Optional[str] = None):
+    """Ritmo medio de incidencias nuevas por hora en las últimas 24h"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
         hours = 24
-        rate = (len(incidencias) / hours) if hours else 0
+        hasta = historial.ahora_utc()
+        desde = hasta - timedelta(hours=hours)
+        # Con histórico que cubra las 24h se cuentan las incidencias realmente aparecidas;
+        # si no, se estima con las activas
+        nuevas = await run_in_threadpool(_historial_nuevas_si_cubre, desde, hasta)
+        if nuevas is None:
+            nuevas = (await _safe_indice(source)).total
+        rate = (nuevas / hours) if hours else 0
         return {"value": round(rate, 2)}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 @app.get("/grafana/accidents/today-count")
-def grafana_accidents_today():
+async def grafana_accidents_today(source: Optional[str] = None):
     """Contar retenciones activas"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        retenciones = [inc for inc in incidencias if inc.get('tipo') and 'retenc' in inc.get('tipo', '').lower()]
-        return {"value": len(retenciones)}
+        return {"value": (await _safe_indice(source)).retenciones}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 @app.get("/grafana/accidents/by-type")
-def grafana_accidents_by_type():
+async def grafana_accidents_by_type(source: Optional[str] = None):
     """Incidencias por tipo"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        
-        tipos = {}
-        for inc in incidencias:
-            tipo = inc.get('tipo', 'Desconocido')
-            if tipo:  # Solo contar si el tipo no es None
-                tipos[tipo] = tipos.get(tipo, 0) + 1
-        
-        return [{"tipo": k, "cantidad": v} for k, v in tipos.items()]
+        tipos = (await _safe_indice(source)).por_tipo
+        return [{"tipo": k, "cantidad": v} for k, v in tipos.most_common() if k]
     except Exception as e:
         return []
 
 
-def _filter_severe(incidencias):
-    return [inc for inc in incidencias if inc.get('nivel') and int(inc.get('nivel', 0)) >= 3]
-
-
 @app.get("/grafana/incidents/severe-count")
-def grafana_incidents_severe_count():
+async def grafana_incidents_severe_count(source: Optional[str] = None):
     """Total de incidencias con nivel >= 3"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        graves = _filter_severe(incidencias)
-        return {"value": len(graves)}
+        return {"value": (await _safe_indice(source)).graves}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 
 @app.get("/grafana/incidents/avg-severity")
-def grafana_incidents_avg_severity():
+async def grafana_incidents_avg_severity(source: Optional[str] = None):
     """Media de nivel de severidad"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        niveles = [int(inc.get('nivel')) for inc in incidencias if inc.get('nivel')]
-        if not niveles:
-            return {"value": 0}
-        return {"value": round(sum(niveles) / len(niveles), 2)}
+        return {"value": (await _safe_indice(source)).media_severidad()}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 
 @app.get("/grafana/incidents/severe-distinct-roads")
-def grafana_incidents_severe_distinct_roads():
+async def grafana_incidents_severe_distinct_roads(source: Optional[str] = None):
     """Número de carreteras con incidencias graves (nivel >=3)"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        graves = _filter_severe(incidencias)
-        roads = {inc.get('carretera') for inc in graves if inc.get('carretera')}
-        return {"value": len(roads)}
+        return {"value": (await _safe_indice(source)).carreteras_distintas(solo_graves=True)}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 
 @app.get("/grafana/incidents/severe-by-cause")
-def grafana_incidents_severe_by_cause():
+async def grafana_incidents_severe_by_cause(source: Optional[str] = None):
     """Causas de incidencias graves (nivel >=3)"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        graves = _filter_severe(incidencias)
-        causes = {}
-        for inc in graves:
-            causa = inc.get('causa', 'Desconeguda')
-            causes[causa] = causes.get(causa, 0) + 1
-        sorted_causes = sorted(causes.items(), key=lambda x: x[1], reverse=True)[:10]
-        return [{"causa": k, "cantidad": v} for k, v in sorted_causes]
+        causes = (await _safe_indice(source)).graves_por_causa
+        return [{"causa": k, "cantidad": v} for k, v in causes.most_common(10)]
     except Exception:
         return []
 
 
 @app.get("/grafana/incidents/severe-by-type")
-def grafana_incidents_severe_by_type():
+async def grafana_incidents_severe_by_type(source: Optional[str] = None):
     """Incidencias graves por tipo"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        graves = _filter_severe(incidencias)
-        tipos = {}
-        for inc in graves:
-            tipo = inc.get('tipo', 'Desconegut')
-            if tipo:
-                tipos[tipo] = tipos.get(tipo, 0) + 1
-        return [{"tipo": k, "cantidad": v} for k, v in sorted(tipos.items(), key=lambda x: x[1], reverse=True)]
+        tipos = (await _safe_indice(source)).graves_por_tipo
+        return [{"tipo": k, "cantidad": v} for k, v in tipos.most_common() if k]
     except Exception:
         return []
 
 
 @app.get("/grafana/incidents/severe-by-road")
-def grafana_incidents_severe_by_road():
+async def grafana_incidents_severe_by_road(source: Optional[str] = None):
     """Top carreteras con incidencias graves"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        graves = _filter_severe(incidencias)
-        roads = {}
-        for inc in graves:
-            carretera = inc.get('carretera', 'Desconeguda')
-            roads[carretera] = roads.get(carretera, 0) + 1
-        sorted_roads = sorted(roads.items(), key=lambda x: x[1], reverse=True)[:10]
-        return [{"carretera": k, "cantidad": v} for k, v in sorted_roads]
+        roads = (await _safe_indice(source)).graves_por_carretera
+        return [{"carretera": k, "cantidad": v} for k, v in roads.most_common(10)]
     except Exception:
         return []
 
 @app.get("/grafana/accidents/by-severity")
-def grafana_accidents_by_severity():
+async def grafana_accidents_by_severity(source: Optional[str] = None):
     """Incidencias por severidad"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-
         # Prellenamos niveles 1-5 para que el gráfico muestre barras aunque no haya casos
-        severities = {str(i): 0 for i in range(1, 6)}
-        for inc in incidencias:
-            nivel_raw = inc.get('nivel')
-            try:
-                nivel = int(nivel_raw)
-            except Exception:
-                continue
-            if nivel <= 0:
-                continue
-            key = str(nivel)
-            severities[key] = severities.get(key, 0) + 1
-
-        ordered = sorted(severities.items(), key=lambda x: int(x[0]))
-        return [{"nivel": k, "cantidad": v} for k, v in ordered]
+        severities = {i: 0 for i in range(1, 6)}
+        for nivel, total in (await _safe_indice(source)).por_nivel.items():
+            if nivel > 0:
+                severities[nivel] = total
+        return [{"nivel": str(k), "cantidad": v} for k, v in sorted(severities.items())]
     except Exception as e:
         return []
 
 @app.get("/grafana/accidents/by-road")
-def grafana_accidents_by_road():
+async def grafana_accidents_by_road(source: Optional[str] = None):
     """Top carreteras con más incidencias"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        
-        roads = {}
-        for inc in incidencias:
-            carretera = inc.get('carretera', 'Desconocida')
-            roads[carretera] = roads.get(carretera, 0) + 1
-        
-        sorted_roads = sorted(roads.items(), key=lambda x: x[1], reverse=True)[:10]
-        return [{"carretera": k, "cantidad": v} for k, v in sorted_roads]
+        roads = (await _safe_indice(source)).por_carretera
+        return [{"carretera": k, "cantidad": v} for k, v in roads.most_common(10)]
     except Exception as e:
         return []
 
 
-def _region_from_incidence(inc: dict) -> str:
-    """Clasifica en regiones gruesas para Grafana (evita 'Desconeguda')."""
-    try:
-        lat = float(inc.get('lat', 'nan'))
-        lon = float(inc.get('lon', inc.get('lng', 'nan')))
-    except Exception:
-        lat = float('nan')
-        lon = float('nan')
-
-    carretera = (inc.get('carretera') or '').upper().strip()
-
-    # Prefer coordenadas si existen
-    if not (lat != lat or lon != lon):  # check for NaN
-        if 41.2 <= lat <= 41.7 and 1.9 <= lon <= 2.5:
-            return 'AMB'
-        if 40.5 <= lat <= 43.8 and -1.5 <= lon <= 3.6:
-            return 'Catalunya'
-
-    # Fallbacks basados en carretera (B- suelen ser area BCN)
-    if carretera.startswith('B-') or carretera.startswith('BV-'):
-        return 'AMB'
-    if carretera.startswith('C-') or carretera.startswith('AP-') or carretera.startswith('A-'):
-        return 'Catalunya'
-
-    return 'Desconeguda'
-
-
 @app.get("/grafana/accidents/by-region")
-def grafana_accidents_by_region():
+async def grafana_accidents_by_region(source: Optional[str] = None):
     """Incidencias agrupadas por área (AMB vs Catalunya vs Desconeguda)."""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        regions = {}
-        for inc in incidencias:
-            region = _region_from_incidence(inc)
-            regions[region] = regions.get(region, 0) + 1
-        sorted_regions = sorted(regions.items(), key=lambda x: x[1], reverse=True)
-        return [{"area": k, "cantidad": v} for k, v in sorted_regions]
+        regions = (await _safe_indice(source)).por_region
+        return [{"area": k, "cantidad": v} for k, v in regions.most_common()]
     except Exception:
         return []
 
 @app.get("/grafana/accidents/distinct-roads")
-def grafana_distinct_roads():
+async def grafana_distinct_roads(source: Optional[str] = None):
     """Número de carreteras distintas con incidencias activas"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        roads = set()
-        for inc in incidencias:
-            carretera = inc.get('carretera', 'Desconocida')
-            if carretera and carretera != 'Desconocida':
-                roads.add(carretera)
-        return {"value": len(roads)}
+        return {"value": (await _safe_indice(source)).carreteras_distintas()}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 @app.get("/grafana/incidents/severity-percentage")
-def grafana_severity_percentage():
+async def grafana_severity_percentage(source: Optional[str] = None):
     """Porcentaje de incidencias graves (nivel >= 3)"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        if not incidencias:
-            return {"value": 0}
-        
-        graves = sum(1 for inc in incidencias if inc.get('nivel') and int(inc.get('nivel', 0)) >= 3)
-        percentage = (graves / len(incidencias)) * 100
-        return {"value": round(percentage, 2)}
+        return {"value": (await _safe_indice(source)).porcentaje_graves()}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
 @app.get("/grafana/incidents/by-cause")
-def grafana_incidents_by_cause():
+async def grafana_incidents_by_cause(source: Optional[str] = None):
     """Causas de incidencias"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        
-        causes = {}
-        for inc in incidencias:
-            causa = inc.get('causa', 'Desconocida')
-            causes[causa] = causes.get(causa, 0) + 1
-        
-        sorted_causes = sorted(causes.items(), key=lambda x: x[1], reverse=True)[:10]
-        return [{"causa": k, "cantidad": v} for k, v in sorted_causes]
+        causes = (await _safe_indice(source)).por_causa
+        return [{"causa": k, "cantidad": v} for k, v in causes.most_common(10)]
     except Exception as e:
         return []
 
 @app.get("/grafana/dashboard/incidents-by-weekday")
-def grafana_incidents_by_weekday():
-    """Incidentes por día de la semana"""
+async def grafana_incidents_by_weekday(desde: Optional[str] = None, hasta: Optional[str] = None, source: Optional[str] = None):
+    """Incidentes por día de la semana (activas, o del histórico si se pasa un rango)"""
     try:
-        from datetime import datetime
-        incidencias = extraer_coordenadas_con_detalles()
-        
-        # Mapeo de días de semana en catalán
-        day_names = ["Dilluns", "Dimarts", "Dimecres", "Dijous", "Divendres", "Dissabte", "Diumenge"]
-        day_counts = {day: 0 for day in day_names}
-        
-        # Contar incidencias por día de la semana basado en el campo 'data'
-        for inc in incidencias:
-            data = inc.get('data')
-            if data:
-                try:
-                    # Parsear fecha formato: "Wed, 14 Jan 2026 12:51:30 GMT"
-                    dt = datetime.strptime(data, "%a, %d %b %Y %H:%M:%S %Z")
-                    weekday = dt.weekday()  # 0=Monday, 6=Sunday
-                    day_counts[day_names[weekday]] += 1
-                except:
-                    pass
-        
-        return [{"day": day, "count": count} for day, count in day_counts.items()]
+        if desde or hasta:
+            inicio, fin = _rango_historial(desde, hasta)
+            por_dia = await run_in_threadpool(_consultar_historial, historial.por_dia_semana, inicio, fin)
+        else:
+            por_dia = (await _safe_indice(source)).por_dia_semana
+        return [{"day": day, "count": por_dia.get(i, 0)} for i, day in enumerate(DIAS_SEMANA)]
     except Exception as e:
         return []
 
 @app.get("/grafana/dashboard/streets-closed")
-def grafana_streets_closed():
+async def grafana_streets_closed():
     """Calles cortadas"""
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        
-        # Filtrar solo las calles cortadas
+        snapshot = await _safe_snapshot()
+        incidencias = snapshot.incidencias
+
+        # Filtrar solo las calles cortadas (máscara vectorizada sobre la tabla columnar)
         closed_streets = [
             {
                 "carretera": inc.get('carretera', 'Desconocida'),
@@ -1022,10 +1869,7 @@ def grafana_streets_closed():
                 "nivel": inc.get('nivel', 0),
                 "sentit": inc.get('sentit', '')
             }
-            for inc in incidencias
-            if (inc.get('descripcion') and 'tallat' in inc.get('descripcion', '').lower()) or 
-               (inc.get('tipo') and 'tall' in inc.get('tipo', '').lower()) or 
-               (inc.get('nivel') and int(inc.get('nivel', 0)) >= 4)
+            for inc in (incidencias[i] for i in snapshot.tabla.filas(snapshot.tabla.mascara_cortadas()))
         ]
         
         return {"calles_cortadas": closed_streets, "total": len(closed_streets)}
@@ -1034,20 +1878,18 @@ def grafana_streets_closed():
 
 
 @app.get("/grafana/dashboard/streets-closed/count")
-def grafana_streets_closed_count():
+async def grafana_streets_closed_count():
     """Total de calles/carreteras cortadas"""
     try:
-        data = grafana_streets_closed()
+        data = await grafana_streets_closed()
         return {"value": data.get("total", 0)} if isinstance(data, dict) else {"value": 0}
     except Exception as e:
         return {"value": 0, "error": str(e)}
 
-@app.get("/api/incidents-map")
-def incidents_map():
-    """Retorna incidencias con coordenadas para visualizar en mapa"""
+def _construir_incidents_map(snapshot: FeedSnapshot) -> dict:
     try:
-        incidencias = extraer_coordenadas_con_detalles()
-        
+        incidencias = snapshot.incidencias
+
         # Filtrar solo incidencias con coordenadas
         incidents_with_coords = [
             {
@@ -1060,14 +1902,99 @@ def incidents_map():
                 "nivel": inc.get('nivel', 0),
                 "sentit": inc.get('sentit', '')
             }
-            for inc in incidencias
-            if inc.get('lat') and inc.get('lon')
+            for inc in (incidencias[i] for i in snapshot.tabla.filas(snapshot.tabla.mascara_con_coordenadas()))
         ]
         
         return {"incidents": incidents_with_coords, "total": len(incidents_with_coords)}
     except Exception as e:
         return {"error": str(e), "incidents": [], "total": 0}
 
+
+@app.get("/api/incidents-map")
+async def incidents_map(request: Request):
+    """Retorna incidencias con coordenadas para visualizar en mapa"""
+    return await _respuesta_snapshot(request, "incidents_map")
+
+
+# Endpoints cuya respuesta se serializa una vez por snapshot
+_RESPUESTAS_SNAPSHOT = {
+    "raw": _construir_raw,
+    "summary": _construir_summary,
+    "by_tipo": _construir_by_tipo,
+    "by_nivel": _construir_by_nivel,
+    "ranking_trams": _construir_ranking_trams,
+    "coordenadas": _construir_coordenadas,
+    "incidencias": _construir_incidencias,
+    "incidents_map": _construir_incidents_map,
+}
+
+
+def _precalcular_respuestas(snapshot: FeedSnapshot) -> None:
+    for clave, construir in _RESPUESTAS_SNAPSHOT.items():
+        try:
+            snapshot.respuestas.obtener(clave, lambda: construir(snapshot))
+        except Exception as exc:
+            # Un panel roto no debe impedir publicar el snapshot (se reintenta al pedirlo)
+            print(f"Error precalculando la respuesta '{clave}': {exc}")
+
+
+@app.get("/api/incidents-map/query")
+async def incidents_map_query(
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = None,
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    radius_km: Optional[float] = None,
+    nivel_min: int = 0,
+    contiene: Optional[List[str]] = Query(None),
+    limit: int = 2000,
+):
+    """
+    Incidencias dentro de la vista del mapa.
+
+    - bbox: "min_lon,min_lat,max_lon,max_lat" (L.LatLngBounds.toBBoxString())
+    - lat, lon, radius_km: alternativa al bbox (círculo)
+    - zoom: por debajo de MAP_CLUSTER_MAX_ZOOM se agrupan las incidencias cercanas
+    - nivel_min: nivel mínimo
+    - contiene: textos (repetible) que deben aparecer en el tipo o la causa (cualquiera de ellos)
+    """
+    try:
+        vista = spatial_index.parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    circulo = lat is not None and lon is not None and radius_km is not None
+    if vista is None and not circulo:
+        raise HTTPException(status_code=400, detail="Indica bbox o lat, lon y radius_km")
+    if circulo and radius_km <= 0:
+        raise HTTPException(status_code=400, detail="radius_km debe ser positivo")
+
+    snapshot = await _safe_snapshot()
+    tabla = snapshot.tabla
+    filas = snapshot.espacial.consultar_bbox(vista) if vista is not None else snapshot.espacial.consultar_radio(lat, lon, radius_km)
+    if circulo and vista is not None:
+        cerca = spatial_index.distancia_km(lat, lon, tabla.lat[filas], tabla.lon[filas]) <= radius_km
+        filas = filas[cerca]
+
+    if nivel_min or contiene:
+        mascara = tabla.nivel[filas] >= nivel_min
+        textos = [t for t in (contiene or []) if t]
+        if textos:
+            mascara &= tabla.mascara_contiene_alguno(('tipo', 'causa'), textos)[filas]
+        filas = filas[mascara]
+
+    total = len(filas)
+    clusters = []
+    if zoom is not None and zoom < MAP_CLUSTER_MAX_ZOOM:
+        clusters, filas = spatial_index.agrupar(tabla.lat, tabla.lon, tabla.nivel, filas, zoom)
+    limit = max(0, limit)
+    incidencias = snapshot.incidencias
+    return {
+        "incidents": [incidencias[i] for i in filas[:limit].tolist()],
+        "clusters": clusters,
+        "total": total,
+        "truncated": len(filas) > limit,
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
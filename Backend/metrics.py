@@ -0,0 +1,224 @@
+"""
+Métricas Prometheus/OpenMetrics del backend (endpoint /metrics).
+
+Cubre los caminos calientes:
+  - peticiones HTTP por ruta (plantilla, no la URL concreta): latencia,
+    estado y peticiones en curso (MetricasHTTP, middleware ASGI)
+  - descargas de servicios externos: duración, estado y bytes (observar_upstream)
+  - etapas de CPU: parseo del feed, índices, respuestas precalculadas,
+    hash de contraseñas... (etapa)
+  - conexiones a la base de datos: tiempo retenidas y consultas (instrumentar_engine)
+  - saturación del threadpool de anyio (se lee en cada scrape)
+  - contadores que ya llevan los componentes en su dict `stats` (poller,
+    caché de snapshots, difusor SSE) se exponen tal cual al hacer scrape
+    (registrar_estadisticas), sin duplicarlos.
+"""
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+PREFIJO = "pae"
+
+# Latencias: de 1 ms a 10 s (peticiones, descargas, etapas de CPU)
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_BYTES = (1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+
+# Rutas de larga duración (SSE): su "latencia" es lo que dura la conexión, no se mide
+RUTAS_SIN_LATENCIA = {"/api/incidencies/stream"}
+
+http_peticiones = Counter(
+    f"{PREFIJO}_http_requests_total", "Peticiones HTTP atendidas", ["method", "route", "status"],
+)
+http_duracion = Histogram(
+    f"{PREFIJO}_http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta",
+    ["method", "route"], buckets=BUCKETS_SEGUNDOS,
+)
+http_en_curso = Gauge(f"{PREFIJO}_http_requests_in_progress", "Peticiones HTTP en curso")
+
+upstream_duracion = Histogram(
+    f"{PREFIJO}_upstream_request_duration_seconds", "Duración de las peticiones a servicios externos",
+    ["host"], buckets=BUCKETS_SEGUNDOS,
+)
+upstream_peticiones = Counter(
+    f"{PREFIJO}_upstream_requests_total", "Peticiones a servicios externos por estado (error = sin respuesta)",
+    ["host", "status"],
+)
+upstream_bytes = Histogram(
+    f"{PREFIJO}_upstream_response_bytes", "Tamaño de las respuestas de servicios externos",
+    ["host"], buckets=BUCKETS_BYTES,
+)
+
+etapa_duracion = Histogram(
+    f"{PREFIJO}_stage_duration_seconds", "Duración de las etapas de CPU (parseo, agregados, serialización...)",
+    ["stage"], buckets=BUCKETS_SEGUNDOS,
+)
+snapshot_incidencias = Gauge(f"{PREFIJO}_snapshot_incidents", "Incidencias del snapshot publicado")
+respuestas_json = Counter(
+    f"{PREFIJO}_json_responses_total", "Respuestas JSON precalculadas servidas (not_modified = 304 por ETag)",
+    ["result"],
+)
+
+db_conexion_duracion = Histogram(
+    f"{PREFIJO}_db_connection_hold_seconds", "Tiempo que una sesión retiene una conexión del pool",
+    buckets=BUCKETS_SEGUNDOS,
+)
+db_conexiones_en_uso = Gauge(f"{PREFIJO}_db_connections_in_use", "Conexiones del pool prestadas a sesiones")
+db_consulta_duracion = Histogram(
+    f"{PREFIJO}_db_query_duration_seconds", "Duración de las sentencias SQL", buckets=BUCKETS_SEGUNDOS,
+)
+
+threadpool_ocupados = Gauge(f"{PREFIJO}_threadpool_busy_threads", "Hilos del threadpool ocupados")
+threadpool_tamano = Gauge(f"{PREFIJO}_threadpool_size", "Hilos máximos del threadpool")
+threadpool_esperando = Gauge(f"{PREFIJO}_threadpool_waiting_tasks", "Tareas esperando un hilo libre")
+
+
+@contextmanager
+def etapa(nombre: str) -> Iterator[None]:
+    """Mide la duración de una etapa (también si lanza excepción)."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        etapa_duracion.labels(nombre).observe(time.perf_counter() - inicio)
+
+
+def medir(nombre: str) -> Callable:
+    """Decorador: mide cada llamada a la función como la etapa `nombre`."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltorio(*args, **kwargs):
+            with etapa(nombre):
+                return funcion(*args, **kwargs)
+        return envoltorio
+    return decorador
+
+
+def observar_upstream(host: str, status: Optional[int], segundos: float, tamano: Optional[int] = None) -> None:
+    """Registra una petición a un servicio externo (status None = fallo de red/timeout)."""
+    host = host or "desconocido"
+    upstream_duracion.labels(host).observe(segundos)
+    upstream_peticiones.labels(host, str(status) if status is not None else "error").inc()
+    if tamano is not None:
+        upstream_bytes.labels(host).observe(tamano)
+
+
+class MetricasHTTP:
+    """Middleware ASGI: latencia y estado por plantilla de ruta (sin mezclar /datasets/1 y /datasets/2)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        inicio = time.perf_counter()
+        estado = {"status": 500}
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["status"] = mensaje["status"]
+            await send(mensaje)
+
+        http_en_curso.inc()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            http_en_curso.dec()
+            ruta = scope.get("route")
+            # Sin ruta (404) se agrupa todo para no crear una serie por URL desconocida
+            plantilla = getattr(ruta, "path", None) or "unmatched"
+            metodo = scope.get("method", "")
+            http_peticiones.labels(metodo, plantilla, str(estado["status"])).inc()
+            if plantilla not in RUTAS_SIN_LATENCIA:
+                http_duracion.labels(metodo, plantilla).observe(time.perf_counter() - inicio)
+
+
+def instrumentar_engine(engine) -> None:
+    """Eventos del engine SQLAlchemy: tiempo de préstamo de conexiones y duración de las sentencias."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["pae_checkout"] = time.perf_counter()
+        db_conexiones_en_uso.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        inicio = connection_record.info.pop("pae_checkout", None)
+        if inicio is not None:
+            db_conexiones_en_uso.dec()
+            db_conexion_duracion.observe(time.perf_counter() - inicio)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("pae_consultas", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _despues(conn, cursor, statement, parameters, context, executemany):
+        consultas = conn.info.get("pae_consultas")
+        if consultas:
+            db_consulta_duracion.observe(time.perf_counter() - consultas.pop())
+
+
+class _Estadisticas:
+    """Collector que lee los dicts `stats` de los componentes en el momento del scrape."""
+
+    def __init__(self):
+        # nombre -> (función que devuelve el dict, claves enteras que son gauges)
+        self.fuentes: Dict[str, Tuple[Callable[[], dict], FrozenSet[str]]] = {}
+
+    def collect(self):
+        for nombre, (leer, gauges) in self.fuentes.items():
+            try:
+                stats = leer()
+            except Exception:
+                continue
+            for clave, valor in stats.items():
+                # Sólo los valores numéricos; los contadores acumulados (enteros) como counter
+                if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+                    continue
+                metrica = f"{PREFIJO}_{nombre}_{clave}"
+                if isinstance(valor, int) and clave not in gauges:
+                    familia = CounterMetricFamily(metrica, f"{nombre}: {clave}")
+                else:
+                    familia = GaugeMetricFamily(metrica, f"{nombre}: {clave}")
+                familia.add_metric([], valor)
+                yield familia
+
+
+_estadisticas = _Estadisticas()
+REGISTRY.register(_estadisticas)
+
+
+def registrar_estadisticas(nombre: str, leer: Callable[[], dict], gauges: Iterable[str] = ()) -> None:
+    """
+    Expone los valores numéricos de leer() como pae_<nombre>_<clave> en cada scrape.
+
+    Los enteros se exponen como counter (acumulados) salvo las claves de `gauges`,
+    que son un estado actual (tamaños, conexiones en uso, último código...); los
+    decimales, siempre como gauge.
+    """
+    _estadisticas.fuentes[nombre] = (leer, frozenset(gauges))
+
+
+def _actualizar_threadpool() -> None:
+    # El limitador por defecto de anyio es el que usa run_in_threadpool (hay que estar en el event loop)
+    try:
+        from anyio.to_thread import current_default_thread_limiter
+        limitador = current_default_thread_limiter()
+    except Exception:
+        return
+    threadpool_tamano.set(limitador.total_tokens)
+    threadpool_ocupados.set(limitador.borrowed_tokens)
+    threadpool_esperando.set(limitador.statistics().tasks_waiting)
+
+
+def exponer() -> tuple:
+    """(cuerpo, content type) en formato de texto de Prometheus. Llamar desde el event loop."""
+    _actualizar_threadpool()
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,61 @@
+"""
+Utilidades de paginación por cursor y proyección de campos.
+
+El cursor es opaco para el cliente: JSON en base64 url-safe con la clave
+de ordenación de la última fila devuelta. La página siguiente empieza
+justo después de esa clave (keyset), así que el coste de cada página no
+depende de cuántas se hayan pedido antes.
+"""
+import base64
+import json
+from typing import Iterable, List, Optional, Sequence
+
+from fastapi import HTTPException
+
+LIMITE_POR_DEFECTO = 100
+LIMITE_MAXIMO = 1000
+
+
+def codificar_cursor(datos: dict) -> str:
+    texto = json.dumps(datos, separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(texto.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor: Optional[str]) -> Optional[dict]:
+    """Devuelve el contenido del cursor (None si no hay); 400 si está mal formado."""
+    if not cursor:
+        return None
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+    if not isinstance(datos, dict):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+    return datos
+
+
+def limitar(limit: Optional[int]) -> int:
+    if limit is None:
+        return LIMITE_POR_DEFECTO
+    return max(1, min(limit, LIMITE_MAXIMO))
+
+
+def parse_fields(fields: Optional[str], disponibles: Sequence[str]) -> Optional[List[str]]:
+    """Lista de campos pedidos en `fields=a,b,c` (None = todos); 400 si alguno no existe."""
+    if not fields:
+        return None
+    pedidos = [f.strip() for f in fields.split(",") if f.strip()]
+    desconocidos = [f for f in pedidos if f not in disponibles]
+    if desconocidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Campos desconocidos: {', '.join(desconocidos)}. Disponibles: {', '.join(disponibles)}",
+        )
+    return pedidos
+
+
+def proyectar(filas: Iterable[dict], campos: Optional[List[str]]) -> List[dict]:
+    if campos is None:
+        return list(filas)
+    return [{c: fila.get(c) for c in campos} for fila in filas]
@@ -0,0 +1,140 @@
+"""
+Hash y verificación de contraseñas en un pool de procesos acotado.
+
+pbkdf2/bcrypt son CPU pura a propósito: hechos en el threadpool de
+FastAPI, una ráfaga de logins lo ocupa entero (y con el GIL, también la
+CPU del proceso) y deja sin hilos al resto de endpoints síncronos. Aquí
+se hacen en un ProcessPoolExecutor aparte con control de admisión: como
+mucho `max_pendientes` operaciones en cola o en curso; por encima se
+rechaza enseguida (PoolSaturado -> 429) en lugar de acumular esperas.
+
+El esquema y el coste son configurables. Los hashes antiguos (otro
+esquema o menos rondas) siguen verificando y, al verificarlos con éxito,
+se devuelve el hash nuevo para guardarlo (rehash transparente en el login).
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+ESQUEMA_POR_DEFECTO = "pbkdf2_sha256"
+
+
+class PoolSaturado(RuntimeError):
+    """Hay demasiadas operaciones de hash pendientes."""
+
+
+def crear_contexto(esquema: str = ESQUEMA_POR_DEFECTO, rondas: Optional[int] = None) -> CryptContext:
+    """
+    Contexto de passlib con `esquema` (y `rondas`, si se indican) como preferido.
+    pbkdf2_sha256 se mantiene siempre para verificar los hashes existentes.
+    """
+    esquemas = [esquema] + [e for e in (ESQUEMA_POR_DEFECTO,) if e != esquema]
+    opciones = {f"{esquema}__rounds": rondas} if rondas else {}
+    return CryptContext(schemes=esquemas, deprecated="auto", **opciones)
+
+
+# --- Funciones que se ejecutan en los procesos del pool ---
+
+_contextos = {}
+
+
+def _contexto(esquema: str, rondas: Optional[int]) -> CryptContext:
+    clave = (esquema, rondas)
+    if clave not in _contextos:
+        _contextos[clave] = crear_contexto(esquema, rondas)
+    return _contextos[clave]
+
+
+def _hash(esquema: str, rondas: Optional[int], password: str) -> str:
+    return _contexto(esquema, rondas).hash(password)
+
+
+def _verificar(esquema: str, rondas: Optional[int], password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    try:
+        return _contexto(esquema, rondas).verify_and_update(password, hashed)
+    except ValueError:
+        # Hash con formato desconocido
+        return False, None
+
+
+class HasherPasswords:
+    def __init__(
+        self,
+        esquema: str = ESQUEMA_POR_DEFECTO,
+        rondas: Optional[int] = None,
+        procesos: Optional[int] = None,
+        max_pendientes: Optional[int] = None,
+    ):
+        """
+        Args:
+            esquema: esquema de passlib para los hashes nuevos (pbkdf2_sha256, bcrypt...)
+            rondas: coste (rounds) del esquema; None = el valor por defecto de passlib
+            procesos: procesos del pool (por defecto, uno por CPU hasta 4)
+            max_pendientes: operaciones en cola o en curso admitidas (por defecto, 8 por proceso)
+        """
+        self.esquema = esquema
+        self.rondas = rondas
+        self.procesos = procesos or min(4, os.cpu_count() or 1)
+        self.max_pendientes = max_pendientes or 8 * self.procesos
+        # Se valida la configuración en el arranque (esquema desconocido o sin backend)
+        self.contexto = crear_contexto(esquema, rondas)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self.stats = {"submitted": 0, "rejected": 0, "in_flight": 0, "rehashed": 0, "processes": self.procesos}
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # spawn: los procesos sólo importan este módulo (no la app ni sus hilos)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.procesos, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _ejecutar(self, funcion, *args):
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                self.stats["rejected"] += 1
+                raise PoolSaturado(f"{self._pendientes} operaciones de hash pendientes")
+            self._pendientes += 1
+            self.stats["submitted"] += 1
+            self.stats["in_flight"] = self._pendientes
+            pool = self._pool()
+        try:
+            return await asyncio.wrap_future(pool.submit(funcion, self.esquema, self.rondas, *args))
+        except BrokenProcessPool:
+            # Un proceso murió (OOM, kill): la próxima operación crea un pool nuevo
+            with self._lock:
+                if self._executor is pool:
+                    self._executor = None
+            raise
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+                self.stats["in_flight"] = self._pendientes
+
+    async def hash(self, password: str) -> str:
+        return await self._ejecutar(_hash, password)
+
+    async def verificar(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns:
+            (válida, hash nuevo si hay que actualizar el guardado o None)
+
+        Raises:
+            PoolSaturado: sin ejecutar nada
+        """
+        valida, nuevo = await self._ejecutar(_verificar, password, hashed)
+        if valida and nuevo is not None:
+            self.stats["rehashed"] += 1
+        return valida, nuevo
+
+    def cerrar(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,144 @@
+"""
+Índice lineal (referenciación por carretera y punto kilométrico) de las incidencias.
+
+Cada incidencia con carretera y PK es un intervalo [pk_inici, pk_fi] sobre
+su carretera (si sólo hay un PK, un intervalo de longitud cero). Por
+carretera, los intervalos se ordenan por PK inicial y se guarda el máximo
+acumulado del PK final: es un árbol de intervalos aplanado en arrays, así
+que "qué incidencias tocan el PK 12-18 de la C-58" son dos búsquedas
+binarias más un filtro sobre los candidatos, y no un recorrido de la tabla.
+
+El ranking de trams divide cada carretera en tramos de longitud fija y
+cuenta, para cada tramo, las incidencias que lo tocan (una incidencia larga
+cuenta en todos los tramos que cubre) y su severidad. Todo vectorizado con
+NumPy, así que vale también para el histórico completo.
+"""
+import math
+from typing import List, Optional
+
+import numpy as np
+
+# Longitud por defecto de los tramos del ranking (km)
+LONGITUD_TRAMO_KM = 5.0
+# Una incidencia no cuenta en más tramos que éstos (PK erróneos de cientos de km)
+MAXIMO_TRAMOS_POR_INCIDENCIA = 200
+
+
+class IndicePK:
+    def __init__(self, tabla):
+        """
+        Args:
+            tabla: TablaIncidencias (usa la carretera, los PK, el nivel y el tipo)
+        """
+        self.tabla = tabla
+        self.carreteras = tabla.categorias['carretera']
+        codigos = tabla.codigos('carretera')
+        inicio, fin = tabla.pk_inici, tabla.pk_fi
+        # Sin PK final (o no numérico) la incidencia es puntual; se admite el orden invertido
+        fin = np.where(np.isnan(fin), inicio, fin)
+        bajo, alto = np.fmin(inicio, fin), np.fmax(inicio, fin)
+        filas = np.flatnonzero((codigos >= 0) & np.isfinite(bajo) & np.isfinite(alto))
+        orden = np.lexsort((bajo[filas], codigos[filas]))
+        # Filas de la tabla ordenadas por (carretera, PK inicial); cada carretera es un tramo contiguo
+        self.filas = filas[orden]
+        self.codigos = codigos[self.filas]
+        self.bajo = bajo[self.filas]
+        self.alto = alto[self.filas]
+        presentes, inicios = np.unique(self.codigos, return_index=True)
+        self._rangos = {
+            int(codigo): (int(a), int(b))
+            for codigo, a, b in zip(presentes, inicios, np.append(inicios[1:], len(self.filas)))
+        }
+        # Máximo acumulado del PK final dentro de cada carretera (no decreciente: admite búsqueda binaria)
+        self.alto_max = np.empty_like(self.alto)
+        for a, b in self._rangos.values():
+            self.alto_max[a:b] = np.maximum.accumulate(self.alto[a:b])
+
+    def __len__(self) -> int:
+        return len(self.filas)
+
+    def _rango(self, carretera: str) -> Optional[tuple]:
+        return self._rangos.get(self.carreteras.codigo(carretera))
+
+    def consultar(self, carretera: str, desde: float = -math.inf, hasta: float = math.inf) -> np.ndarray:
+        """Filas de la tabla de `carretera` cuyo intervalo de PK se solapa con [desde, hasta]."""
+        rango = self._rango(carretera)
+        if rango is None or desde > hasta:
+            return np.empty(0, dtype=np.int64)
+        a, b = rango
+        # Candidatas: PK inicial <= hasta y, a partir de la primera con máximo acumulado >= desde
+        fin = a + int(np.searchsorted(self.bajo[a:b], hasta, side="right"))
+        inicio = a + int(np.searchsorted(self.alto_max[a:b], desde, side="left"))
+        if inicio >= fin:
+            return np.empty(0, dtype=np.int64)
+        candidatas = np.arange(inicio, fin)
+        return np.sort(self.filas[candidatas[self.alto[candidatas] >= desde]])
+
+    def ranking_tramos(
+        self,
+        longitud_km: float = LONGITUD_TRAMO_KM,
+        limite: int = 10,
+        carretera: Optional[str] = None,
+        mascara: Optional[np.ndarray] = None,
+    ) -> List[dict]:
+        """
+        Tramos de `longitud_km` con más incidencias (y, a igualdad, más severidad).
+
+        Args:
+            carretera: sólo los tramos de esa carretera
+            mascara: máscara booleana sobre la tabla (p. ej. rango de nivel o de fechas)
+        """
+        if longitud_km <= 0:
+            raise ValueError("longitud_km debe ser positiva")
+        posiciones = np.arange(len(self.filas))
+        if carretera is not None:
+            rango = self._rango(carretera)
+            posiciones = posiciones[rango[0]:rango[1]] if rango is not None else posiciones[:0]
+        if mascara is not None:
+            posiciones = posiciones[mascara[self.filas[posiciones]]]
+        if len(posiciones) == 0:
+            return []
+
+        # En float y acotado antes de pasar a entero: un PK enorme no debe desbordar int64
+        primero = np.floor(self.bajo[posiciones] / longitud_km)
+        ultimo = np.floor(self.alto[posiciones] / longitud_km)
+        cubiertos = np.clip(ultimo - primero + 1, 1, MAXIMO_TRAMOS_POR_INCIDENCIA).astype(np.int64)
+        primero = primero.astype(np.int64)
+        # Una entrada por (incidencia, tramo que cubre)
+        posiciones = np.repeat(posiciones, cubiertos)
+        desplazamiento = np.arange(len(posiciones)) - np.repeat(np.cumsum(cubiertos) - cubiertos, cubiertos)
+        tramos = np.repeat(primero, cubiertos) + desplazamiento
+        codigos = self.codigos[posiciones]
+        claves = (codigos.astype(np.int64) << 32) | (tramos & 0xFFFFFFFF)
+        _, primera, grupo = np.unique(claves, return_index=True, return_inverse=True)
+        grupo = grupo.reshape(-1)
+
+        niveles = self.tabla.nivel[self.filas[posiciones]].astype(np.int64)
+        cantidad = np.bincount(grupo)
+        severidad = np.bincount(grupo, weights=niveles)
+        nivel_max = np.full(len(cantidad), np.iinfo(np.int64).min)
+        np.maximum.at(nivel_max, grupo, niveles)
+
+        orden = np.lexsort((-severidad, -cantidad))[:limite]
+        tipos = self.tabla.codigos('tipo')[self.filas[posiciones]]
+        por_grupo = np.argsort(grupo, kind="stable")
+        limites = np.append(0, np.cumsum(cantidad))
+        ranking = []
+        for g in orden:
+            tipos_tramo = tipos[por_grupo[limites[g]:limites[g + 1]]]
+            tipos_tramo = tipos_tramo[tipos_tramo >= 0]
+            tipo_principal = None
+            if len(tipos_tramo):
+                tipo_principal = self.tabla.categorias['tipo'].valores[int(np.bincount(tipos_tramo).argmax())]
+            tramo = int(tramos[primera[g]])
+            ranking.append({
+                "carretera": self.carreteras.valores[int(codigos[primera[g]])],
+                "pk_inici": round(tramo * longitud_km, 3),
+                "pk_fi": round((tramo + 1) * longitud_km, 3),
+                "incidents": int(cantidad[g]),
+                "densitat": round(int(cantidad[g]) / longitud_km, 3),
+                "severitat": int(severidad[g]),
+                "max_nivel": max(int(nivel_max[g]), 0),
+                "tipo_principal": tipo_principal,
+            })
+        return ranking
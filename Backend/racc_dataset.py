@@ -0,0 +1,398 @@
+"""
+Dataset RACC (Excel) convertido a una tabla columnar en disco.
+
+El .xlsx se lee una sola vez en modo read-only de openpyxl (fila a fila, sin
+cargar el libro entero) y se guarda como un directorio de arrays .npy:
+
+  - data (epoch float64, NaN si no hay), km de retención (float64, NaN),
+    nivel de severidad (int8, 0 = desconocido), día de la semana
+    (int8, 0 = dilluns ... 6 = diumenge, -1 = desconocido)
+  - columnas categóricas (via, poblacio, sentit, tipus, info) como códigos
+    int32 sobre un diccionario de valores (-1 = sin valor)
+
+El directorio se nombra con el sha256 del .xlsx, así que sólo se vuelve a
+convertir si cambia el contenido (el mtime/tamaño evita recalcular el hash
+mientras el fichero no se toque). Los arrays se abren con mmap: aunque el
+export tenga millones de filas, cargar la tabla es casi inmediato y los
+filtros y group-by se hacen vectorizados con NumPy.
+
+Dimensiones: las de racc:TrafficIncident en la ontología (hasRoadSegment ->
+via, hasArea -> poblacio, hasIncidentType -> tipus, hasSeverity -> nivel,
+dayOfWeek -> dia_setmana, hasDirection -> sentit).
+"""
+import calendar
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unicodedata
+from array import array
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from incident_index import DIAS_SEMANA
+
+# Cambiar si cambia el formato de los arrays (invalida las cachés existentes)
+VERSION_FORMATO = 1
+
+# Cabecera normalizada (minúsculas, sin acentos) -> campo
+COLUMNAS = {
+    "dia_setmana": "dia_setmana",
+    "dia": "dia",
+    "data": "data",
+    "via": "via",
+    "poblacio": "poblacio",
+    "sentit": "sentit",
+    "longitud_retencio_km": "km",
+    "tipus_incidencia": "tipus",
+    "informacio_addicional": "info",
+    "severitat": "severitat",
+    "nivell": "severitat",
+}
+CATEGORICAS = ("via", "poblacio", "sentit", "tipus", "info")
+# Dimensiones para filtros y agregados (info es texto libre: sólo se lista)
+DIMENSIONES = ("via", "poblacio", "sentit", "tipus", "nivel", "dia_setmana")
+
+# Sin columna de severidad, el nivel (1-5) se deriva de la longitud de la cua (km):
+# < 1, < 3, < 6, < 10 y a partir de 10. Sin longitud queda 0 (desconocido).
+LIMITES_NIVEL_KM = (1.0, 3.0, 6.0, 10.0)
+
+_DIAS = {dia.lower(): i for i, dia in enumerate(DIAS_SEMANA)}
+_NUMERO = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+
+def _normalizar(texto: str) -> str:
+    texto = unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\W+", "_", texto.strip().lower()).strip("_")
+
+
+def _texto(valor) -> Optional[str]:
+    if valor is None:
+        return None
+    texto = str(valor).strip()
+    return texto or None
+
+
+def _epoch(valor) -> float:
+    if isinstance(valor, datetime):
+        return float(calendar.timegm(valor.timetuple()))
+    if isinstance(valor, date):
+        return float(calendar.timegm(valor.timetuple()))
+    texto = _texto(valor)
+    if texto is None:
+        return np.nan
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M"):
+        try:
+            return float(calendar.timegm(datetime.strptime(texto, formato).timetuple()))
+        except ValueError:
+            continue
+    return np.nan
+
+
+def _numero(valor) -> float:
+    if isinstance(valor, bool):
+        return np.nan
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    texto = _texto(valor)
+    if texto is None or isinstance(valor, (datetime, date)):
+        return np.nan
+    encontrado = _NUMERO.search(texto)
+    return float(encontrado.group().replace(",", ".")) if encontrado else np.nan
+
+
+def _dia_semana(*valores) -> int:
+    for valor in valores:
+        texto = _texto(valor)
+        if texto and texto.lower() in _DIAS:
+            return _DIAS[texto.lower()]
+    return -1
+
+
+def nivel_por_km(km: float) -> int:
+    if np.isnan(km) or km <= 0:
+        return 0
+    return 1 + sum(km >= limite for limite in LIMITES_NIVEL_KM)
+
+
+class _Codificador:
+    """Diccionario incremental valor -> código mientras se recorren las filas."""
+
+    def __init__(self):
+        self.valores: List[str] = []
+        self._codigos: Dict[str, int] = {}
+        self.codigos = array("i")
+
+    def agregar(self, valor: Optional[str]) -> None:
+        if valor is None:
+            self.codigos.append(-1)
+            return
+        codigo = self._codigos.get(valor)
+        if codigo is None:
+            codigo = len(self.valores)
+            self._codigos[valor] = codigo
+            self.valores.append(valor)
+        self.codigos.append(codigo)
+
+
+class TablaRACC:
+    def __init__(
+        self,
+        data: np.ndarray,
+        km: np.ndarray,
+        nivel: np.ndarray,
+        dia_setmana: np.ndarray,
+        codigos: Dict[str, np.ndarray],
+        valores: Dict[str, List[str]],
+    ):
+        self.data = data
+        self.km = km
+        self.nivel = nivel
+        self.dia_setmana = dia_setmana
+        self.codigos = codigos
+        self.valores = valores
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    # --- Persistencia ---
+
+    def guardar(self, directorio: str) -> None:
+        os.makedirs(directorio, exist_ok=True)
+        for nombre in ("data", "km", "nivel", "dia_setmana"):
+            np.save(os.path.join(directorio, f"{nombre}.npy"), getattr(self, nombre))
+        for campo, codigos in self.codigos.items():
+            np.save(os.path.join(directorio, f"{campo}.npy"), codigos)
+        with open(os.path.join(directorio, "valores.json"), "w", encoding="utf-8") as f:
+            json.dump(self.valores, f, ensure_ascii=False)
+
+    @classmethod
+    def abrir(cls, directorio: str) -> "TablaRACC":
+        """Abre la tabla con los arrays mapeados en memoria (no se leen hasta usarlos)."""
+        def cargar(nombre):
+            return np.load(os.path.join(directorio, f"{nombre}.npy"), mmap_mode="r")
+
+        with open(os.path.join(directorio, "valores.json"), encoding="utf-8") as f:
+            valores = json.load(f)
+        return cls(
+            cargar("data"), cargar("km"), cargar("nivel"), cargar("dia_setmana"),
+            {campo: cargar(campo) for campo in CATEGORICAS}, valores,
+        )
+
+    # --- Filtros ---
+
+    def _codigos_iguales(self, campo: str, valor: str) -> List[int]:
+        valor = valor.strip().lower()
+        return [i for i, v in enumerate(self.valores[campo]) if v.lower() == valor]
+
+    def mascara(
+        self,
+        filtros: Optional[Dict[str, str]] = None,
+        nivel_min: Optional[int] = None,
+        nivel_max: Optional[int] = None,
+        desde: Optional[float] = None,
+        hasta: Optional[float] = None,
+    ) -> np.ndarray:
+        """
+        Filas que cumplen todos los filtros. `filtros` compara por igualdad (sin
+        distinguir mayúsculas) las columnas categóricas y dia_setmana (nombre del día).
+        """
+        mascara = np.ones(len(self), dtype=bool)
+        for campo, valor in (filtros or {}).items():
+            if campo == "dia_setmana":
+                dia = _dia_semana(valor)
+                mascara &= self.dia_setmana == dia if dia >= 0 else np.zeros(len(self), dtype=bool)
+            else:
+                mascara &= np.isin(self.codigos[campo], self._codigos_iguales(campo, valor))
+        if nivel_min is not None:
+            mascara &= self.nivel >= nivel_min
+        if nivel_max is not None:
+            mascara &= self.nivel <= nivel_max
+        if desde is not None:
+            mascara &= self.data >= desde
+        if hasta is not None:
+            mascara &= self.data <= hasta
+        return mascara
+
+    # --- Group-by ---
+
+    def contar_por(self, dimension: str, mascara: Optional[np.ndarray] = None) -> List[Tuple[Optional[str], int]]:
+        """(valor, filas) por valor de la dimensión, de más a menos frecuente (None = sin valor)."""
+        if dimension == "nivel":
+            conteo = np.bincount(self.nivel, weights=mascara, minlength=6)
+            pares = [(int(n) if n else None, int(conteo[n])) for n in np.flatnonzero(conteo)]
+        elif dimension == "dia_setmana":
+            conteo = np.bincount(self.dia_setmana.astype(np.int16) + 1, weights=mascara, minlength=8)
+            nombres = [None] + DIAS_SEMANA
+            # Los días se devuelven en orden de la semana, no por frecuencia
+            return [(nombres[i], int(conteo[i])) for i in np.flatnonzero(conteo)]
+        else:
+            valores = [None] + self.valores[dimension]
+            conteo = np.bincount(self.codigos[dimension] + 1, weights=mascara, minlength=len(valores))
+            pares = [(valores[i], int(conteo[i])) for i in np.flatnonzero(conteo)]
+        return sorted(pares, key=lambda par: -par[1])
+
+    def resumen(self, mascara: np.ndarray) -> dict:
+        km = self.km[mascara]
+        km = km[~np.isnan(km)]
+        nivel = self.nivel[mascara]
+        nivel = nivel[nivel > 0]
+        data = self.data[mascara]
+        data = data[~np.isnan(data)]
+        return {
+            "total": int(mascara.sum()),
+            "km_cua_mitjana": float(km.mean()) if len(km) else None,
+            "nivel_mitja": float(nivel.mean()) if len(nivel) else None,
+            "desde": _iso(data.min()) if len(data) else None,
+            "hasta": _iso(data.max()) if len(data) else None,
+        }
+
+    # --- Filas ---
+
+    def filas(self, indices: Sequence[int]) -> List[dict]:
+        resultado = []
+        for i in indices:
+            fila = {"fila": int(i)}
+            for campo in CATEGORICAS:
+                codigo = int(self.codigos[campo][i])
+                fila[campo] = self.valores[campo][codigo] if codigo >= 0 else None
+            data = float(self.data[i])
+            km = float(self.km[i])
+            dia = int(self.dia_setmana[i])
+            fila["data"] = _iso(data) if not np.isnan(data) else None
+            fila["dia_setmana"] = DIAS_SEMANA[dia] if dia >= 0 else None
+            fila["km"] = km if not np.isnan(km) else None
+            fila["nivel"] = int(self.nivel[i]) or None
+            resultado.append(fila)
+        return resultado
+
+    def pagina(self, mascara: np.ndarray, despues_de: int = -1, limite: int = 100) -> Tuple[List[int], Optional[int]]:
+        """Filas (en orden del fichero) posteriores a `despues_de`; devuelve también la clave de la siguiente."""
+        inicio = despues_de + 1
+        seleccion = np.flatnonzero(mascara[inicio:])[:limite + 1] + inicio
+        filas = seleccion[:limite].tolist()
+        siguiente = filas[-1] if len(seleccion) > limite else None
+        return filas, siguiente
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def convertir_xlsx(ruta: str) -> TablaRACC:
+    """Lee la primera hoja del .xlsx fila a fila (la primera fila es la cabecera)."""
+    from openpyxl import load_workbook
+
+    libro = load_workbook(ruta, read_only=True, data_only=True)
+    try:
+        filas = libro.worksheets[0].iter_rows(values_only=True)
+        cabecera = next(filas, None) or ()
+        posiciones = {}
+        for i, nombre in enumerate(cabecera):
+            campo = COLUMNAS.get(_normalizar(nombre)) if nombre is not None else None
+            if campo and campo not in posiciones:
+                posiciones[campo] = i
+        if "data" not in posiciones and "via" not in posiciones:
+            raise ValueError("La primera fila del Excel no tiene la cabecera esperada")
+
+        def celda(fila, campo):
+            i = posiciones.get(campo)
+            return fila[i] if i is not None and i < len(fila) else None
+
+        data, km, nivel, dias = array("d"), array("d"), array("b"), array("b")
+        categoricas = {campo: _Codificador() for campo in CATEGORICAS}
+        for fila in filas:
+            if not any(v is not None and str(v).strip() for v in fila):
+                continue
+            instante = _epoch(celda(fila, "data"))
+            longitud = _numero(celda(fila, "km"))
+            severitat = _numero(celda(fila, "severitat"))
+            dia = _dia_semana(celda(fila, "dia_setmana"), celda(fila, "dia"))
+            if dia < 0 and not np.isnan(instante):
+                # El 1/1/1970 fue jueves
+                dia = (int(instante // 86400) + 3) % 7
+            data.append(instante)
+            km.append(longitud)
+            nivel.append(int(severitat) if 1 <= severitat <= 5 else nivel_por_km(longitud))
+            dias.append(dia)
+            for campo, codificador in categoricas.items():
+                valor = _texto(celda(fila, campo))
+                codificador.agregar(valor.lower() if campo == "tipus" and valor else valor)
+    finally:
+        libro.close()
+
+    return TablaRACC(
+        np.frombuffer(data, dtype=np.float64).copy(),
+        np.frombuffer(km, dtype=np.float64).copy(),
+        np.frombuffer(nivel, dtype=np.int8).copy(),
+        np.frombuffer(dias, dtype=np.int8).copy(),
+        {campo: np.frombuffer(c.codigos, dtype=np.int32).copy() for campo, c in categoricas.items()},
+        {campo: c.valores for campo, c in categoricas.items()},
+    )
+
+
+def _sha256(ruta: str) -> str:
+    hasher = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for trozo in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(trozo)
+    return hasher.hexdigest()
+
+
+class AlmacenRACC:
+    """Tabla del Excel RACC, convertida una vez por contenido y reutilizada entre peticiones y reinicios."""
+
+    def __init__(self, ruta_xlsx: str, directorio_cache: str):
+        self.ruta_xlsx = ruta_xlsx
+        self.directorio_cache = directorio_cache
+        self._lock = threading.Lock()
+        self._firma: Optional[Tuple[int, int]] = None
+        self._tabla: Optional[TablaRACC] = None
+        self.stats = {"conversions": 0, "cache_hits": 0, "rows": 0}
+
+    def tabla(self) -> TablaRACC:
+        """Tabla actual (bloqueante: puede convertir el Excel). FileNotFoundError si no existe."""
+        estado = os.stat(self.ruta_xlsx)
+        firma = (estado.st_mtime_ns, estado.st_size)
+        tabla = self._tabla
+        if tabla is not None and firma == self._firma:
+            return tabla
+        with self._lock:
+            if self._tabla is not None and firma == self._firma:
+                return self._tabla
+            self._tabla = self._cargar()
+            self._firma = firma
+            self.stats["rows"] = len(self._tabla)
+            return self._tabla
+
+    def _cargar(self) -> TablaRACC:
+        nombre = f"racc-v{VERSION_FORMATO}-{_sha256(self.ruta_xlsx)}"
+        destino = os.path.join(self.directorio_cache, nombre)
+        if os.path.isdir(destino):
+            self.stats["cache_hits"] += 1
+            return TablaRACC.abrir(destino)
+
+        with metrics.etapa("racc_ingest"):
+            tabla = convertir_xlsx(self.ruta_xlsx)
+        os.makedirs(self.directorio_cache, exist_ok=True)
+        temporal = tempfile.mkdtemp(prefix=".racc-", dir=self.directorio_cache)
+        try:
+            tabla.guardar(temporal)
+            os.replace(temporal, destino)
+        except OSError:
+            # Otro proceso ha escrito la misma versión a la vez: nos quedamos con la suya
+            shutil.rmtree(temporal, ignore_errors=True)
+            if not os.path.isdir(destino):
+                raise
+        self.stats["conversions"] += 1
+        # Las conversiones de versiones anteriores del Excel ya no se usarán
+        for entrada in os.listdir(self.directorio_cache):
+            if entrada.startswith("racc-") and entrada != nombre:
+                shutil.rmtree(os.path.join(self.directorio_cache, entrada), ignore_errors=True)
+        return TablaRACC.abrir(destino)
@@ -0,0 +1,140 @@
+"""
+Caché en memoria de snapshots del feed de incidencias (SCT).
+
+Un único snapshot alimenta todos los endpoints. Semántica:
+  - edad < ttl: se sirve el snapshot tal cual (fresco).
+  - ttl <= edad < ttl + stale_ttl: se sirve el snapshot viejo y se lanza
+    una revalidación en segundo plano (stale-while-revalidate).
+  - sin snapshot o más viejo: la petición espera a la descarga.
+En todos los casos sólo hay una descarga en vuelo (single-flight): las
+peticiones concurrentes esperan a la misma en lugar de repetirla.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+
+class Snapshot:
+    """Valor descargado junto con el instante (monotónico) de la descarga."""
+
+    def __init__(self, value: Any, fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+def _recoger(vuelo: asyncio.Task) -> None:
+    # Revalidación en segundo plano sin nadie esperando: el error ya queda en stats/last_error
+    if not vuelo.cancelled():
+        vuelo.exception()
+
+
+class SnapshotCache:
+    def __init__(
+        self,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: float = 60.0,
+        stale_ttl: float = 600.0,
+        wait_timeout: Optional[float] = 30.0,
+    ):
+        """
+        Args:
+            loader: corrutina que descarga y parsea el feed (debe lanzar excepción si falla)
+            ttl: segundos durante los que el snapshot se considera fresco
+            stale_ttl: segundos extra durante los que se sirve viejo mientras se revalida
+            wait_timeout: máximo que espera una petición a una descarga en vuelo
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.wait_timeout = wait_timeout
+        # set() puede llegar desde el threadpool; la descarga en vuelo sólo se toca en el event loop
+        self._lock = threading.Lock()
+        self._snapshot: Optional[Snapshot] = None
+        self._vuelo: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "loads": 0, "errors": 0}
+        self.last_error: Optional[str] = None
+
+    # --- Lectura ---
+
+    async def get_async(self) -> Any:
+        """Devuelve el valor del snapshot, esperando a la descarga (sin ocupar hilos) sólo cuando es necesario."""
+        servido, valor, revalidar = self._consultar()
+        if revalidar:
+            self._unirse_al_vuelo()
+        if servido:
+            return valor
+        vuelo = self._unirse_al_vuelo()
+        try:
+            # shield: si esta petición se cancela o se cansa de esperar, la descarga sigue para las demás
+            await asyncio.wait_for(asyncio.shield(vuelo), self.wait_timeout)
+        except Exception:
+            pass
+        return self._resultado(vuelo)
+
+    def peek(self) -> Optional[Snapshot]:
+        """Snapshot actual sin disparar descargas (None si aún no hay)."""
+        return self._snapshot
+
+    # --- Escritura ---
+
+    def set(self, value: Any) -> None:
+        """Publica un valor nuevo (p. ej. descargado por un proceso externo)."""
+        with self._lock:
+            self._snapshot = Snapshot(value, time.monotonic())
+
+    # --- Internos ---
+
+    def _consultar(self):
+        """
+        Devuelve (servido, valor, revalidar). Si servido es True el valor se
+        puede devolver ya (fresco, o viejo y entonces revalidar es True para
+        lanzar la descarga en segundo plano); si no, hay que esperar a la descarga.
+        """
+        with self._lock:
+            snap = self._snapshot
+            if snap is not None:
+                age = snap.age()
+                if age < self.ttl:
+                    self.stats["hits"] += 1
+                    return True, snap.value, False
+                if age < self.ttl + self.stale_ttl:
+                    self.stats["stale_hits"] += 1
+                    return True, snap.value, True
+            self.stats["misses"] += 1
+            return False, None, False
+
+    def _resultado(self, vuelo: asyncio.Task) -> Any:
+        with self._lock:
+            snap = self._snapshot
+        if snap is not None:
+            # Si la descarga falla o tarda se sigue sirviendo el último snapshot válido
+            return snap.value
+        if vuelo.done() and not vuelo.cancelled() and vuelo.exception() is not None:
+            raise vuelo.exception()
+        raise TimeoutError("Timeout esperando la descarga del feed")
+
+    def _unirse_al_vuelo(self) -> asyncio.Task:
+        """La descarga en vuelo, o una nueva si no hay ninguna (single-flight)."""
+        if self._vuelo is None:
+            self._vuelo = asyncio.get_running_loop().create_task(self._cargar())
+            self._vuelo.add_done_callback(_recoger)
+        return self._vuelo
+
+    async def _cargar(self) -> None:
+        try:
+            value = await self.loader()
+            with self._lock:
+                self._snapshot = Snapshot(value, time.monotonic())
+                self.stats["loads"] += 1
+                self.last_error = None
+        except Exception as exc:
+            with self._lock:
+                self.stats["errors"] += 1
+                self.last_error = str(exc)
+            raise
+        finally:
+            self._vuelo = None
@@ -0,0 +1,159 @@
+"""
+Índice espacial (rejilla regular) de las incidencias de un snapshot.
+
+Las incidencias con coordenadas se ordenan por celda de la rejilla
+(tamaño fijo en grados) y para cada celda ocupada se guarda el rango de
+posiciones que le corresponde. Una consulta por bbox sólo mira las celdas
+ocupadas que caen dentro y filtra exactamente los candidatos, así que el
+coste depende de lo que hay en pantalla y no del tamaño del feed.
+
+También incluye el agrupado (clustering) por rejilla para zooms bajos:
+el tamaño de celda se deriva del zoom del mapa (teselas de 256 px).
+"""
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# ~5,5 km en latitud: en Catalunya deja unas pocas incidencias por celda
+CELDA_GRADOS = 0.05
+# Tamaño en píxeles de pantalla de cada grupo al agrupar
+CLUSTER_PIXELES = 60
+RADIO_TIERRA_KM = 6371.0088
+
+BBox = Tuple[float, float, float, float]  # (min_lon, min_lat, max_lon, max_lat)
+
+
+def _clave_celda(cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+    # Los índices de celda caben de sobra en 32 bits: se combinan en un único int64
+    return (cx.astype(np.int64) << 32) | (cy.astype(np.int64) & 0xFFFFFFFF)
+
+
+class IndiceEspacial:
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, celda: float = CELDA_GRADOS):
+        """
+        Args:
+            lat, lon: columnas de la tabla de incidencias (NaN o 0 = sin coordenadas)
+            celda: lado de la celda de la rejilla en grados
+        """
+        self.celda = celda
+        self.lat = lat
+        self.lon = lon
+        validas = np.isfinite(lat) & np.isfinite(lon) & (lat != 0) & (lon != 0)
+        filas = np.flatnonzero(validas)
+        cx = np.floor(lon[filas] / celda).astype(np.int64)
+        cy = np.floor(lat[filas] / celda).astype(np.int64)
+        claves = _clave_celda(cx, cy)
+        orden = np.argsort(claves, kind="stable")
+        # Filas de la tabla ordenadas por celda; cada celda ocupada es un tramo contiguo
+        self.filas = filas[orden]
+        claves, inicios = np.unique(claves[orden], return_index=True)
+        self.celdas_x = cx[orden][inicios]
+        self.celdas_y = cy[orden][inicios]
+        self.inicios = inicios
+        self.finales = np.append(inicios[1:], len(self.filas)).astype(inicios.dtype)
+
+    def __len__(self) -> int:
+        return len(self.filas)
+
+    def consultar_bbox(self, bbox: BBox) -> np.ndarray:
+        """Filas de la tabla con coordenadas dentro del bbox (bordes incluidos)."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if len(self.filas) == 0 or min_lon > max_lon or min_lat > max_lat:
+            return np.empty(0, dtype=np.int64)
+        celdas = np.flatnonzero(
+            (self.celdas_x >= math.floor(min_lon / self.celda)) & (self.celdas_x <= math.floor(max_lon / self.celda))
+            & (self.celdas_y >= math.floor(min_lat / self.celda)) & (self.celdas_y <= math.floor(max_lat / self.celda))
+        )
+        if len(celdas) == 0:
+            return np.empty(0, dtype=np.int64)
+        candidatas = np.concatenate([self.filas[self.inicios[c]:self.finales[c]] for c in celdas])
+        lat, lon = self.lat[candidatas], self.lon[candidatas]
+        dentro = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return np.sort(candidatas[dentro])
+
+    def consultar_radio(self, lat: float, lon: float, radio_km: float) -> np.ndarray:
+        """Filas a menos de radio_km (distancia haversine) del punto."""
+        dlat = math.degrees(radio_km / RADIO_TIERRA_KM)
+        coseno = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(180.0, dlat / coseno)
+        candidatas = self.consultar_bbox((lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+        if len(candidatas) == 0:
+            return candidatas
+        return candidatas[distancia_km(lat, lon, self.lat[candidatas], self.lon[candidatas]) <= radio_km]
+
+
+def distancia_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distancia haversine (km) de un punto a un array de puntos."""
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def tamano_cluster(zoom: int, pixeles: int = CLUSTER_PIXELES) -> float:
+    """Grados de longitud que ocupan `pixeles` de pantalla a un zoom dado."""
+    return 360.0 / (2 ** zoom) * pixeles / 256.0
+
+
+def agrupar(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    nivel: np.ndarray,
+    filas: np.ndarray,
+    zoom: int,
+) -> Tuple[List[dict], np.ndarray]:
+    """
+    Agrupa las filas por rejilla según el zoom.
+
+    Returns:
+        (clusters, sueltas): los grupos de más de una incidencia (centroide,
+        número, nivel máximo y bbox) y las filas que quedan solas en su celda.
+    """
+    if len(filas) == 0:
+        return [], filas
+    lado = tamano_cluster(zoom)
+    la, lo = lat[filas], lon[filas]
+    claves = _clave_celda(np.floor(lo / lado), np.floor(la / lado))
+    _, grupo, cantidad = np.unique(claves, return_inverse=True, return_counts=True)
+    grupo = grupo.reshape(-1)
+    n = len(cantidad)
+    suma_lat = np.bincount(grupo, weights=la, minlength=n)
+    suma_lon = np.bincount(grupo, weights=lo, minlength=n)
+    nivel_max = np.full(n, np.iinfo(np.int16).min, dtype=np.int16)
+    np.maximum.at(nivel_max, grupo, nivel[filas].astype(np.int16))
+    min_lat = np.full(n, np.inf)
+    max_lat = np.full(n, -np.inf)
+    min_lon = np.full(n, np.inf)
+    max_lon = np.full(n, -np.inf)
+    np.minimum.at(min_lat, grupo, la)
+    np.maximum.at(max_lat, grupo, la)
+    np.minimum.at(min_lon, grupo, lo)
+    np.maximum.at(max_lon, grupo, lo)
+
+    clusters = [
+        {
+            "lat": round(float(suma_lat[g] / cantidad[g]), 6),
+            "lon": round(float(suma_lon[g] / cantidad[g]), 6),
+            "count": int(cantidad[g]),
+            "max_nivel": int(nivel_max[g]),
+            "bbox": [float(min_lon[g]), float(min_lat[g]), float(max_lon[g]), float(max_lat[g])],
+        }
+        for g in np.flatnonzero(cantidad > 1)
+    ]
+    clusters.sort(key=lambda c: -c["count"])
+    sueltas = filas[cantidad[grupo] == 1]
+    return clusters, sueltas
+
+
+def parse_bbox(texto: Optional[str]) -> Optional[BBox]:
+    """Parsea "min_lon,min_lat,max_lon,max_lat" (formato de L.LatLngBounds.toBBoxString)."""
+    if not texto:
+        return None
+    partes = [float(p) for p in texto.split(",")]
+    if len(partes) != 4 or not all(math.isfinite(p) for p in partes):
+        raise ValueError("bbox debe tener 4 valores: min_lon,min_lat,max_lon,max_lat")
+    min_lon, min_lat, max_lon, max_lat = partes
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("bbox con mínimos mayores que máximos")
+    return min_lon, min_lat, max_lon, max_lat
@@ -0,0 +1,113 @@
+"""
+Conversión XML -> TXT incremental (mismo formato que el antiguo xml_to_txt).
+
+El documento se va alimentando por trozos a un XMLPullParser (la interfaz
+de iterparse por eventos) y cada trozo devuelve el texto que ya se puede
+escribir. No hay recursión (un documento muy profundo no llega al límite
+de recursión de Python) y los elementos ya escritos se liberan, así que
+la memoria no depende del tamaño del documento.
+
+El texto de un elemento se escribe en cuanto se sabe que está completo:
+al empezar su primer hijo o al cerrarse; el "tail" de un hijo, al empezar
+el siguiente hermano o al cerrarse el padre. Los comentarios e
+instrucciones de procesamiento no se escriben, pero sí el texto que les
+sigue (su tail).
+"""
+from typing import Iterable, Iterator, List, Optional
+
+from lxml import etree
+
+SEPARADOR = "=" * 80
+CABECERA = f"{SEPARADOR}\nCONTENIDO XML CONVERTIDO A TXT\n{SEPARADOR}\n\n"
+PIE = f"\n{SEPARADOR}\n"
+
+
+class ConversorTXT:
+    def __init__(self):
+        self._parser = etree.XMLPullParser(events=("start", "end", "comment", "pi"), huge_tree=True)
+        self._salida: List[str] = [CABECERA]
+        # Elementos abiertos con su nivel y si ya se ha escrito su texto
+        self._pila: List[list] = []
+        # Último hijo cerrado cuyo tail aún no se ha escrito (y su nivel)
+        self._cerrado: Optional[etree._Element] = None
+        self._nivel_cerrado = 0
+
+    def _escribir_texto(self, entrada: list) -> None:
+        elemento, nivel, escrito = entrada
+        if not escrito:
+            entrada[2] = True
+            if elemento.text and elemento.text.strip():
+                self._salida.append(f"{'  ' * nivel}  > {elemento.text.strip()}\n")
+
+    def _escribir_tail(self) -> None:
+        hijo = self._cerrado
+        if hijo is None:
+            return
+        self._cerrado = None
+        if hijo.tail and hijo.tail.strip():
+            # El tail va con la indentación del padre (nivel del hijo - 1)
+            self._salida.append(f"{'  ' * (self._nivel_cerrado - 1)}  {hijo.tail.strip()}\n")
+        # Ya escrito: se libera el hijo y sus hermanos anteriores
+        hijo.clear()
+        padre = hijo.getparent()
+        if padre is not None:
+            while len(padre) and padre[0] is not hijo:
+                del padre[0]
+            if len(padre):
+                del padre[0]
+
+    def _procesar_eventos(self) -> None:
+        for evento, elemento in self._parser.read_events():
+            if evento == "start":
+                self._escribir_tail()
+                if self._pila:
+                    self._escribir_texto(self._pila[-1])
+                nivel = len(self._pila)
+                indentacion = "  " * nivel
+                self._salida.append(f"{indentacion}[{elemento.tag}]\n")
+                for nombre, valor in elemento.attrib.items():
+                    self._salida.append(f"{indentacion}  @{nombre}: {valor}\n")
+                self._pila.append([elemento, nivel, False])
+            elif evento in ("comment", "pi"):
+                if not self._pila:
+                    # Fuera del elemento raíz: no hay texto que escribir
+                    continue
+                self._escribir_tail()
+                self._escribir_texto(self._pila[-1])
+                # Como un hijo ya cerrado: sólo queda escribir su tail
+                self._cerrado, self._nivel_cerrado = elemento, len(self._pila)
+            else:
+                self._escribir_tail()
+                entrada = self._pila.pop()
+                self._escribir_texto(entrada)
+                self._cerrado, self._nivel_cerrado = elemento, entrada[1]
+
+    def _vaciar(self) -> str:
+        texto = "".join(self._salida)
+        self._salida.clear()
+        return texto
+
+    def alimentar(self, datos: bytes) -> str:
+        """Procesa un trozo del documento y devuelve el texto ya disponible (lanza XMLSyntaxError)."""
+        self._parser.feed(datos)
+        self._procesar_eventos()
+        return self._vaciar()
+
+    def cerrar(self) -> str:
+        """Termina el documento y devuelve el resto del texto (con el pie)."""
+        self._parser.close()
+        self._procesar_eventos()
+        # El tail del elemento raíz no se escribía en la versión recursiva
+        self._cerrado = None
+        self._salida.append(PIE)
+        return self._vaciar()
+
+
+def convertir(trozos: Iterable[bytes]) -> Iterator[str]:
+    """Generador: texto convertido a medida que llegan los trozos del XML."""
+    conversor = ConversorTXT()
+    for datos in trozos:
+        texto = conversor.alimentar(datos)
+        if texto:
+            yield texto
+    yield conversor.cerrar()
@@ -1,5 +1,5 @@
-import React, { useState, useEffect } from 'react';
-import { MapContainer, TileLayer, Circle, Popup, Polyline, Marker } from 'react-leaflet';
+import React, { useState, useEffect, useRef } from 'react';
+import { MapContainer, TileLayer, Circle, CircleMarker, Popup, Polyline, Marker, Tooltip, useMapEvents } from 'react-leaflet';
 import L from 'leaflet';
 import 'leaflet/dist/leaflet.css';
 import './TrafficMap.css';
@@ -65,6 +65,37 @@ interface TrafficIncident {
   nivel?: number;
 }
 
+interface IncidentCluster {
+  lat: number;
+  lon: number;
+  count: number;
+  max_nivel: number;
+  bbox: [number, number, number, number];
+}
+
+type MapView = {
+  bbox: string;
+  zoom: number;
+};
+
+// Textos que el backend busca en el tipo o la causa para cada filtro de tipo
+const TYPE_FILTER_TEXTS: Record<string, string[]> = {
+  Retencions: ['retenc'],
+  Obres: ['obr'],
+  Meteorologia: ['meteor', 'neu', 'pluja'],
+};
+
+// Informa de la vista actual del mapa (bbox + zoom) cada vez que se mueve
+const ViewportWatcher: React.FC<{ onChange: (view: MapView) => void }> = ({ onChange }) => {
+  const map = useMapEvents({
+    moveend: () => onChange({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() }),
+  });
+  useEffect(() => {
+    onChange({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() });
+  }, [map]);
+  return null;
+};
+
 type ExternalMarker = {
   lat: number;
   lng: number;
@@ -110,17 +141,27 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
   const [selectedType, setSelectedType] = useState<string>('Tots');
   const [selectedArea, setSelectedArea] = useState<string>('AMB');
 
-  // Función para obtener coordenadas del backend
-  const fetchIncidents = async () => {
+  // Vista actual del mapa: sólo se piden las incidencias que caen dentro
+  const [view, setView] = useState<MapView | null>(null);
+  const [clusters, setClusters] = useState<IncidentCluster[]>([]);
+  const [totalInView, setTotalInView] = useState(0);
+  const [liveLoaded, setLiveLoaded] = useState(false);
+  const requestId = useRef(0);
+
+  // Función para obtener del backend las incidencias de la vista (agrupadas a zoom bajo)
+  const fetchIncidents = async (currentView: MapView) => {
+    const id = ++requestId.current;
     try {
       setLoading(true);
-      const response = await fetch('http://localhost:8000/incidencias');
+      const params = new URLSearchParams({ bbox: currentView.bbox, zoom: String(currentView.zoom) });
+      if (onlySevere) params.append('nivel_min', '3');
+      (TYPE_FILTER_TEXTS[selectedType] || []).forEach(text => params.append('contiene', text));
+      const response = await fetch(`http://localhost:8000/api/incidents-map/query?${params}`);
       const data = await response.json();
-      
-      console.log('📍 Datos recibidos del backend:', data);
-      console.log('📍 Total incidencias:', data.incidencias?.length);
-      
-      const incidents: TrafficIncident[] = data.incidencias.map((inc: any, idx: number) => ({
+      // Si el mapa se ha movido mientras tanto, esta respuesta ya no sirve
+      if (id !== requestId.current) return;
+
+      const incidents: TrafficIncident[] = (data.incidents || []).map((inc: any, idx: number) => ({
         id: idx + 1,
         lat: inc.lat,
         lng: inc.lon,
@@ -137,24 +178,27 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
         tipo: inc.tipo,
         nivel: inc.nivel
       }));
-      
-      console.log('📍 Incidencias procesadas:', incidents);
-      console.log('📍 Primera incidencia:', incidents[0]);
-      
+
       setLiveIncidents(incidents);
+      setClusters(data.clusters || []);
+      setTotalInView(data.total ?? incidents.length);
+      setLiveLoaded(true);
     } catch (error) {
       console.error('❌ Error al obtener incidencias:', error);
     } finally {
-      setLoading(false);
+      if (id === requestId.current) setLoading(false);
     }
   };
 
-  // Cargar incidencias al montar el componente
+  // Recargar al mover el mapa o cambiar los filtros (con un pequeño debounce)
   useEffect(() => {
-    fetchIncidents();
-  }, []);
+    if (!view) return;
+    const timer = setTimeout(() => fetchIncidents(view), 150);
+    return () => clearTimeout(timer);
+  }, [view, onlySevere, selectedType]);
 
-  const rawItems: TrafficIncident[] = liveIncidents.length > 0
+  const hasLiveData = liveLoaded;
+  const rawItems: TrafficIncident[] = hasLiveData
     ? liveIncidents
     : (markers && markers.length)
       ? markers.map((m, i) => ({
@@ -166,8 +210,8 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
         }))
       : defaultIncidents;
 
-  // Aplicar filtros
-  const items = rawItems.filter(inc => {
+  // Los datos del backend ya vienen filtrados; los filtros locales sólo aplican a los marcadores de ejemplo
+  const items = hasLiveData ? rawItems : rawItems.filter(inc => {
     // Filtro de severidad
     if (onlySevere && (inc.nivel ?? 0) < 3) return false;
 
@@ -189,10 +233,6 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
     return true;
   });
 
-  console.log('🗺️ liveIncidents.length:', liveIncidents.length);
-  console.log('🗺️ Items a mostrar en el mapa:', items);
-  console.log('🗺️ Total items:', items.length);
-
   const styleHeight = typeof height === 'number' ? `${height}px` : height;
 
   // Calcular el centro del mapa basado en el área seleccionada
@@ -238,7 +278,7 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
         </div>
 
         <div className="filter-stats">
-          {items.length} incidències
+          {hasLiveData ? totalInView : items.length} incidències{loading ? '…' : ''}
         </div>
       </div>
 
@@ -252,6 +292,21 @@ const TrafficMap: React.FC<TrafficMapProps> = ({ markers, height = '100%', route
           attribution='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
           url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
         />
+        <ViewportWatcher onChange={setView} />
+        {clusters.map((cluster, idx) => (
+          <CircleMarker
+            key={`cluster-${idx}`}
+            center={[cluster.lat, cluster.lon]}
+            radius={Math.min(40, 12 + Math.sqrt(cluster.count) * 3)}
+            pathOptions={{
+              color: cluster.max_nivel >= 3 ? '#e11d48' : '#3498db',
+              fillColor: cluster.max_nivel >= 3 ? '#e11d48' : '#3498db',
+              fillOpacity: 0.5
+            }}
+          >
+            <Tooltip direction="center" permanent>{cluster.count}</Tooltip>
+          </CircleMarker>
+        ))}
         {items.map(incident => (
           <React.Fragment key={incident.id}>
             <Marker position={[incident.lat, incident.lng]} icon={getIconForIncident(incident.description)}>
@@ -32,6 +32,11 @@ type AnalysisResult = {
 };
 
 const API_BASE = process.env.REACT_APP_API_URL || 'http://localhost:8000';
+// Mida màxima per defecte del backend (DATASET_UPLOAD_MAX_BYTES)
+const MAX_UPLOAD_BYTES = 5 * 1024 * 1024 * 1024;
+
+// Els fitxers pujats es serveixen des del backend (/datasets/{id}/file)
+const datasetHref = (link: string) => (link.startsWith('/datasets/') ? `${API_BASE}${link}` : link);
 
 const Datasets: React.FC = () => {
   const { fetchWithAuth, user } = useAuth();
@@ -128,8 +133,8 @@ const Datasets: React.FC = () => {
       return;
     }
 
-    if (file.size > 50 * 1024 * 1024) { // 50MB limit
-      setUploadError('La mida del fitxer no pot superar 50MB');
+    if (file.size > MAX_UPLOAD_BYTES) {
+      setUploadError('La mida del fitxer no pot superar 5GB');
       return;
     }
 
@@ -266,7 +271,7 @@ const Datasets: React.FC = () => {
               </div>
 
               <div className="dataset-actions">
-                <a className="btn btn-view" href={dataset.link} target="_blank" rel="noopener noreferrer">🔗 Obrir enllaç</a>
+                <a className="btn btn-view" href={datasetHref(dataset.link)} target="_blank" rel="noopener noreferrer">🔗 Obrir enllaç</a>
                 <button className="btn btn-view" onClick={() => handleView(dataset)}>👁️ Vista ràpida</button>
                 <button className="btn btn-export" onClick={() => handleExport(dataset, 'CSV')}>⬇️ Exportar</button>
                 {dataset.id === 1 && (
@@ -306,7 +311,7 @@ const Datasets: React.FC = () => {
             </div>
             <p>
               Pots obrir l'enllaç oficial en una nova pestanya:{' '}
-              <a href={preview.link} target="_blank" rel="noopener noreferrer">{preview.link}</a>
+              <a href={datasetHref(preview.link)} target="_blank" rel="noopener noreferrer">{preview.link}</a>
             </p>
           </div>
         )}
@@ -542,7 +547,7 @@ const Datasets: React.FC = () => {
               o arrastra aquí per carregar
             </div>
             <div style={{ fontSize: '12px', color: '#999', marginTop: '8px' }}>
-              Màxim 50MB
+              Màxim 5GB
             </div>
           </div>
 
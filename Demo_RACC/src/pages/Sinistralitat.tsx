@@ -1,4 +1,4 @@
-import React, { useEffect, useMemo, useState } from 'react';
+import React, { useEffect, useMemo, useRef, useState } from 'react';
 import {
   BarChart,
   Bar,
@@ -19,9 +19,35 @@ type SummaryResponse = {
   via_mes_afectada: { carretera: string | null; incidents: number } | null;
 };
 
-type RankingEntry = { carretera: string; incidents: number; max_nivel: number; tipo_principal?: string | null };
+type IncidenciesDelta = {
+  version: number;
+  added: IncidenciaDetallada[];
+  updated: IncidenciaDetallada[];
+  resolved: string[];
+};
+
+// Aplica un delta del stream sobre la llista actual (per identificador)
+const applyDelta = (prev: IncidenciaDetallada[], delta: IncidenciesDelta): IncidenciaDetallada[] => {
+  const byId = new Map(prev.map((inc) => [String(inc.identificador), inc]));
+  delta.resolved.forEach((id) => byId.delete(String(id)));
+  [...delta.added, ...delta.updated].forEach((inc) => byId.set(String(inc.identificador), inc));
+  return Array.from(byId.values());
+};
+
+type RankingEntry = {
+  carretera: string;
+  pk_inici?: number | null;
+  pk_fi?: number | null;
+  incidents: number;
+  max_nivel: number;
+  tipo_principal?: string | null;
+};
+
+const tramLabel = (row: RankingEntry) =>
+  row.pk_inici != null && row.pk_fi != null ? `${row.carretera} (PK ${row.pk_inici}–${row.pk_fi})` : row.carretera;
 type IncidenciaDetallada = {
   id: string | number;
+  identificador?: string | null;
   carretera?: string | null;
   lat?: number | string | null;
   lon?: number | string | null;
@@ -97,19 +123,19 @@ const TramsRankingTable: React.FC<{
   return (
     <div className="ranking-table">
       <div className="ranking-head">
-        <span>VIA</span>
+        <span>TRAM</span>
         <span>INCIDENTS</span>
         <span>NIVELL MÀXIM</span>
         <span>TIPUS PRINCIPAL</span>
       </div>
       {data.map((row) => (
         <button
-          key={row.carretera}
+          key={`${row.carretera}-${row.pk_inici ?? ''}`}
           className={`ranking-row ${selected === row.carretera ? 'selected' : ''}`}
           onClick={() => onSelect?.(row.carretera)}
           type="button"
         >
-          <span>{row.carretera}</span>
+          <span>{tramLabel(row)}</span>
           <span>{row.incidents}</span>
           <span>{row.max_nivel}</span>
           <span>{row.tipo_principal || 'Desconegut'}</span>
@@ -223,10 +249,46 @@ const Sinistralitat: React.FC = () => {
     }
   };
 
+  const loadAggregates = async () => {
+    try {
+      const [summaryRes, rankingRes] = await Promise.all([
+        fetch(`${API_BASE}/api/incidencies/summary`),
+        fetch(`${API_BASE}/api/incidencies/ranking_trams`),
+      ]);
+      if (summaryRes.ok) setSummary((await summaryRes.json()) as SummaryResponse);
+      if (rankingRes.ok) setRanking((await rankingRes.json()) as RankingEntry[]);
+    } catch (err) {
+      console.error('Error carregant agregats', err);
+    }
+  };
+
+  const aggregatesTimer = useRef<ReturnType<typeof setTimeout> | null>(null);
+
   useEffect(() => {
-    loadData();
-    const interval = setInterval(loadData, 180000); // refresc cada 3 minuts
-    return () => clearInterval(interval);
+    if (typeof EventSource === 'undefined') {
+      loadData();
+      const interval = setInterval(loadData, 180000); // refresc cada 3 minuts
+      return () => clearInterval(interval);
+    }
+
+    // Canal push: un snapshot complet i després només els canvis
+    loadAggregates();
+    const source = new EventSource(`${API_BASE}/api/incidencies/stream`);
+    source.addEventListener('snapshot', (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      setIncidencies(data.incidencies || []);
+    });
+    source.addEventListener('delta', (event) => {
+      const delta = JSON.parse((event as MessageEvent).data) as IncidenciesDelta;
+      setIncidencies((prev) => applyDelta(prev, delta));
+      // Els agregats es recalculen al servidor: es tornen a demanar (agrupant ràfegues de canvis)
+      if (aggregatesTimer.current) clearTimeout(aggregatesTimer.current);
+      aggregatesTimer.current = setTimeout(loadAggregates, 1000);
+    });
+    return () => {
+      source.close();
+      if (aggregatesTimer.current) clearTimeout(aggregatesTimer.current);
+    };
   }, []);
 
   useEffect(() => {